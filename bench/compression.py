@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""compression.py [--cold] [--level=<N>] [<count>]
+
+Compare the load latency of caches saved with and without compression.
+
+Saves the paths of a synthetic folder (as cpickle and JSON) and their
+search and gram indices (as cpickle) both as-is and wrapped in a
+`ZlibSerializer`, which is what the workflow variable `compress_cache`
+does, and prints the size and load times of each file. The best of 3
+loads is shown.
+
+Compression only pays off if reading the uncompressed file takes longer
+than decompressing it, so run it with --cold on the disk in question.
+
+Usage:
+    compression.py [--cold] [--level=<N>] [<count>]
+
+Options:
+    --cold         Drop the page cache before each load (Linux as root
+                   or macOS with sudo), so the file is read from disk
+    --level=<N>    zlib compression level [default: 1]
+
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+
+from corpus import make_paths  # also adds `src` to `sys.path`
+from frontcoding import drop_caches
+
+from docopt import docopt
+
+from workflow import Workflow3
+from workflow.workflow import (CPickleSerializer, JSONSerializer,
+                               ZlibSerializer)
+
+
+def main():
+    """Run benchmark."""
+    args = docopt(__doc__)
+    count = int(args['<count>'] or 300000)
+    level = int(args['--level'])
+    wf = Workflow3()
+    paths = make_paths(count)
+    index = wf.search_index(paths, key=os.path.basename)
+    grams = wf.gram_index(index)
+    print('{0:d} paths, zlib level {1:d}'.format(count, level))
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        for label, data, serializer in (
+                ('paths cpickle', paths, CPickleSerializer),
+                ('paths json', paths, JSONSerializer),
+                ('index cpickle', index, CPickleSerializer),
+                ('grams cpickle', grams, CPickleSerializer)):
+            results = []
+            for compressed in (False, True):
+                if compressed:
+                    serializer = ZlibSerializer(serializer, 0, level)
+                path = os.path.join(tempdir, '{0}-{1:d}'.format(
+                    label.replace(' ', '-'), compressed))
+                start = time.time()
+                with open(path, 'wb') as fp:
+                    serializer.dump(data, fp)
+                dumped = time.time() - start
+
+                best = None
+                for _ in range(3):
+                    if args['--cold']:
+                        drop_caches()
+                    start = time.time()
+                    with open(path, 'rb') as fp:
+                        serializer.load(fp)
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+
+                results.append('{0:5.1f}MB dump {1:4.0f}ms load {2:4.0f}ms'
+                               .format(os.path.getsize(path) / 1e6,
+                                       dumped * 1000, best * 1000))
+
+            print('{0:<14} raw {1}  |  zlib {2}'.format(label, *results))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
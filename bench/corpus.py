@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""corpus.py [--seed=<N>] <count>
+
+Generate a synthetic Smart Folder: sorted paths of files in a few
+thousand directories under a handful of deep roots, like the results
+of a query that matches a whole home directory.
+
+Prints the paths one per line. The benchmarks import `make_paths()`.
+
+Usage:
+    corpus.py [--seed=<N>] <count>
+
+Options:
+    --seed=<N>   Seed of random number generator [default: 1]
+
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'src')
+sys.path.insert(0, SRC)
+
+from docopt import docopt  # noqa: E402
+
+ROOTS = (
+    u'/Users/me/Library/Mobile Documents/com~apple~CloudDocs',
+    u'/Users/me/Documents',
+    u'/Users/me/Downloads',
+    u'/Users/me/Library/Application Support/Foo/Data',
+)
+WORDS = (u'project invoice report 2019 2020 draft final notes photos scans '
+         u'taxes client r\xe9sum\xe9 archive').split()
+EXTENSIONS = ('pdf', 'docx', 'txt', 'jpg')
+# directories per root
+DIRS = 2500
+
+
+def make_paths(count, seed=1):
+    """Return `count` sorted, unique paths."""
+    rand = random.Random(seed)
+    dirs = []
+    for root in ROOTS:
+        for _ in range(DIRS):
+            d = root
+            for _ in range(rand.randint(1, 4)):
+                d += u'/{0}{1}'.format(rand.choice(WORDS), rand.randint(0, 30))
+            dirs.append(d)
+
+    paths = set()
+    while len(paths) < count:
+        paths.add(u'{0}/{1}-{2} {3}.{4}'.format(
+            rand.choice(dirs), rand.choice(WORDS), rand.choice(WORDS),
+            rand.randint(0, 999), rand.choice(EXTENSIONS)))
+
+    return sorted(paths)
+
+
+def main():
+    """Print paths."""
+    args = docopt(__doc__)
+    for path in make_paths(int(args['<count>']), int(args['--seed'])):
+        print(path.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""frontcoding.py [--cold] [<count>]
+
+Compare the size and load times of folder contents saved by the
+cpickle, strtab and frontcoded serializers.
+
+Each file is loaded and then (1) the first 100 paths are read, as for
+an unfiltered folder listing, (2) 100 random paths are read, as for
+search results, and (3) all paths are read, as when there's no search
+index. The best of 3 runs is shown.
+
+Usage:
+    frontcoding.py [--cold] [<count>]
+
+Options:
+    --cold   Drop the page cache before each load (Linux as root
+             or macOS with sudo), so the file is read from disk
+
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from corpus import make_paths  # also adds `src` to `sys.path`
+
+from docopt import docopt
+
+from workflow.workflow import (CPickleSerializer, FrontCodedSerializer,
+                               StringTableSerializer)
+
+SERIALIZERS = (
+    ('cpickle', CPickleSerializer),
+    ('strtab', StringTableSerializer),
+    ('frontcoded', FrontCodedSerializer),
+)
+
+READS = (
+    ('load+100', lambda data: list(data[:100])),
+    ('load+random100', lambda data: [data[random.randrange(len(data))]
+                                     for _ in range(100)]),
+    ('load+iterate', lambda data: sum(1 for _ in data)),
+)
+
+
+def drop_caches():
+    """Empty page cache, so files are read from disk."""
+    if sys.platform == 'darwin':
+        subprocess.check_call(['sudo', 'purge'])
+    else:
+        subprocess.check_call(['sync'])
+        with open('/proc/sys/vm/drop_caches', 'wb') as fp:
+            fp.write(b'3\n')
+
+
+def main():
+    """Run benchmark."""
+    args = docopt(__doc__)
+    count = int(args['<count>'] or 500000)
+    paths = make_paths(count)
+    print('{0:d} paths, {1:.1f}MB of text'.format(
+        count, sum(len(p.encode('utf-8')) + 1 for p in paths) / 1e6))
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        for name, serializer in SERIALIZERS:
+            path = os.path.join(tempdir, name)
+            start = time.time()
+            with open(path, 'wb') as fp:
+                serializer.dump(paths, fp)
+            dumped = time.time() - start
+
+            timings = []
+            for label, read in READS:
+                best = None
+                for _ in range(3):
+                    if args['--cold']:
+                        drop_caches()
+                    start = time.time()
+                    with open(path, 'rb') as fp:
+                        read(serializer.load(fp))
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                timings.append('{0} {1:.1f}ms'.format(label, best * 1000))
+
+            print('{0:<10} size {1:5.1f}MB  dump {2:.2f}s  {3}'.format(
+                name, os.path.getsize(path) / 1e6, dumped,
+                '  '.join(timings)))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
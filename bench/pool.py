@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""pool.py [--processes=<N>] [--index] [--budget=<SECS>] [<count>...]
+
+Find the number of items above which `Workflow.filter()` is quicker
+scoring them in parallel (`Workflow.filter_pool_size`).
+
+For each number of items, runs a few queries against synthetic paths
+with the serial scorer (the batch scorer if --index is given) and with
+the process pool, and prints the best of 3 times of each. The pool
+needs more than one CPU. --processes pretends there are that many,
+which on fewer CPUs only shows the overhead of forking.
+
+With --budget, each search is split into runs of that many seconds,
+as in the workflow, which reruns the search till it's finished. The
+times are then the total of all runs.
+
+Usage:
+    pool.py [--processes=<N>] [--index] [--budget=<SECS>] [<count>...]
+
+Options:
+    --processes=<N>   Number of processes to use instead of one per CPU
+    --index           Filter with a search index
+    --budget=<SECS>   Search in runs of this many seconds
+
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import time
+
+from corpus import make_paths  # also adds `src` to `sys.path`
+
+from docopt import docopt
+
+from workflow import Workflow3
+
+COUNTS = (5000, 10000, 20000, 50000, 100000, 300000)
+QUERIES = (u'inv', u'rcpt', u'e', u'tax fin')
+
+
+def best_time(func):
+    """Return best of 3 run times of `func`."""
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    """Run benchmark."""
+    args = docopt(__doc__)
+    if args['--processes']:
+        processes = int(args['--processes'])
+        multiprocessing.cpu_count = lambda: processes
+    counts = [int(n) for n in args['<count>']] or COUNTS
+    budget = None
+    if args['--budget']:
+        budget = float(args['--budget'])
+    print('{0:d} process(es), {1}, {2}'.format(
+        multiprocessing.cpu_count(),
+        'with search index' if args['--index'] else 'no search index',
+        'budget {0:0.0f}ms'.format(budget * 1000) if budget
+        else 'no budget'))
+
+    wf = Workflow3()
+    version = [0]  # new one for each search, so it starts from scratch
+    paths = make_paths(max(counts))
+    crossover = None
+    for count in counts:
+        items = paths[:count]
+        index = None
+        if args['--index']:
+            index = wf.search_index(items, key=os.path.basename)
+
+        serial = pool = 0.0
+        for query in QUERIES:
+            def run():
+                if budget is None:
+                    wf.filter(query, items, key=os.path.basename,
+                              index=index, min_score=10, max_results=100)
+                    return
+
+                version[0] += 1
+                while True:
+                    wf.filter(query, items, key=os.path.basename,
+                              index=index, min_score=10, max_results=100,
+                              session_key='bench', version=version[0],
+                              budget=budget)
+                    if not wf.filter_pending:
+                        break
+
+            wf.filter_pool_size = 0
+            serial += best_time(run)
+            wf.filter_pool_size = 1
+            pool += best_time(run)
+
+        if crossover is None and pool < serial:
+            crossover = count
+        print('{0:7d} items  serial {1:6.0f}ms  pool {2:6.0f}ms'.format(
+            count, serial * 1000 / len(QUERIES), pool * 1000 / len(QUERIES)))
+
+    if crossover is None:
+        print('pool never quicker')
+    else:
+        print('pool quicker from {0:d} items'.format(crossover))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,15 @@ Cache Smart Folders and their contents
 
 Usage:
     cache.py --folder <DIR>
+    cache.py --refresh-stale [--max-age=<SECS>]
     cache.py
 
 Options:
     -f, --folder=<DIR>   Cache contents of specified folder
+    --refresh-stale      Update cached contents of all folders that
+                         are older than --max-age
+    --max-age=<SECS>     Age at which cached contents are stale
+                         [default: 10]
 
 """
 
@@ -27,79 +32,915 @@ import sys
 import os
 import plistlib
 import hashlib
+from itertools import groupby
+import json
+from multiprocessing.pool import ThreadPool
+import re
+import signal
 import subprocess
+import threading
 from time import time
 
 from docopt import docopt
 
-from workflow import Workflow3
+from workflow import Workflow3, manager
+from workflow.background import is_running, run_in_background
+from workflow.util import atomic_writer
+
+import store
 
 # Placeholder, replaced on run
 log = None
 
+# Folder contents are saved as memory-mapped, front-coded string tables,
+# so loading them doesn't slow down with the size of the folder, and
+# the many shared directory prefixes are only stored once
+CONTENTS_SERIALIZER = 'frontcoded'
+
+# Pickled caches (i.e. search indices) larger than this are compressed.
+# That only speeds up loading them from slow disks, so it's off unless
+# the workflow variable `compress_cache` is set. Compressed caches can
+# be loaded either way.
+COMPRESS_THRESHOLD = 1024 * 1024  # bytes
+if os.getenv('compress_cache', '').lower() in ('1', 'true', 'yes'):
+    manager.compress('cpickle', COMPRESS_THRESHOLD)
+else:
+    manager.compress('cpickle', None)
+
+# Changes to folder contents are appended to a log instead of caching
+# the contents (and their search indices) again, until there are more
+# than this many changes (or log entries)
+MAX_DELTA_PATHS = 1000
+MAX_DELTA_RECORDS = 360  # an hour of updates
+
+# When a folder's contents are loaded for the first time, the files
+# found so far are cached after FIRST_SNAPSHOT paths and then every
+# SNAPSHOT_INTERVAL seconds, so they can be shown while mdfind runs
+FIRST_SNAPSHOT = 200
+SNAPSHOT_INTERVAL = 1.0  # seconds
+
+# The contents of the most used folders are updated along with the list
+# of folders if they're older than PREFETCH_AGE, so they're already
+# cached when the folders are opened
+PREFETCH_FOLDERS = 3
+PREFETCH_AGE = 600  # seconds
+
+# Name of stored log of how often and when folders were opened
+USAGE_LOG = 'usage'
+# Opening a folder counts half as much a week later
+USAGE_HALF_LIFE = 7 * 24 * 3600  # seconds
+
+# Name of cache of parsed .savedSearch files
+SEARCHES_CACHE = 'searches'
+# Number of threads that parse .savedSearch files during folder discovery
+PARSE_THREADS = 4
+# Number of mdfind queries run at once by `--refresh-stale`
+REFRESH_THREADS = 4
+
+# mdfind queries that run longer than this are killed, and the cached
+# data are kept. Set the workflow variable `query_timeout` to change it.
+QUERY_TIMEOUT = 60  # seconds
+
+# Default maximum size of folder caches in MB. Set the workflow
+# variable `cache_budget` to change it.
+CACHE_BUDGET = 200
+
+# Name of folder contents cache or one of its indices
+FOLDER_CACHE = re.compile(r'^(folder-[0-9a-f]{32})(-index|-grams)?$')
+
 
 def cache_key(path):
     """Return cache key for `path`."""
     return 'folder-{}'.format(hashlib.md5(path.encode('utf-8')).hexdigest())
 
 
+def index_key(path):
+    """Return cache key for search index of `path`."""
+    return cache_key(path) + '-index'
+
+
+def grams_key(path):
+    """Return cache key for posting lists of `path`."""
+    return cache_key(path) + '-grams'
+
+
+def folder_command(wf, path):
+    """Return command to update cached contents of folder `path`."""
+    return ['/usr/bin/python', wf.workflowfile('cache.py'), '--folder', path]
+
+
+def contents_state(wf, path):
+    """Return `(mtime, changes, updated)` of cached contents of `path`.
+
+    `mtime` is the modification time of the contents' cache, `changes`
+    their `DeltaLog` and `updated` the time they were last updated.
+    `mtime` and `updated` are `None` if the contents aren't cached.
+
+    """
+    info = wf.cached_data_info(cache_key(path), CONTENTS_SERIALIZER)
+    if not info:
+        return None, DeltaLog(), None
+
+    changes = DeltaLog(delta_log(wf, path), info['version']).load()
+    updated = info['mtime']
+    if changes.mtime is not None:
+        updated = max(updated, changes.mtime)
+
+    return info['mtime'], changes, updated
+
+
+def record_usage(wf, path):
+    """Add opening of folder `path` to usage log."""
+    usage = wf.stored_data(USAGE_LOG) or {}
+    count, _ = usage.get(path, (0, 0))
+    usage[path] = (count + 1, time())
+    wf.store_data(USAGE_LOG, usage)
+
+
+def frequent_folders(wf, count):
+    """Return paths of the `count` most frequently and recently used folders.
+
+    Each time a folder was opened counts half as much after
+    `USAGE_HALF_LIFE`, so folders opened often in the past rank below
+    folders opened a few times recently.
+
+    """
+    usage = wf.stored_data(USAGE_LOG) or {}
+    now = time()
+
+    def frecency(path):
+        n, last = usage[path]
+        return n * 0.5 ** ((now - last) / USAGE_HALF_LIFE)
+
+    return sorted(usage, key=frecency, reverse=True)[:count]
+
+
+def parse_search(path):
+    """Return `mdfind` command for Smart Folder at `path`.
+
+    Returns:
+        tuple: `(cmd, missing)`, where `cmd` is the `mdfind` command
+            and `missing` the search scopes that were left out because
+            they don't exist (yet).
+
+    Raises:
+        ValueError: Raised if `path` isn't a valid saved search.
+    """
+    # Smart Folders in ~/Library/Saved Searches *can* be called by name,
+    # but (on Catalina at least) location restrictions aren't observed,
+    # so we'll parse these files, too.
+    # if path.startswith(os.path.expanduser('~/Library/Saved Searches')):
+    #     name = os.path.splitext(os.path.basename(path))[0]
+    #     cmd = ['mdfind', '-s', name]
+    try:
+        params = plistlib.readPlist(path)['RawQueryDict']
+        query = params['RawQuery']
+        locations = params['SearchScopes']
+    except Exception as err:
+        raise ValueError('invalid saved search %r: %r' % (path, err))
+
+    log.debug('[cache] query=%r, locations=%r', query, locations)
+    cmd = ['mdfind']
+    missing = []
+    for p in locations:
+        if p == 'kMDQueryScopeHome':
+            p = os.path.expanduser('~/')
+        elif p == 'kMDQueryScopeComputer':
+            continue
+        elif not os.path.exists(p):
+            missing.append(p)
+            continue
+        cmd.extend(['-onlyin', p])
+
+    cmd.append(query)
+    return cmd, missing
+
+
+def load_search(path):
+    """Parse Smart Folder at `path` into an entry for `SEARCHES_CACHE`.
+
+    The entry records the file's size and modification time, so
+    `search_valid()` can tell when it has changed, and either the
+    `mdfind` command (`cmd`) or why the file couldn't be parsed
+    (`error`).
+
+    """
+    st = os.stat(path)
+    entry = {'mtime': st.st_mtime, 'size': st.st_size, 'missing': []}
+    try:
+        entry['cmd'], entry['missing'] = parse_search(path)
+    except ValueError as err:
+        log.error('[cache] %s', err)
+        entry['error'] = str(err)
+
+    return entry
+
+
+def search_valid(entry, path):
+    """Return `True` if `entry` of `SEARCHES_CACHE` is still valid.
+
+    It isn't if the Smart Folder at `path` has changed or a search
+    scope that was missing has appeared (e.g. a drive was mounted).
+
+    """
+    if not entry:
+        return False
+
+    st = os.stat(path)
+    if (st.st_mtime, st.st_size) != (entry['mtime'], entry['size']):
+        return False
+
+    return not any(os.path.exists(p) for p in entry['missing'])
+
+
+def delta_log(wf, path):
+    """Return path of the log of changes to contents of folder `path`."""
+    return wf.cachefile(cache_key(path) + '.delta')
+
+
+def partial_flag(wf, path):
+    """Return path of file marking cached contents of `path` incomplete."""
+    return wf.cachefile(cache_key(path) + '.partial')
+
+
+class DeltaLog(object):
+    """Append-only log of changes to a folder's cached contents.
+
+    The first line of the log is the version (per the cache manifest)
+    of the cached contents the changes were made to. Every other line
+    is a JSON list of the paths added and the paths removed by an
+    update.
+
+    Attributes:
+        added (list): Paths added since contents were cached (sorted)
+        removed (set): Paths removed since contents were cached
+        records (int): Number of updates in log
+        mtime (float): Time of last update or `None` if there is no
+            log for `version`
+        size (int): Size of the log in bytes
+
+    """
+
+    def __init__(self, path=None, version=None):
+        """Create new `DeltaLog` for contents `version` at `path`."""
+        self.path = path
+        self.version = version
+        self.added = []
+        self.removed = set()
+        self.records = 0
+        self.mtime = None
+        self.size = 0
+
+    def __len__(self):
+        """Return number of added and removed paths."""
+        return len(self.added) + len(self.removed)
+
+    def load(self):
+        """Read log and add up the changes. Returns `self`."""
+        try:
+            with open(self.path, 'rb') as fp:
+                st = os.fstat(fp.fileno())
+                lines = fp.read().splitlines()
+        except IOError:
+            return self
+
+        # no log for this version of the contents
+        if not lines or json.loads(lines[0]) != self.version:
+            return self
+
+        added, removed = set(), set()
+        for line in lines[1:]:
+            try:
+                plus, minus = json.loads(line)
+            except ValueError:  # not written yet
+                break
+            for p in minus:
+                if p in added:
+                    added.discard(p)
+                else:
+                    removed.add(p)
+            for p in plus:
+                if p in removed:
+                    removed.discard(p)
+                else:
+                    added.add(p)
+            self.records += 1
+
+        self.added = sorted(added)
+        self.removed = removed
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        return self
+
+    def append(self, added, removed):
+        """Add an update that added and removed paths to log."""
+        # a single write, so readers never see half a line
+        with open(self.path, 'ab') as fp:
+            fp.write(json.dumps([added, removed]) + '\n')
+
+    def touch(self):
+        """Record an update that didn't change anything."""
+        os.utime(self.path, None)
+
+    def reset(self):
+        """Start a new, empty log."""
+        with atomic_writer(self.path, 'wb') as fp:
+            fp.write(json.dumps(self.version) + '\n')
+
+
+def cache_budget():
+    """Return maximum size of folder caches in bytes."""
+    try:
+        budget = float(os.getenv('cache_budget') or CACHE_BUDGET)
+    except ValueError:
+        budget = CACHE_BUDGET
+
+    return int(budget * 1024 * 1024)
+
+
+def query_timeout():
+    """Return maximum run time of mdfind queries in seconds."""
+    try:
+        return float(os.getenv('query_timeout') or QUERY_TIMEOUT)
+    except ValueError:
+        return QUERY_TIMEOUT
+
+
+class QueryTimeout(Exception):
+    """Raised if an mdfind query takes longer than `query_timeout()`."""
+
+
+class Query(object):
+    """mdfind process that is killed if it runs too long.
+
+    mdfind runs in its own process group, which a watchdog kills after
+    `timeout` seconds, so reading its output can't hang. Use it as a
+    context manager, so the process group is also killed if reading
+    fails or the job itself is terminated.
+
+    """
+
+    #: Queries that haven't finished, killed on SIGTERM
+    running = set()
+
+    def __init__(self, cmd, timeout):
+        """Start `cmd`."""
+        self.cmd = cmd
+        self.timeout = timeout
+        self.timed_out = False
+        self.proc = subprocess.Popen(cmd, bufsize=-1, stdout=subprocess.PIPE,
+                                     preexec_fn=os.setpgrp)
+        self.stdout = self.proc.stdout
+        self.running.add(self)
+        self._watchdog = threading.Timer(timeout, self._expire)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _expire(self):
+        """Kill query that has run too long."""
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        """Kill query and any processes it started."""
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:  # already finished
+            pass
+
+    def wait(self):
+        """Wait for query to finish.
+
+        Raises:
+            QueryTimeout: Raised if the query was killed by the watchdog.
+            subprocess.CalledProcessError: Raised if mdfind failed.
+        """
+        retcode = self.proc.wait()
+        self._watchdog.cancel()
+        if self.timed_out:
+            raise QueryTimeout('query timed out after %0.0fs: %r' %
+                               (self.timeout, self.cmd))
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, self.cmd)
+
+    def __enter__(self):
+        """Return query."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Kill query if it's still running."""
+        self._watchdog.cancel()
+        if self.proc.poll() is None:
+            self.kill()
+            self.proc.wait()
+        self.running.discard(self)
+
+
+def terminate(*args):
+    """Kill running queries and exit. Handler for SIGTERM."""
+    for query in list(Query.running):
+        query.kill()
+    sys.exit(1)
+
+
 class Cache(object):
     """Cache of all smart folders or their contents."""
 
     def __init__(self):
         """Create new `Cache`."""
         self.wf = None
+        self._searches = None
 
     def run(self, wf):
         """Run Cache."""
         self.wf = wf
         args = docopt(__doc__, argv=wf.args)
         path = args['--folder']
+        max_age = float(args['--max-age'])
+
+        if store.enabled():
+            db = store.Store(wf)
+            if args['--refresh-stale']:
+                self.refresh_stale(max_age, db)
+                return self.evict(db=db)
+            return self.run_store(db, path)
+
+        if args['--refresh-stale']:
+            self.refresh_stale(max_age)
+            return self.evict()
 
         try:
             if path:  # cache contents of Smart Folder
-                wf.cache_data(cache_key(path), self.folder_contents(path))
+                self.update_folder(path)
 
             else:  # cache list of all Smart Folders
-                wf.cache_data('folders', self.smart_folders())
+                folders = self.smart_folders()
+                self.parse_searches(folders)
+                wf.cache_data('folders', folders)
+                # remove search state of previous sessions
+                wf.clear_session_cache()
+                self.prefetch(folders)
 
             wf.cache_data('error', None)  # clear existing error
+        except QueryTimeout as err:
+            log.warning('[cache] %s', err)
+            # keep cached data, if any, and try again when they're stale
+            if self.postpone(path):
+                return
+
+            # message only: smartfolders.py can't unpickle this class
+            wf.cache_data('error', unicode(err))
+            raise err
         except Exception as err:
             wf.cache_data('error', err)
             raise err
 
-    def folder_contents(self, path):
-        """Return `list` of files in Smart Folder at `path`."""
-        # Smart Folders in ~/Library/Saved Searches *can* be called by name,
-        # but (on Catalina at least) location restrictions aren't observed,
-        # so we'll parse these files, too.
-        # if path.startswith(os.path.expanduser('~/Library/Saved Searches')):
-        #     name = os.path.splitext(os.path.basename(path))[0]
-        #     cmd = ['mdfind', '-s', name]
-
-        # Parse .savedSearch file and construct corresponding `mdfind` command.
-        plist = plistlib.readPlist(path)
-        params = plist['RawQueryDict']
-        query = params['RawQuery']
-        locations = params['SearchScopes']
-        log.debug('[cache] query=%r, locations=%r', query, locations)
-        cmd = ['mdfind']
-        for p in locations:
-            if p == 'kMDQueryScopeHome':
-                p = os.path.expanduser('~/')
-            elif p == 'kMDQueryScopeComputer' or not os.path.exists(p):
+        self.evict(keep=cache_key(path) if path else None)
+
+    def postpone(self, path):
+        """Mark cached contents of `path` (or list of folders) up to date.
+
+        So a failed update is only retried when they're stale again.
+        Returns `False` if there is nothing cached or the cached
+        contents are incomplete (i.e. the first load didn't finish).
+
+        """
+        wf = self.wf
+        if not path:
+            folders = wf.cached_data('folders', max_age=0)
+            if folders is None:
+                return False
+            wf.cache_data('folders', folders)
+            return True
+
+        info = wf.cached_data_info(cache_key(path), CONTENTS_SERIALIZER)
+        if not info or os.path.exists(partial_flag(wf, path)):
+            return False
+
+        changes = DeltaLog(delta_log(wf, path), info['version']).load()
+        if changes.mtime is None:
+            changes.reset()
+        else:
+            changes.touch()
+        return True
+
+    def prefetch(self, folders, db=None):
+        """Update cached contents of the most used `folders` if they're old.
+
+        `db` is the `store.Store` if the SQLite cache is used.
+
+        """
+        paths = set(path for _, path in folders)
+        for path in frequent_folders(self.wf, PREFETCH_FOLDERS):
+            if path not in paths:
+                continue
+
+            if db:
+                updated = db.updated(path)
+            else:
+                updated = contents_state(self.wf, path)[2]
+
+            if updated is None or time() - updated > PREFETCH_AGE:
+                log.debug('[cache] prefetching contents of %r ...', path)
+                run_in_background(cache_key(path),
+                                  folder_command(self.wf, path))
+
+    def refresh_stale(self, max_age, db=None):
+        """Update cached contents of all folders older than `max_age`.
+
+        Up to `REFRESH_THREADS` mdfind queries run at once, and each
+        folder's cache is updated (by this thread) as soon as its query
+        finishes. Folders that aren't cached yet or that are being
+        updated by a background job are skipped. `db` is the
+        `store.Store` if the SQLite cache is used.
+
+        """
+        start = time()
+        if db:
+            folders = db.folders()
+        else:
+            folders = self.wf.cached_data('folders', max_age=0) or []
+
+        stale = []
+        for _, path in folders:
+            if db:
+                updated = db.updated(path)
+            else:
+                updated = contents_state(self.wf, path)[2]
+
+            if (updated is None or time() - updated < max_age or
+                    is_running(cache_key(path))):
+                continue
+
+            # parse saved search here, as it may update its cache
+            try:
+                self.search_command(path)
+            except (OSError, ValueError) as err:
+                log.error('[cache] %s', err)
+                continue
+
+            stale.append(path)
+
+        log.debug('[cache] %d/%d folder(s) stale', len(stale), len(folders))
+
+        def query(path):
+            t = time()
+            try:
+                files = self.folder_contents(path)
+            except Exception as err:  # reported below
+                files = err
+            return path, files, time() - t
+
+        done = 0
+        if stale:
+            pool = ThreadPool(min(REFRESH_THREADS, len(stale)))
+            try:
+                for path, files, duration in pool.imap_unordered(query, stale):
+                    if isinstance(files, Exception):
+                        log.error('[cache] %r: %s', path, files)
+                        continue
+
+                    t = time()
+                    if db:
+                        self.store_contents(db, path, files)
+                    else:
+                        self.update_folder(path, files)
+
+                    done += 1
+                    log.info('[cache] %d file(s) in %r, query: %0.2fs, '
+                             'update: %0.2fs', len(files), path, duration,
+                             time() - t)
+            finally:
+                pool.close()
+
+        log.info('[cache] %d/%d stale folder(s) updated in %0.2fs',
+                 done, len(stale), time() - start)
+
+    def update_folder(self, path, files=None):
+        """Update cached contents of Smart Folder at `path`.
+
+        Changes since the last update are appended to the folder's
+        `DeltaLog`. When there are too many, the contents and their
+        search indices are cached again, and the log is started afresh.
+        `files` are the folder's current contents, if already fetched.
+
+        """
+        wf = self.wf
+        key = cache_key(path)
+        info = wf.cached_data_info(key, CONTENTS_SERIALIZER)
+        cached = wf.cached_data(key, max_age=0, serializer=CONTENTS_SERIALIZER)
+        if os.path.exists(partial_flag(wf, path)):  # last load didn't finish
+            cached = None
+
+        if files is None:
+            publish = None
+            if cached is None:
+                publish = self._publisher(path, lambda snapshot: wf.cache_data(
+                    key, snapshot, serializer=CONTENTS_SERIALIZER))
+
+            files = self.folder_contents(path, publish)
+        if cached is not None:
+            changes = DeltaLog(delta_log(wf, path), info['version']).load()
+            if changes.mtime is None:
+                changes.reset()
+
+            cached = set(cached)
+            current = (cached - changes.removed).union(changes.added)
+            new = set(files)
+            if (changes.records < MAX_DELTA_RECORDS and
+                    len(cached ^ new) <= MAX_DELTA_PATHS):
+                added, removed = sorted(new - current), sorted(current - new)
+                log.debug('[cache] %d added, %d removed', len(added),
+                          len(removed))
+                if added or removed:
+                    changes.append(added, removed)
+                else:
+                    changes.touch()
+                return
+
+        version = self._save_contents(path, files)
+        DeltaLog(delta_log(wf, path), version).reset()
+        self._remove(partial_flag(wf, path))
+
+    def store_contents(self, db, path, files):
+        """Save contents `files` of folder `path` to SQLite cache `db`.
+
+        They're also cached with their search indices (for short
+        queries), unless they haven't changed since they were last
+        saved, in which case `db` is only marked as updated.
+
+        """
+        wf = self.wf
+        key = cache_key(path)
+        version = db.indexed(path)
+        info = wf.cached_data_info(key, CONTENTS_SERIALIZER)
+        if (version is not None and info and info['version'] == version and
+                list(wf.cached_data(key, max_age=0,
+                                    serializer=CONTENTS_SERIALIZER)) ==
+                files):
+            log.debug('[cache] contents unchanged')
+            db.touch(path)
+            return
+
+        db.set_contents(path, files, self._save_contents(path, files))
+
+    def _save_contents(self, path, files):
+        """Cache contents `files` of folder `path` and their search indices.
+
+        Returns the version (per the cache manifest) of the contents'
+        cache.
+
+        """
+        wf = self.wf
+        key = cache_key(path)
+        index = wf.search_index(files, key=os.path.basename)
+        # Indices are written first, so readers can tell if they're
+        # out of sync with the contents (i.e. newer)
+        wf.cache_data(grams_key(path), wf.gram_index(index))
+        wf.cache_data(index_key(path), index)
+        wf.cache_data(key, files, serializer=CONTENTS_SERIALIZER)
+        return wf.cached_data_info(key, CONTENTS_SERIALIZER)['version']
+
+    def _publisher(self, path, save):
+        """Return function that marks contents of `path` partial and saves them.
+
+        For `folder_contents()`. `save` is called with the list of
+        files found so far.
+
+        """
+        flag = partial_flag(self.wf, path)
+
+        def publish(files):
+            log.debug('[cache] %d file(s) found so far', len(files))
+            if not os.path.exists(flag):
+                open(flag, 'wb').close()
+            save(files)
+
+        return publish
+
+    def _remove(self, path):
+        """Delete file at `path` if it exists."""
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def evict(self, keep=None, db=None):
+        """Delete least recently used folder caches over budget.
+
+        Caches of folders that no longer exist go first. Folder
+        contents are updated whenever they're viewed, so the time of
+        the last update (per `contents_state` or the SQLite cache `db`)
+        is (more or less) the time of the last access. Caches that are
+        being read and the cache of folder `keep` are never deleted.
+
+        """
+        if db:
+            folders = db.folders()
+        else:
+            folders = self.wf.cached_data('folders', max_age=0) or []
+        paths = dict((cache_key(path), path) for _, path in folders)
+
+        caches = {}  # folder key -> manifest entries
+        for info in self.wf.cached_data_entries():
+            m = FOLDER_CACHE.match(info['name'])
+            if m:
+                caches.setdefault(m.group(1), []).append(info)
+
+        # Updates only append to the log of changes, which isn't in the
+        # manifest, so count it, too
+        deltas = {}  # folder key -> size of log of changes
+        for key in caches:
+            try:
+                deltas[key] = os.path.getsize(
+                    self.wf.cachefile(key + '.delta'))
+            except OSError:  # no changes logged
+                deltas[key] = 0
+
+        size = sum(info['size'] for entries in caches.values()
+                   for info in entries) + sum(deltas.values())
+        budget = cache_budget()
+        log.debug('[cache] %d folder cache(s), %d/%d bytes',
+                  len(caches), size, budget)
+
+        def lru(key):
+            if key in paths:
+                if db:
+                    updated = db.updated(paths[key])
+                else:
+                    updated = contents_state(self.wf, paths[key])[2]
+                if updated is not None:
+                    return (True, updated)
+            return (key in paths, max(i['mtime'] for i in caches[key]))
+
+        for key in sorted(caches, key=lru):
+            if size <= budget:
+                break
+            if key == keep:
                 continue
-            cmd.extend(['-onlyin', p])
 
-        cmd.append(query)
+            for info in caches[key]:
+                if self.wf.evict_cached_data(info['name'],
+                                             info['serializer']):
+                    size -= info['size']
+                    if info['name'] == key:  # contents
+                        self._remove(self.wf.cachefile(key + '.delta'))
+                        self._remove(self.wf.cachefile(key + '.partial'))
+                        size -= deltas[key]
+
+    def run_store(self, db, path):
+        """Update SQLite cache `db` (a `store.Store`)."""
+        try:
+            if path:  # cache contents of Smart Folder
+                flag = partial_flag(self.wf, path)
+                publish = None
+                if db.updated(path) is None or os.path.exists(flag):
+                    publish = self._publisher(path, lambda files: (
+                        db.set_contents(path, files)))
+
+                self.store_contents(db, path,
+                                    self.folder_contents(path, publish))
+                self._remove(flag)
+            else:  # cache list of all Smart Folders
+                folders = self.smart_folders()
+                self.parse_searches(folders)
+                db.set_folders(folders)
+                # remove search state of previous sessions
+                self.wf.clear_session_cache()
+                self.prefetch(folders, db)
+
+            db.set_error(None)  # clear existing error
+        except QueryTimeout as err:
+            log.warning('[cache] %s', err)
+            # keep cached data, if any, and try again when they're stale
+            key = path or 'folders'
+            partial = path and os.path.exists(partial_flag(self.wf, path))
+            if db.updated(key) is not None and not partial:
+                db.touch(key)
+                return
+
+            db.set_error(err)
+            raise err
+        except Exception as err:
+            db.set_error(err)
+            raise err
+
+        self.evict(keep=cache_key(path) if path else None, db=db)
+
+    @property
+    def searches(self):
+        """Cached entries of parsed Smart Folders, keyed by path."""
+        if self._searches is None:
+            self._searches = self.wf.cached_data(SEARCHES_CACHE,
+                                                 max_age=0) or {}
+        return self._searches
 
+    def parse_searches(self, folders):
+        """Parse `.savedSearch` files of changed `folders` in parallel.
+
+        Entries of folders that no longer exist are dropped from the
+        cache.
+
+        """
+        searches = self.searches
+        todo = [path for _, path in folders
+                if not search_valid(searches.get(path), path)]
+        if todo:
+            log.debug('[cache] parsing %d Smart Folder(s) ...', len(todo))
+            pool = ThreadPool(min(PARSE_THREADS, len(todo)))
+            try:
+                searches.update(zip(todo, pool.map(load_search, todo)))
+            finally:
+                pool.close()
+
+        paths = set(path for _, path in folders)
+        if todo or set(searches) - paths:
+            self._searches = dict((path, searches[path]) for path in paths)
+            self.wf.cache_data(SEARCHES_CACHE, self._searches)
+
+    def search_command(self, path):
+        """Return `mdfind` command for Smart Folder at `path`.
+
+        The `.savedSearch` file is only parsed if it has changed since
+        it was last parsed.
+
+        Raises:
+            ValueError: Raised if `path` isn't a valid saved search.
+        """
+        entry = self.searches.get(path)
+        if not search_valid(entry, path):
+            entry = self.searches[path] = load_search(path)
+            self.wf.cache_data(SEARCHES_CACHE, self.searches)
+
+        if 'error' in entry:
+            raise ValueError(entry['error'])
+
+        return entry['cmd']
+
+    def folder_contents(self, path, publish=None):
+        """Return `list` of files in Smart Folder at `path`.
+
+        If `publish` is given, mdfind's output is read as it arrives,
+        and `publish` is called with the (sorted) files found so far
+        after `FIRST_SNAPSHOT` paths and then every `SNAPSHOT_INTERVAL`
+        seconds.
+
+        """
+        # NUL-delimited, so filenames may contain newlines
+        cmd = self.search_command(path)
+        cmd = cmd[:1] + ['-0'] + cmd[1:]
         log.debug('[cache] cmd=%r', cmd)
-        output = self.wf.decode(subprocess.check_output(cmd))
 
-        files = [p.strip() for p in output.split('\n') if p.strip()]
+        paths = set()  # paths as returned by mdfind, i.e. UTF-8
+        tail = [b'']  # incomplete path at end of output read so far
+
+        def add(data):
+            chunk = (tail[0] + data).split(b'\0')
+            tail[0] = chunk.pop()
+            paths.update(chunk)
+
+        with Query(cmd, query_timeout()) as query:
+            if publish is None:
+                add(query.stdout.read())
+            else:
+                fd = query.stdout.fileno()
+                last = None  # time of last snapshot
+                for data in iter(lambda: os.read(fd, 65536), b''):
+                    add(data)
+                    if last is None:
+                        due = len(paths) >= FIRST_SNAPSHOT
+                    else:
+                        due = time() - last >= SNAPSHOT_INTERVAL
+
+                    if due:
+                        publish(self._decode_paths(paths))
+                        last = time()
+
+            paths.add(tail[0])
+            query.wait()
+
+        files = self._decode_paths(paths)
         log.debug('%d file(s) in folder %r', len(files), path)
         return files
 
+    def _decode_paths(self, paths):
+        """Return sorted `list` of `unicode` paths for UTF-8 `paths`.
+
+        Sorted, so paths in the same directory are stored together,
+        and without duplicates, so changes can be logged as sets.
+
+        """
+        # Sorting bytes is much faster than sorting unicode, and as
+        # UTF-8 sorts like the code points it encodes, the decoded paths
+        # are still (all but, due to normalisation) sorted, which makes
+        # sorting them again cheap. Decoding and normalising all paths
+        # at once is also much faster than one by one.
+        paths.discard(b'')
+        text = self.wf.decode(b'\0'.join(sorted(paths)))
+        files = sorted(text.split(u'\0')) if text else []
+        # normalisation can turn different paths into the same one
+        return [p for p, _ in groupby(files)]
+
     def smart_folders(self):
         """Return list of all Smart Folders on system.
 
@@ -108,13 +949,13 @@ class Cache(object):
         """
         folders = []
         log.debug('[cache] querying mds for Smart Folders ...')
-        output = subprocess.check_output([
-            'mdfind', 'kMDItemContentType == com.apple.finder.smart-folder'
-        ])
+        with Query(['mdfind', '-0',
+                    'kMDItemContentType == com.apple.finder.smart-folder'],
+                   query_timeout()) as query:
+            output = query.stdout.read()
+            query.wait()
 
-        for path in [p.strip() for p in self.wf.decode(output).split('\n')]:
-            if not path:
-                continue
+        for path in self._decode_paths(set(output.split(b'\0'))):
             name = os.path.splitext(os.path.basename(path))[0]
             folders.append((name, path))
             log.debug('[cache] "%s" (%s)', (name, path))
@@ -127,5 +968,7 @@ class Cache(object):
 if __name__ == '__main__':
     wf = Workflow3()
     log = wf.logger
+    # kill mdfind when job is superseded
+    signal.signal(signal.SIGTERM, terminate)
     cache = Cache()
     wf.run(cache.run)
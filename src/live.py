@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""live.py
+
+Keep the contents of recently opened Smart Folders up to date.
+
+Runs one `mdfind -live` query per recently opened folder and updates
+the folder's cache when its query reports changes, so the contents
+don't have to be re-fetched every `CACHE_AGE_CONTENTS` seconds while
+the folder is open. Exits when no folder has been opened for
+`LIVE_IDLE` seconds.
+
+`mdfind -live` only reports the number of matches when it changes, not
+which files were added or removed, so the folder is updated by the
+usual `cache.py --folder` job, which logs the changes.
+
+Turn it on by setting the workflow variable `live_updates` to `1`.
+
+"""
+
+from __future__ import print_function
+
+import os
+import select
+import signal
+import subprocess
+import sys
+from time import time
+
+from workflow import Workflow3
+from workflow.background import is_running, run_in_background
+from workflow.util import LockFile
+
+import cache
+import store
+
+# Name of background job and of cache of watched folders
+LIVE_JOB = 'live'
+# Maximum number of folders watched at once
+LIVE_FOLDERS = 3
+# Folders are watched till they haven't been opened for this long.
+# The daemon exits when no folders are left.
+LIVE_IDLE = 600  # seconds
+# How often the usage log is checked for newly opened folders
+LIVE_CHECK = 5  # seconds
+# A folder is updated once its query has been quiet for this long
+LIVE_DELAY = 1.0  # seconds
+
+# Placeholder, replaced on run
+log = None
+
+
+def enabled():
+    """Return `True` if live updates are turned on."""
+    return os.getenv('live_updates', '').lower() in ('1', 'true', 'yes')
+
+
+def start(wf):
+    """Start daemon if it isn't already running."""
+    if not is_running(LIVE_JOB):
+        run_in_background(LIVE_JOB, ['/usr/bin/python',
+                                     wf.workflowfile('live.py')])
+
+
+def watching(wf, path):
+    """Return `True` if the daemon is keeping folder `path` up to date."""
+    if not is_running(LIVE_JOB):
+        return False
+
+    return path in (wf.cached_data(LIVE_JOB, max_age=0) or ())
+
+
+def recent_folders(wf):
+    """Return paths of the most recently opened folders that aren't idle."""
+    usage = wf.stored_data(cache.USAGE_LOG) or {}
+    now = time()
+    paths = [p for p, (_, last) in usage.items() if now - last < LIVE_IDLE]
+    paths.sort(key=lambda p: usage[p][1], reverse=True)
+    return paths[:LIVE_FOLDERS]
+
+
+class LiveQuery(object):
+    """`mdfind -live` process for one Smart Folder."""
+
+    def __init__(self, wf, path, cmd):
+        """Start live query `cmd` for folder at `path`."""
+        self.wf = wf
+        self.path = path
+        # when the query last produced output, i.e. reported changes
+        self.changed = time()
+        cmd = cmd[:1] + ['-live'] + cmd[1:]
+        log.debug('[live] cmd=%r', cmd)
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def fileno(self):
+        """Return file descriptor of query's output (for `select`)."""
+        return self.proc.stdout.fileno()
+
+    def read(self):
+        """Read query's output. Return `False` if the query has exited."""
+        # The output itself is of no use: first the matching files,
+        # then the number of matches each time it changes
+        if not os.read(self.fileno(), 65536):
+            self.proc.wait()
+            log.debug('[live] query for %r exited with %r', self.path,
+                      self.proc.returncode)
+            return False
+
+        self.changed = time()
+        return True
+
+    def update(self):
+        """Update cached contents of folder if query has been quiet."""
+        if self.changed and time() - self.changed >= LIVE_DELAY:
+            log.debug('[live] updating %r ...', self.path)
+            run_in_background(cache.cache_key(self.path),
+                              cache.folder_command(self.wf, self.path))
+            self.changed = None
+
+    def stop(self):
+        """Terminate query."""
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+
+def main(wf):
+    """Run live queries till no folder has been opened for a while."""
+    # Only one daemon, even if its background runner has been killed
+    lock = LockFile(wf.cachefile(LIVE_JOB))
+    if not lock.acquire(blocking=False):
+        log.debug('[live] daemon already running')
+        return
+
+    # stop queries when killed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    searches = cache.Cache()
+    searches.wf = wf
+    db = store.Store(wf) if store.enabled() else None
+    queries = {}  # path -> LiveQuery
+    watched = None
+    checked = 0
+    try:
+        while True:
+            if time() - checked >= LIVE_CHECK:
+                checked = time()
+                if db:
+                    folders = db.folders()
+                else:
+                    folders = wf.cached_data('folders', max_age=0) or ()
+                folders = set(p for _, p in folders)
+                paths = [p for p in recent_folders(wf) if p in folders]
+                if not paths:
+                    log.debug('[live] no recently opened folders')
+                    break
+
+                for path in set(queries) - set(paths):
+                    log.debug('[live] stopped watching %r', path)
+                    queries.pop(path).stop()
+
+                for path in paths:
+                    if path not in queries:
+                        try:
+                            cmd = searches.search_command(path)
+                        except (OSError, ValueError) as err:
+                            log.error('[live] %r: %s', path, err)
+                            continue
+                        log.debug('[live] watching %r', path)
+                        queries[path] = LiveQuery(wf, path, cmd)
+
+                if sorted(queries) != watched:
+                    watched = sorted(queries)
+                    wf.cache_data(LIVE_JOB, watched)
+
+            ready = select.select(queries.values(), [], [], LIVE_DELAY)[0]
+            for query in ready:
+                if not query.read():  # try again on next check
+                    del queries[query.path]
+
+            for query in queries.values():
+                query.update()
+
+    finally:
+        wf.cache_data(LIVE_JOB, None)
+        for query in queries.values():
+            query.stop()
+
+
+if __name__ == '__main__':
+    wf = Workflow3()
+    log = cache.log = wf.logger
+    wf.run(main)
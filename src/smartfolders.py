@@ -26,15 +26,22 @@ Options:
 from __future__ import print_function
 
 from collections import namedtuple
+import heapq
+from itertools import islice
 import os
+from time import time
 
 from docopt import docopt
 
 from workflow import (Workflow3, ICON_INFO, ICON_WARNING, ICON_ERROR,
                       ICON_SYNC)
-from workflow.background import is_running, run_in_background
+from workflow.background import run_in_background
 from workflow.util import run_trigger
-from cache import cache_key
+from cache import (CONTENTS_SERIALIZER, PREFETCH_AGE, cache_key,
+                   contents_state, folder_command, grams_key, index_key,
+                   partial_flag, query_timeout, record_usage)
+import live
+import store
 
 ICON_LOADING = 'loading.png'
 
@@ -44,6 +51,10 @@ HELPFILE = os.path.join(os.path.dirname(__file__), 'Help.html')
 DELIMITER = u'\U0001F782'
 CACHE_AGE_FOLDERS = 20  # seconds
 CACHE_AGE_CONTENTS = 10  # seconds
+SEARCH_BUDGET = 0.1  # seconds
+# Longest query (not counting spaces) searched with the search index
+# instead of SQLite when the SQLite cache is used
+SHORT_QUERY = 2
 
 # Placeholder, replaced on run
 log = None
@@ -64,6 +75,14 @@ class SmartFolders(object):
         self.wf = None
         self.query = None
         self.folders = []
+        self.store = None
+
+    @property
+    def job_timeout(self):
+        """Time after which background updates are assumed to hang."""
+        # mdfind is killed after `query_timeout()`, but saving its
+        # results can take a while, too
+        return 2 * query_timeout()
 
     def run(self, wf):
         """Run workflow."""
@@ -72,31 +91,34 @@ class SmartFolders(object):
         log.debug(u'args=%r', args)
         self.query = args['<query>'] or ''
         folder = args['--folder']
+        if store.enabled():
+            self.store = store.Store(wf)
 
         # show error encountered by background script
-        err = self.wf.cached_data('error', max_age=0)
+        if self.store:
+            err = self.store.error()
+        else:
+            err = self.wf.cached_data('error', max_age=0)
         if err and os.getenv('rerun'):
-            wf.add_item(u'Error Loading Smart Folder', str(err), icon=ICON_ERROR)
+            wf.add_item(u'Error Loading Smart Folder', unicode(err),
+                        icon=ICON_ERROR)
             wf.send_feedback()
             return
 
         # get list of Smart Folders; update in background if necessary
-        self.folders = [
-            Folder(*t) for t in self.wf.cached_data('folders', max_age=0) or []
-        ]
-
-        # update folder list if it's old
-        running = False
-        if not self.wf.cached_data_fresh('folders', CACHE_AGE_FOLDERS):
-            self.wf.rerun = 0.5
-            log.debug('updating list of Smart Folders in background...')
-            run_in_background('folders', [
-                '/usr/bin/python', self.wf.workflowfile('cache.py')
-            ])
-            running = True
-
-        if running or is_running('folders'):
-            self.wf.rerun = 0.5
+        cmd = ['/usr/bin/python', self.wf.workflowfile('cache.py')]
+        if self.store:
+            folders = self.store.folders()
+            loading = self.wf.refresh_in_background(
+                'folders', cmd, not self.store.fresh('folders',
+                                                     CACHE_AGE_FOLDERS),
+                timeout=self.job_timeout)
+        else:
+            folders, _, loading = self.wf.cached_data_swr(
+                'folders', cmd, CACHE_AGE_FOLDERS, timeout=self.job_timeout)
+        self.folders = [Folder(*t) for t in folders or []]
+
+        if loading:
             self.wf.setvar('rerun', 'true')
 
         # has a specific folder been specified?
@@ -125,7 +147,10 @@ class SmartFolders(object):
 
         elif query:  # filter folder list
             folders = self.wf.filter(query, self.folders, key=lambda t: t.name,
-                                     min_score=30)
+                                     min_score=30, max_results=MAX_RESULTS)
+            # user will probably open the best match
+            if 0 < len(folders) <= 2:
+                self._prefetch(folders[0].path)
         else:  # show all folders
             folders = self.folders
 
@@ -174,26 +199,45 @@ class SmartFolders(object):
             return self._show_error(u'Unknown Folder \u201C%s\u201D' % folder,
                                     'Check your configuration')
 
+        # folder was just opened (Alfred doesn't set `rerun`)
+        if not self.query and not os.getenv('rerun'):
+            record_usage(self.wf, path)
+
         # Get contents of folder; update if necessary
         key = cache_key(path)
-        files = self.wf.cached_data(key, max_age=0)
-        if files is None:
-            files = []
-
-        loading = False
-        if not self.wf.cached_data_fresh(key, CACHE_AGE_CONTENTS):
-            self.wf.rerun = 0.5
-            run_in_background(key, [
-                '/usr/bin/python', self.wf.workflowfile('cache.py'), '--folder', path
-            ])
-            loading = True
-
-        if loading or is_running(key):
-            self.wf.rerun = 0.5
+        mtime, changes, updated = contents_state(self.wf, path)
+        if self.store:
+            mtime = updated = self.store.updated(path)
+        fresh = updated and time() - updated < CACHE_AGE_CONTENTS
+        if live.enabled():
+            live.start(self.wf)
+            # daemon updates contents when they change
+            if updated and live.watching(self.wf, path):
+                fresh = True
+
+        loading = self.wf.refresh_in_background(
+            key, folder_command(self.wf, path), not fresh,
+            timeout=self.job_timeout)
+        if loading:
             self.wf.setvar('rerun', 'true')
-
-        if self.query:
-            files = self.wf.filter(self.query, files, key=os.path.basename, min_score=10)
+        # contents are being loaded for the first time, or loading them
+        # didn't finish
+        partial = os.path.exists(partial_flag(self.wf, path))
+
+        # Reruns with the same query get the same results until the
+        # contents are updated
+        memo = self.wf.cached_data(key + '-results', max_age=0, session=True)
+        version = (self.query, mtime, changes.size, MAX_RESULTS)
+        if mtime is not None and memo and memo['version'] == version:
+            log.debug('results unchanged')
+            files = memo['files']
+        else:
+            files = self._search_folder(path, key, mtime, changes)
+            if mtime is not None and not self.wf.filter_pending:
+                self.wf.cache_data(key + '-results', {
+                    'version': version,
+                    'files': files[:MAX_RESULTS],
+                }, session=True)
 
         if not files:  # no results
             if not self.query:
@@ -202,10 +246,22 @@ class SmartFolders(object):
                                       icon=ICON_LOADING)
                 else:
                     self._add_message('Empty Smart Folder', icon=ICON_WARNING)
+            elif self.wf.filter_pending:
+                self._add_message(u'Searching\U00002026', icon=ICON_LOADING)
             else:
                 self._add_message('No matching results', 'Try a different query',
                                   icon=ICON_WARNING)
         else:  # show results
+            if partial and loading:
+                self._add_message(u'Loading Folder Contents\U00002026',
+                                  'Showing the files found so far',
+                                  icon=ICON_LOADING)
+            elif partial:
+                self._add_message(u'Incomplete Folder Contents',
+                                  "Loading them didn't finish. Showing the "
+                                  'files found so far',
+                                  icon=ICON_WARNING)
+
             home = os.getenv('HOME')
             for i, path in enumerate(files):
                 title = os.path.basename(path)
@@ -225,6 +281,152 @@ class SmartFolders(object):
 
         self.wf.send_feedback()
 
+    def _prefetch(self, path):
+        """Update cached contents of folder at `path` if they're old."""
+        if self.store:
+            updated = self.store.updated(path)
+        else:
+            updated = contents_state(self.wf, path)[2]
+
+        if updated is None or time() - updated > PREFETCH_AGE:
+            log.debug(u'prefetching contents of "%s" ...', path)
+            run_in_background(cache_key(path), folder_command(self.wf, path))
+
+    def _search_folder(self, path, key, mtime, changes):
+        """Return contents of folder at `path` matching query.
+
+        `key` is the folder's cache key, `mtime` the modification
+        time of its cache and `changes` its `DeltaLog`.
+
+        """
+        if self.store:
+            return self._search_store(path, key)
+
+        files = self.wf.cached_data(key, max_age=0,
+                                    serializer=CONTENTS_SERIALIZER)
+        if files is None:
+            files = []
+
+        if not self.query.strip():
+            if changes:
+                files = (p for p in files if p not in changes.removed)
+                files = list(islice(heapq.merge(files, changes.added),
+                                    MAX_RESULTS))
+            return files
+
+        index = self._search_index(index_key(path), files, mtime)
+        grams = None
+        if index:
+            grams = self._search_index(grams_key(path), files, mtime)
+
+        # Removed files are dropped from the results, so get enough
+        # to be left with MAX_RESULTS
+        limit = MAX_RESULTS + len(changes.removed)
+        results = self.wf.filter(self.query, files, key=os.path.basename,
+                                 min_score=10, max_results=limit,
+                                 include_score=True, index=index, grams=grams,
+                                 session_key=key + '-search',
+                                 version=(mtime, changes.size),
+                                 budget=SEARCH_BUDGET)
+        if changes:
+            # filtering the changes resets `filter_pending`
+            pending = self.wf.filter_pending
+            results = [r for r in results if r[0] not in changes.removed]
+            results += self.wf.filter(self.query, changes.added,
+                                      key=os.path.basename, min_score=10,
+                                      max_results=MAX_RESULTS,
+                                      include_score=True)
+            self.wf.filter_pending = pending
+            # same order as `Workflow.filter()`: best score, then name
+            results.sort(key=lambda r: (-r[1],
+                                        os.path.basename(r[0]).strip().lower(),
+                                        r))
+
+        return [r[0] for r in results[:MAX_RESULTS]]
+
+    def _search_store(self, path, key):
+        """Return contents of folder at `path` in SQLite cache matching query.
+
+        SQLite finds the files that contain the query's characters,
+        and `Workflow.filter()` sorts them out. Short queries, which
+        nearly all files match, are searched with the folder's search
+        index instead, the same way as `_search_folder()` does.
+
+        """
+        if not self.query:
+            return self.store.contents(path, MAX_RESULTS)
+
+        query = self.wf.compile_query(self.query)
+        words = [w[0] for w in query.words]
+        indexed = None
+        if sum(len(w) for w in words) <= SHORT_QUERY:
+            indexed = self._stored_index(path, key)
+
+        if indexed is None:
+            files = self.store.search(path, words)
+            return self.wf.filter(query, files, key=os.path.basename,
+                                  min_score=10, max_results=MAX_RESULTS)
+
+        files, index, grams, version = indexed
+        return self.wf.filter(query, files, key=os.path.basename,
+                              min_score=10, max_results=MAX_RESULTS,
+                              index=index, grams=grams,
+                              session_key=key + '-search',
+                              version=version, budget=SEARCH_BUDGET)
+
+    def _stored_index(self, path, key):
+        """Return `(files, index, grams, version)` for folder at `path`.
+
+        `files` are the contents of the folder in the SQLite cache as
+        cached (with key `key`) along with their search indices, and
+        `version` is the version of that cache. Returns `None` if it
+        doesn't match the SQLite cache or has no indices.
+
+        """
+        version = self.store.indexed(path)
+        info = self.wf.cached_data_info(key, CONTENTS_SERIALIZER)
+        if version is None or not info or info['version'] != version:
+            log.debug('no cached contents with search index')
+            return None
+
+        files = self.wf.cached_data(key, max_age=0,
+                                    serializer=CONTENTS_SERIALIZER)
+        if files is None:
+            return None
+
+        index = self._search_index(index_key(path), files, info['mtime'])
+        if index is None:
+            return None
+
+        grams = self._search_index(grams_key(path), files, info['mtime'])
+        return files, index, grams, version
+
+    def _search_index(self, name, files, mtime):
+        """Return cached search index `name` for folder contents `files`.
+
+        Returns `None` if there is no index or it doesn't belong to
+        `files`, whose cache was modified at `mtime`. Indices are
+        written before the contents, so if one is newer than `mtime`,
+        it's from a later update than `files`.
+
+        """
+        imtime = self._cache_mtime(name)
+        if mtime is None or imtime is None or imtime > mtime:
+            log.debug('no search index %r', name)
+            return None
+
+        index = self.wf.cached_data(name, max_age=0)
+        if index is None or index['count'] != len(files):
+            log.debug('search index %r is out of date', name)
+            return None
+
+        return index
+
+    def _cache_mtime(self, name, serializer=None):
+        """Return modification time of cache `name` or `None`."""
+        info = self.wf.cached_data_info(name, serializer)
+        return info['mtime'] if info else None
+
     def _add_message(self, title, subtitle=u'', icon=ICON_INFO):
         """Add a message to the results returned to Alfred."""
         self.wf.add_item(title, subtitle, icon=icon)
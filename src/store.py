@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""SQLite cache of Smart Folders and their contents.
+
+An alternative to caching the folder list and the contents of each
+folder in separate files. Everything is kept in one database in the
+workflow's cache directory, so script filters always read a consistent
+version of the data, and searches run in SQLite.
+
+Nearly every file contains the characters of a query of only one or two
+characters, so SQLite can't narrow those searches down. For them, cache.py
+also saves each folder's contents and their search indices to the same
+cache files as without SQLite, which load much faster than they would
+from the database. The database records which version of those files
+(per the cache manifest) matches its contents.
+
+Turn it on by setting the workflow variable `use_sqlite` to `1`.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import time
+
+DB_NAME = 'cache.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS status (
+    key TEXT PRIMARY KEY,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS folders (
+    name TEXT,
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS files (
+    folder TEXT,
+    pos INTEGER,
+    path TEXT,
+    name TEXT,
+    folded TEXT,
+    PRIMARY KEY (folder, pos)
+);
+CREATE TABLE IF NOT EXISTS indexed (
+    folder TEXT PRIMARY KEY,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS error (
+    message TEXT
+);
+"""
+
+
+def enabled():
+    """Return `True` if the SQLite cache is turned on."""
+    return os.getenv('use_sqlite', '').lower() in ('1', 'true', 'yes')
+
+
+def like_pattern(word):
+    """Return `LIKE` pattern matching strings containing chars of `word`.
+
+    The characters must occur in the same order as in `word`, which
+    all of `Workflow.filter()`'s rules require.
+
+    """
+    chars = []
+    for c in word:
+        if c in '\\%_':
+            c = '\\' + c
+        chars.append(c)
+
+    return u'%{}%'.format(u'%'.join(chars))
+
+
+class Store(object):
+    """Cache of Smart Folders and their contents in a SQLite database.
+
+    The list of folders is stored under the key `folders`, the contents
+    of each folder under the folder's path.
+
+    """
+
+    def __init__(self, wf):
+        """Open (and if necessary, create) database in `wf`'s cache."""
+        self.wf = wf
+        self.db = sqlite3.connect(wf.cachefile(DB_NAME), timeout=10)
+        # readers don't block the writer and vice versa
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def updated(self, key):
+        """Return time `key` was last updated or `None`."""
+        row = self.db.execute('SELECT updated FROM status WHERE key = ?',
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def fresh(self, key, max_age):
+        """Return `True` if `key` was updated less than `max_age` ago."""
+        updated = self.updated(key)
+        return updated is not None and time.time() - updated < max_age
+
+    def folders(self):
+        """Return list of `(name, path)` tuples of Smart Folders."""
+        return self.db.execute(
+            'SELECT name, path FROM folders ORDER BY name, path').fetchall()
+
+    def set_folders(self, folders):
+        """Replace list of Smart Folders with `(name, path)` tuples."""
+        with self.db:
+            self.db.execute('DELETE FROM folders')
+            self.db.executemany('INSERT INTO folders VALUES (?, ?)', folders)
+            # forget the contents of deleted folders
+            self.db.execute('DELETE FROM files WHERE folder NOT IN '
+                            '(SELECT path FROM folders)')
+            self.db.execute('DELETE FROM indexed WHERE folder NOT IN '
+                            '(SELECT path FROM folders)')
+            self.db.execute("DELETE FROM status WHERE key != 'folders' AND "
+                            "key NOT IN (SELECT path FROM folders)")
+            self._touch('folders')
+
+    def contents(self, folder, limit=-1):
+        """Return paths of (the first `limit`) files in `folder`."""
+        return [row[0] for row in self.db.execute(
+            'SELECT path FROM files WHERE folder = ? ORDER BY pos LIMIT ?',
+            (folder, limit))]
+
+    def set_contents(self, folder, files, version=None):
+        """Replace contents of `folder` with paths `files`.
+
+        `version` is the version of the cache file `files` were also
+        saved to along with their search indices, if they were.
+
+        """
+        def rows():
+            for i, path in enumerate(files):
+                name = os.path.basename(path).strip()
+                # the same keys `Workflow.filter()` compares queries to
+                folded = self.wf.fold_to_ascii(name).lower()
+                yield (folder, i, path, name.lower(), folded)
+
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE folder = ?', (folder,))
+            self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                                rows())
+            self.db.execute('DELETE FROM indexed WHERE folder = ?',
+                            (folder,))
+            if version is not None:
+                self.db.execute('INSERT INTO indexed VALUES (?, ?)',
+                                (folder, version))
+            self._touch(folder)
+
+    def indexed(self, folder):
+        """Return version of indexed cache file of `folder`'s contents.
+
+        Returns `None` if the contents weren't saved to a cache file
+        with their search indices.
+
+        """
+        row = self.db.execute('SELECT version FROM indexed WHERE folder = ?',
+                              (folder,)).fetchone()
+        return row[0] if row else None
+
+    def search(self, folder, words):
+        """Return paths in `folder` that can match all of `words`.
+
+        Only finds the candidates; the results still have to be
+        filtered and sorted with `Workflow.filter()`. `words` should
+        be lowercase.
+
+        """
+        sql = 'SELECT path FROM files WHERE folder = ?'
+        args = [folder]
+        for word in words:
+            sql += (" AND (name LIKE ? ESCAPE '\\'"
+                    " OR folded LIKE ? ESCAPE '\\')")
+            args.extend([like_pattern(word)] * 2)
+
+        sql += ' ORDER BY pos'
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def error(self):
+        """Return message of last error in background update or `None`."""
+        row = self.db.execute('SELECT message FROM error').fetchone()
+        return row[0] if row else None
+
+    def set_error(self, err):
+        """Save (or with `None`, clear) background update error."""
+        with self.db:
+            self.db.execute('DELETE FROM error')
+            if err is not None:
+                self.db.execute('INSERT INTO error VALUES (?)',
+                                (unicode(err),))
+
+    def touch(self, key):
+        """Mark `key` as updated without changing it."""
+        with self.db:
+            self._touch(key)
+
+    def _touch(self, key):
+        """Set update time of `key` to now."""
+        self.db.execute('INSERT OR REPLACE INTO status VALUES (?, ?)',
+                        (key, time.time()))
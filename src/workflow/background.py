@@ -24,10 +24,11 @@ import sys
 import os
 import subprocess
 import pickle
+import time
 
 from workflow import Workflow
 
-__all__ = ['is_running', 'run_in_background']
+__all__ = ['is_running', 'job_age', 'kill', 'run_in_background']
 
 _wf = None
 
@@ -173,14 +174,37 @@ def _background(pidfile, stdin='/dev/null', stdout='/dev/null',
         os.dup2(se.fileno(), sys.stderr.fileno())
 
 
-def kill(name, sig=signal.SIGTERM):
+def job_age(name):
+    """Return how long job ``name`` has been running.
+
+    Args:
+        name (str): Name of the job
+
+    Returns:
+        float: Seconds since the job started or `None` if it isn't running.
+    """
+    if not is_running(name):
+        return None
+
+    try:
+        return time.time() - os.path.getmtime(_pid_file(name))
+    except OSError:  # job just finished
+        return None
+
+
+def kill(name, sig=signal.SIGTERM, group=False):
     """Send a signal to job ``name`` via :func:`os.kill`.
 
     .. versionadded:: 1.29
 
+    Each job runs in its own process group, so with ``group=True``,
+    the processes it has started (e.g. the command passed to
+    :func:`run_in_background`) are sent the signal, too.
+
     Args:
         name (str): Name of the job
         sig (int, optional): Signal to send (default: SIGTERM)
+        group (bool, optional): Send signal to job's process group
 
     Returns:
         bool: `False` if job isn't running, `True` if signal was sent.
@@ -189,7 +213,10 @@ def kill(name, sig=signal.SIGTERM):
     if pid is None:
         return False
 
-    os.kill(pid, sig)
+    if group and os.getpgid(pid) != os.getpgrp():
+        os.killpg(os.getpgid(pid), sig)
+    else:
+        os.kill(pid, sig)
     return True
 
 
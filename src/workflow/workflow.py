@@ -21,22 +21,34 @@ up your Python script to best utilise the :class:`Workflow` object.
 
 from __future__ import print_function, unicode_literals
 
+from array import array
 import binascii
 import cPickle
+import cStringIO
 from copy import deepcopy
+import errno
+import fcntl
+import functools
+import heapq
+from itertools import izip
 import json
 import logging
 import logging.handlers
+import mmap
+import multiprocessing
 import os
 import pickle
 import plistlib
 import re
 import shutil
 import string
+import struct
 import subprocess
 import sys
 import time
+import traceback
 import unicodedata
+import zlib
 
 try:
     import xml.etree.cElementTree as ET
@@ -415,6 +427,18 @@ INITIALS = string.ascii_uppercase + string.digits
 #: Split on non-letters, numbers
 split_on_delimiters = re.compile('[^a-zA-Z0-9]').split
 
+#: Search keys precomputed by :meth:`Workflow.search_index`, in the
+#: order :meth:`Workflow.filter` uses them
+SEARCH_KEYS = ('value', 'lower', 'capitals', 'atoms', 'initials')
+
+#: Number of items per block of a search index. The offset of each
+#: block is stored, so its keys can be read without reading the others.
+INDEX_BLOCK_SIZE = 1024
+
+#: Name of the file in the cache directory that lists the data cached
+#: with :meth:`Workflow.cache_data`
+CACHE_MANIFEST = '_wfcache.json'
+
 # Match filter flags
 #: Match items that start with ``query``
 MATCH_STARTSWITH = 1
@@ -436,6 +460,22 @@ MATCH_ALLCHARS = 64
 #: Combination of all other ``MATCH_*`` constants
 MATCH_ALL = 127
 
+#: Rules that :meth:`Workflow.filter` can evaluate in bulk, in the order
+#: they're tested: ``(rule, search key, base score, key for score,
+#: match at start of key only)``
+BATCH_RULES = (
+    (MATCH_STARTSWITH, 1, 100.0, 0, True),
+    (MATCH_CAPITALS, 2, 100.0, 2, True),
+    (MATCH_ATOM, 3, 100.0, 0, False),
+    (MATCH_INITIALS_STARTSWITH, 4, 100.0, 4, True),
+    (MATCH_INITIALS_CONTAIN, 4, 95.0, 4, False),
+    (MATCH_SUBSTRING, 1, 90.0, 0, False),
+)
+
+#: Translation table that lowercases ASCII letters only. This is how
+#: :const:`MATCH_ALLCHARS` compares characters.
+ASCII_LOWERCASE = dict((i, i + 32) for i in range(ord('A'), ord('Z') + 1))
+
 
 ####################################################################
 # Used by `Workflow.check_update`
@@ -483,6 +523,311 @@ class PasswordExists(KeychainError):
 # Helper functions
 ####################################################################
 
+def _find_items(blob, sub, start=False):
+    """Yield indices of the NUL-separated items in ``blob`` containing ``sub``.
+
+    If ``start`` is ``True``, only items that start with ``sub`` match.
+    Each item is only yielded once.
+
+    """
+    i = pos = 0  # ``pos`` is the offset of item ``i``
+    shift = 0
+    if start:
+        if blob.startswith(sub):
+            yield 0
+        # match the separator before the item
+        sub = '\x00' + sub
+        shift = 1
+
+    while True:
+        found = blob.find(sub, pos - shift if pos else 0)
+        if found < 0:
+            return
+
+        found += shift
+        i += blob.count('\x00', pos, found)
+        yield i
+
+        # skip to next item
+        pos = blob.find('\x00', found)
+        if pos < 0:
+            return
+        pos += 1
+        i += 1
+
+
+def _best_results(results, ascending, min_score, max_results):
+    """Sort ``(sort_key, (item, score, rule))`` results, best first.
+
+    Only results with a score above ``min_score`` are kept, and only
+    the first ``max_results`` of them (if set).
+
+    """
+    if min_score:
+        results = [r for r in results if r[1][1] > min_score]
+
+    if max_results and len(results) > max_results:
+        # only select the best results instead of sorting all of them
+        if ascending:
+            return heapq.nlargest(max_results, results)
+        return heapq.nsmallest(max_results, results)
+
+    results.sort(reverse=ascending)
+    return results
+
+
+def _best_indices(results, items, ascending, min_score, max_results):
+    """Like :func:`_best_results`, but for results with indices of items.
+
+    ``results`` are ``(sort_key, (i, score, rule))`` tuples, where ``i``
+    is the index of the item in ``items``. They are ranked by the items,
+    like :func:`_best_results` does.
+
+    """
+    results = _best_results([(sort_key, (items[i], score, rule), i)
+                             for sort_key, (i, score, rule) in results],
+                            ascending, min_score, max_results)
+
+    return [(sort_key, (i, score, rule))
+            for sort_key, (_, score, rule), i in results]
+
+
+def _index_block(index, block):
+    """Return the search keys of the items in ``block`` of ``index``.
+
+    :param index: search index generated by :meth:`Workflow.search_index`
+    :type index: ``dict``
+    :param block: number of the block, i.e. the index of its first
+        item divided by :const:`INDEX_BLOCK_SIZE`
+    :type block: ``int``
+    :returns: a list of keys for each of :const:`SEARCH_KEYS`, like
+        the ``columns`` of :meth:`Workflow._score_matches`
+    :rtype: ``list``
+
+    """
+    columns = []
+    for k in SEARCH_KEYS:
+        blob = index[k]
+        offsets = index['blocks'][k]
+        end = len(blob)
+        if block + 1 < len(offsets):
+            end = offsets[block + 1] - 1  # before the NUL
+
+        columns.append(blob[offsets[block]:end].split('\x00'))
+
+    return columns
+
+
+def _block_index(index, block, columns):
+    """Return a search index of only the items in ``block`` of ``index``.
+
+    The items are numbered from ``0``, so the index can be passed to
+    :meth:`Workflow._batch_score` to score one block at a time.
+
+    :param index: search index generated by :meth:`Workflow.search_index`
+    :type index: ``dict``
+    :param block: number of the block, as for :func:`_index_block`
+    :type block: ``int``
+    :param columns: search keys of the block, as returned by
+        :func:`_index_block`
+    :type columns: ``list``
+    :returns: search index of the block
+    :rtype: ``dict``
+
+    """
+    offset = block * INDEX_BLOCK_SIZE
+    count = len(columns[0])
+    sub = {'count': count}
+    for k in SEARCH_KEYS:
+        blob = index[k]
+        offsets = index['blocks'][k]
+        end = len(blob)
+        if block + 1 < len(offsets):
+            end = offsets[block + 1] - 1  # before the NUL
+
+        sub[k] = blob[offsets[block]:end]
+
+    folded = index['folded']
+    sub['folded'] = dict((i - offset, folded[i])
+                         for i in xrange(offset, offset + count)
+                         if i in folded)
+    if sub['folded']:
+        for n, k in enumerate(SEARCH_KEYS):
+            column = list(columns[n])
+            for i, keys in sub['folded'].iteritems():
+                column[i] = keys[n]
+            sub['folded_' + k] = '\x00'.join(column)
+
+    return sub
+
+
+def _fork_map(func, args):
+    """Call ``func`` on each of ``args`` in parallel in forked processes.
+
+    Like :meth:`multiprocessing.Pool.map`, but ``func`` and ``args``
+    aren't pickled (the child processes share this one's memory), and
+    there's no pool to shut down, which takes ~100 ms.
+
+    :param func: callable to call in each child process. Its return
+        value must be picklable.
+    :type func: ``callable``
+    :param args: argument to call ``func`` with in each process
+    :type args: ``list``
+    :returns: return values of ``func``
+    :rtype: ``list``
+
+    """
+    children = []
+    for arg in args:
+        fd_in, fd_out = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # child
+            try:
+                os.close(fd_in)
+                try:
+                    data = (True, func(arg))
+                except Exception:
+                    data = (False, traceback.format_exc())
+
+                with os.fdopen(fd_out, 'wb') as fp:
+                    cPickle.dump(data, fp, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                os._exit(0)
+
+        os.close(fd_out)
+        children.append((pid, fd_in))
+
+    results = []
+    errors = []
+    for pid, fd_in in children:
+        with os.fdopen(fd_in, 'rb') as fp:
+            data = fp.read()
+        os.waitpid(pid, 0)
+
+        if not data:
+            errors.append('process {0} exited without a result'.format(pid))
+            continue
+
+        ok, value = cPickle.loads(data)
+        if ok:
+            results.append(value)
+        else:
+            errors.append(value)
+
+    if errors:
+        raise RuntimeError('child process failed: ' + errors[0])
+
+    return results
+
+
+def _find_allchars(blob, query):
+    """Yield items in ``blob`` containing all characters of ``query``.
+
+    Like :func:`search_allchars`, but for all the NUL-separated items in
+    ``blob`` at once. Characters are compared as-is, so ``blob`` and
+    ``query`` should already be lowercase.
+
+    Yields ``(i, start, end)`` tuples, where ``i`` is the index of the
+    item and ``start`` and ``end`` are the offsets of the match in it.
+
+    """
+    head, tail = query[0], query[1:]
+    size = len(blob)
+    i = pos = 0  # ``pos`` is the offset of item ``i``
+    nul = -1  # end of item ``i``
+    start = 0  # where to look for ``head``
+    while True:
+        found = blob.find(head, start)
+        if found < 0:
+            return
+
+        if found > nul:
+            i += blob.count('\x00', pos, found)
+            pos = blob.rfind('\x00', pos, found) + 1 or pos
+            nul = blob.find('\x00', found)
+            if nul < 0:
+                nul = size
+
+        # Matches can't span lines (or items)
+        eol = blob.find('\n', found, nul)
+        if eol < 0:
+            eol = nul
+
+        end = found + 1
+        for c in tail:
+            end = blob.find(c, end, eol)
+            if end < 0:
+                break
+            end += 1
+
+        else:
+            line = blob.rfind('\n', pos, found) + 1 or pos
+            yield i, line - pos, end - pos
+            # skip to next item
+            start = nul + 1
+            continue
+
+        # try next line
+        start = eol + 1
+
+
+def search_allchars(query, text):
+    """Find all characters of ``query`` in ``text`` in order.
+
+    Equivalent to searching ``text`` with the regular expression
+    ``.*?q.*?u.*?e.*?r.*?y`` (ignoring case), but takes linear time
+    regardless of ``query``. As with the regex, the characters must all
+    be on one line, and only ASCII letters are case-insensitive.
+
+    :param query: characters to search for. Must not contain newlines.
+    :type query: ``unicode``
+    :param text: text to search
+    :type text: ``unicode``
+    :returns: :class:`AllCharsMatch` or ``None`` if ``text`` doesn't
+        contain all characters of ``query``
+    :rtype: :class:`AllCharsMatch`
+
+    """
+    return _search_allchars(_ascii_lower(query), text)
+
+
+def _search_allchars(query, text):
+    """Implementation of :func:`search_allchars` for lowercase ``query``."""
+    text = _ascii_lower(text)
+    size = len(text)
+    line = 0
+    while True:
+        eol = text.find('\n', line)
+        if eol < 0:
+            eol = size
+
+        # Earliest possible end of a match on this line
+        end = line
+        for c in query:
+            end = text.find(c, end, eol)
+            if end < 0:
+                break
+            end += 1
+
+        else:
+            return AllCharsMatch(query, text, line, end)
+
+        if eol == size:
+            return None
+
+        line = eol + 1
+
+
+def _ascii_lower(text):
+    """Lowercase ASCII letters in ``text``."""
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        if isinstance(text, unicode):
+            return text.translate(ASCII_LOWERCASE)
+    return text.lower()
+
+
 def isascii(text):
     """Test if ``text`` contains only ASCII characters.
 
@@ -581,6 +926,36 @@ class SerializerManager(object):
         """Return names of registered serializers."""
         return sorted(self._serializers.keys())
 
+    def compress(self, name, threshold=1024 * 1024, level=1):
+        """Compress data saved with serializer ``name`` if it's large.
+
+        Replaces the serializer registered under ``name`` with a
+        :class:`ZlibSerializer` that wraps it. Files it saved before
+        can still be loaded.
+
+        :param name: Name of serializer to wrap
+        :type name: ``unicode`` or ``str``
+        :param threshold: Compress data larger than this many bytes.
+            If ``None``, data are never compressed, but compressed
+            files can still be loaded.
+        :type threshold: ``int``
+        :param level: :mod:`zlib` compression level (1-9)
+        :type level: ``int``
+        :returns: the wrapped serializer object
+
+        """
+        serializer = self.serializer(name)
+        if serializer is None:
+            raise ValueError('No such serializer registered : {0}'.format(
+                             name))
+
+        if isinstance(serializer, ZlibSerializer):
+            serializer = serializer.serializer
+
+        self._serializers[name] = ZlibSerializer(serializer, threshold,
+                                                 level)
+        return serializer
+
 
 class JSONSerializer(object):
     """Wrapper around :mod:`json`. Sets ``indent`` and ``encoding``.
@@ -699,11 +1074,461 @@ class PickleSerializer(object):
         return pickle.dump(obj, file_obj, protocol=-1)
 
 
+class StringTable(object):
+    """Read-only list of the strings in a :class:`StringTableSerializer` file.
+
+    The file is memory-mapped, and each string is only read and decoded
+    when it's accessed. Slices are :class:`StringTable` objects, too, so
+    slicing doesn't copy anything.
+
+    :class:`StringTable` objects are pickled as regular lists.
+
+    """
+
+    def __init__(self, buf, start=0, stop=None):
+        """Create new :class:`StringTable`.
+
+        :param buf: contents of the file
+        :type buf: :class:`mmap.mmap` or ``str``
+        :param start: index of first string in table
+        :type start: ``int``
+        :param stop: index after last string in table (default: all)
+        :type stop: ``int``
+
+        """
+        if buf[:4] != StringTableSerializer.magic:
+            raise ValueError('not a string table')
+
+        count = struct.unpack_from(b'<I', buf, 4)[0]
+        self._buf = buf
+        # offset of the strings, whose offsets are relative to it
+        self._base = 8 + 4 * (count + 1)
+        self._start = start
+        self._stop = count if stop is None else stop
+
+    def __len__(self):
+        """Return number of strings."""
+        return self._stop - self._start
+
+    def __getitem__(self, i):
+        """Return string ``i`` or a slice of the table."""
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in xrange(start, stop, step)]
+            stop = max(start, stop)
+            return StringTable(self._buf, self._start + start,
+                               self._start + stop)
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string table index out of range')
+
+        start, end = struct.unpack_from(b'<2I', self._buf,
+                                        8 + 4 * (self._start + i))
+        return self._buf[self._base + start:self._base + end].decode('utf-8')
+
+    def __iter__(self):
+        """Iterate over strings."""
+        # read all offsets at once
+        offsets = array(b'I')
+        offsets.fromstring(self._buf[8 + 4 * self._start:
+                                     8 + 4 * (self._stop + 1)])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        buf, base = self._buf, self._base
+        for i in xrange(len(offsets) - 1):
+            yield buf[base + offsets[i]:base + offsets[i + 1]].decode('utf-8')
+
+    def __reduce__(self):
+        """Pickle as a list."""
+        return (list, (list(self),))
+
+    def __repr__(self):
+        """Format table as string."""
+        return '<StringTable of {0} string(s)>'.format(len(self))
+
+
+class StringTableSerializer(object):
+    """Compact, memory-mapped format for lists of strings.
+
+    Saves a list of ``unicode`` strings as a table of offsets followed
+    by the UTF-8-encoded strings. :meth:`load` maps the file into memory
+    and returns a :class:`StringTable`, so it takes the same (very
+    short) time however long the list is. Use this serializer for long
+    lists of which only a few items are used at a time.
+
+    """
+
+    #: Identifies string table files
+    magic = b'STB1'
+
+    @classmethod
+    def load(cls, file_obj):
+        """Open string table file.
+
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+        :returns: strings in file
+        :rtype: :class:`StringTable`
+
+        """
+        buf = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        return StringTable(buf)
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        """Save list of strings ``obj`` to open file.
+
+        :param obj: strings to save
+        :type obj: ``list`` of ``unicode``
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+
+        """
+        data = [text.encode('utf-8') for text in obj]
+        offsets = array(b'I', [0])
+        offset = 0
+        for b in data:
+            offset += len(b)
+            offsets.append(offset)
+
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        file_obj.write(cls.magic + struct.pack(b'<I', len(data)))
+        file_obj.write(offsets.tostring())
+        file_obj.write(b''.join(data))
+
+
+def _common_prefix(a, b):
+    """Return length of longest common prefix of strings ``a`` and ``b``."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+class FrontCodedTable(object):
+    """Read-only list of the strings in a :class:`FrontCodedSerializer` file.
+
+    Works like :class:`StringTable`: the file is memory-mapped, and
+    strings are only decoded when they're accessed. As each string is
+    stored relative to the one before it, strings are decoded a block
+    at a time. The most recently used block is kept, so sequential
+    access is cheap.
+
+    """
+
+    def __init__(self, buf, start=0, stop=None):
+        """Create new :class:`FrontCodedTable`.
+
+        :param buf: contents of the file
+        :type buf: :class:`mmap.mmap` or ``str``
+        :param start: index of first string in table
+        :type start: ``int``
+        :param stop: index after last string in table (default: all)
+        :type stop: ``int``
+
+        """
+        if buf[:4] != FrontCodedSerializer.magic:
+            raise ValueError('not a front-coded string table')
+
+        count, block_size = struct.unpack_from(b'<2I', buf, 4)
+        nblocks = (count + block_size - 1) // block_size
+        # start of each block, relative to end of header
+        self._blocks = array(b'I')
+        self._blocks.fromstring(buf[12:12 + 4 * (nblocks + 1)])
+        if sys.byteorder != 'little':
+            self._blocks.byteswap()
+
+        self._buf = buf
+        self._base = 12 + 4 * (nblocks + 1)
+        self._count = count
+        self._block_size = block_size
+        self._start = start
+        self._stop = count if stop is None else stop
+        self._cached = (None, None)
+
+    def _block(self, b):
+        """Return strings in block ``b``."""
+        if self._cached[0] == b:
+            return self._cached[1]
+
+        buf = self._buf
+        pos = self._base + self._blocks[b]
+        end = self._base + self._blocks[b + 1]
+        n = min(self._block_size, self._count - b * self._block_size)
+
+        # shared prefix lengths, then suffix lengths, then suffixes
+        lengths = array(buf[pos])
+        pos += 1
+        lengths.fromstring(buf[pos:pos + 2 * n * lengths.itemsize])
+        if sys.byteorder != 'little':
+            lengths.byteswap()
+
+        data = buf[pos + 2 * n * lengths.itemsize:end]
+        strings = []
+        prev = b''
+        i = 0
+        for shared, size in izip(lengths[:n], lengths[n:]):
+            prev = prev[:shared] + data[i:i + size]
+            i += size
+            strings.append(prev.decode('utf-8'))
+
+        self._cached = (b, strings)
+        return strings
+
+    def __len__(self):
+        """Return number of strings."""
+        return self._stop - self._start
+
+    def __getitem__(self, i):
+        """Return string ``i`` or a slice of the table."""
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in xrange(start, stop, step)]
+            table = object.__new__(FrontCodedTable)
+            table.__dict__.update(self.__dict__)
+            table._start = self._start + start
+            table._stop = self._start + max(start, stop)
+            return table
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string table index out of range')
+
+        b, j = divmod(self._start + i, self._block_size)
+        return self._block(b)[j]
+
+    def __iter__(self):
+        """Iterate over strings."""
+        if self._start >= self._stop:
+            return
+
+        first, j = divmod(self._start, self._block_size)
+        last, k = divmod(self._stop - 1, self._block_size)
+        for b in xrange(first, last + 1):
+            strings = self._block(b)
+            if b == first or b == last:
+                strings = strings[j if b == first else 0:
+                                  k + 1 if b == last else None]
+            for text in strings:
+                yield text
+
+    def __reduce__(self):
+        """Pickle as a list."""
+        return (list, (list(self),))
+
+    def __repr__(self):
+        """Format table as string."""
+        return '<FrontCodedTable of {0} string(s)>'.format(len(self))
+
+
+class FrontCodedSerializer(object):
+    """Memory-mapped format for lists of strings with common prefixes.
+
+    Like :class:`StringTableSerializer`, but each string is saved as
+    the length of the prefix it shares with the previous string plus
+    the rest of the string. Every :attr:`block_size` strings, a string
+    is saved in full, so any string can be decoded without reading the
+    ones before it.
+
+    Lists of paths take up much less space this way, especially if
+    they're sorted. :meth:`load` returns a :class:`FrontCodedTable`.
+
+    """
+
+    #: Identifies front-coded files
+    magic = b'FCS1'
+
+    #: Number of strings between full (not front-coded) strings
+    block_size = 16
+
+    @classmethod
+    def load(cls, file_obj):
+        """Open front-coded file.
+
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+        :returns: strings in file
+        :rtype: :class:`FrontCodedTable`
+
+        """
+        buf = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        return FrontCodedTable(buf)
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        """Save list of strings ``obj`` to open file.
+
+        :param obj: strings to save
+        :type obj: ``list`` of ``unicode``
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+
+        """
+        data = [text.encode('utf-8') for text in obj]
+        blocks = []
+        offsets = array(b'I', [0])
+        offset = 0
+        for i in xrange(0, len(data), cls.block_size):
+            chunk = data[i:i + cls.block_size]
+            shared = [0] + [_common_prefix(a, b)
+                            for a, b in izip(chunk, chunk[1:])]
+            suffixes = [b[n:] for b, n in izip(chunk, shared)]
+            sizes = [len(b) for b in suffixes]
+
+            typecode = b'H' if max(sizes) <= 0xFFFF else b'I'
+            lengths = array(typecode, shared + sizes)
+            if sys.byteorder != 'little':
+                lengths.byteswap()
+
+            block = typecode + lengths.tostring() + b''.join(suffixes)
+            blocks.append(block)
+            offset += len(block)
+            offsets.append(offset)
+
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        file_obj.write(cls.magic + struct.pack(b'<2I', len(data),
+                                               cls.block_size))
+        file_obj.write(offsets.tostring())
+        file_obj.write(b''.join(blocks))
+
+
+class _ZlibWriter(object):
+    """File-like object that compresses data written to it.
+
+    Data are passed through uncompressed until more than ``threshold``
+    bytes have been written (``None`` = never compress).
+
+    """
+
+    def __init__(self, file_obj, threshold, level):
+        """Create new :class:`_ZlibWriter` that writes to ``file_obj``."""
+        self.file_obj = file_obj
+        self.threshold = threshold
+        self.level = level
+        self._compressor = None
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        """Write (and possibly compress) ``data``."""
+        if self._compressor is not None:
+            self.file_obj.write(self._compressor.compress(data))
+            return
+
+        self._buffer.append(data)
+        self._size += len(data)
+        if self.threshold is not None and self._size > self.threshold:
+            self._compressor = zlib.compressobj(self.level)
+            self.file_obj.write(ZlibSerializer.magic)
+            self.write(b''.join(self._buffer))
+            self._buffer = None
+
+    def close(self):
+        """Write remaining data."""
+        if self._compressor is not None:
+            self.file_obj.write(self._compressor.flush())
+        else:
+            self.file_obj.write(b''.join(self._buffer))
+
+
+class ZlibSerializer(object):
+    """Wrapper that compresses the output of another serializer.
+
+    Output larger than ``threshold`` bytes is compressed with
+    :mod:`zlib` while it's written, and marked with a header, so
+    :meth:`load` can tell compressed and uncompressed files apart.
+
+    Reading a large file can take longer than decompressing it,
+    especially from an encrypted or slow disk. Register one with
+    :meth:`SerializerManager.compress`.
+
+    .. note::
+
+        Serializers that memory-map files, such as
+        :class:`StringTableSerializer`, can't be wrapped.
+
+    """
+
+    #: Marks compressed files. Neither JSON nor pickle data start with it.
+    magic = b'\x00WFZ'
+
+    def __init__(self, serializer, threshold=1024 * 1024, level=1):
+        """Create new :class:`ZlibSerializer`.
+
+        :param serializer: serializer to wrap
+        :param threshold: Compress data larger than this many bytes
+            (``None`` = never)
+        :type threshold: ``int``
+        :param level: :mod:`zlib` compression level (1-9)
+        :type level: ``int``
+
+        """
+        self.serializer = serializer
+        self.threshold = threshold
+        self.level = level
+
+    def load(self, file_obj):
+        """Load (and decompress) data from open file.
+
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+        :returns: data loaded by the wrapped serializer
+
+        """
+        if file_obj.read(len(self.magic)) != self.magic:
+            file_obj.seek(0)
+            return self.serializer.load(file_obj)
+
+        decompressor = zlib.decompressobj()
+        chunks = []
+        while True:
+            data = file_obj.read(1024 * 1024)
+            if not data:
+                break
+            chunks.append(decompressor.decompress(data))
+
+        chunks.append(decompressor.flush())
+        return self.serializer.load(cStringIO.StringIO(b''.join(chunks)))
+
+    def dump(self, obj, file_obj):
+        """Serialize ``obj`` to open file, compressing it if it's large.
+
+        :param obj: object to serialize
+        :type obj: JSON-serializable data structure
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+
+        """
+        if self.threshold is None:
+            return self.serializer.dump(obj, file_obj)
+
+        writer = _ZlibWriter(file_obj, self.threshold, self.level)
+        self.serializer.dump(obj, writer)
+        writer.close()
+
+
 # Set up default manager and register built-in serializers
 manager = SerializerManager()
 manager.register('cpickle', CPickleSerializer)
 manager.register('pickle', PickleSerializer)
 manager.register('json', JSONSerializer)
+manager.register('strtab', StringTableSerializer)
+manager.register('frontcoded', FrontCodedSerializer)
 
 
 class Item(object):
@@ -799,6 +1624,135 @@ class Item(object):
         return root
 
 
+class AllCharsMatch(object):
+    """Match of all characters of a query in a string.
+
+    Returned by :func:`search_allchars`. Like a regex match object,
+    it has :meth:`start` and :meth:`end` methods, which return the
+    same values as for a ``.*?q.*?u.*?e.*?r.*?y`` regex.
+
+    """
+
+    __slots__ = ('query', 'text', '_start', '_end', '_positions')
+
+    def __init__(self, query, text, start, end):
+        """Create new :class:`AllCharsMatch`.
+
+        :param query: lowercase query
+        :type query: ``unicode``
+        :param text: lowercase text the query was found in
+        :type text: ``unicode``
+        :param start: offset of the start of the line containing match
+        :type start: ``int``
+        :param end: offset after the last character of the match
+        :type end: ``int``
+
+        """
+        self.query = query
+        self.text = text
+        self._start = start
+        self._end = end
+        self._positions = None
+
+    def start(self):
+        """Return offset of the start of the match.
+
+        This is the start of the line the characters are on, as
+        the regex would also match the characters in front of them.
+
+        """
+        return self._start
+
+    def end(self):
+        """Return offset after the end of the match."""
+        return self._end
+
+    @property
+    def positions(self):
+        """Offsets of the matched characters in the text.
+
+        The characters are in the tightest window of the line that
+        contains them all, e.g. ``ab`` in ``axxxxb ab`` are the last
+        two characters. If there are several windows of the same
+        width, the first one is used.
+
+        Each window is found by scanning forward for the earliest end
+        of a match and then back from there for its latest start. The
+        next window must start after that one, so the scan then starts
+        again from the character after its start.
+
+        :returns: offset of each character of the query
+        :rtype: ``tuple``
+
+        """
+        if self._positions is None:
+            text, query, line = self.text, self.query, self._start
+            eol = text.find('\n', line)
+            if eol < 0:
+                eol = len(text)
+
+            best = None
+            end = self._end  # earliest end of a match
+            while True:
+                positions = []
+                pos = end
+                for c in reversed(query):
+                    pos = text.rfind(c, line, pos)
+                    positions.append(pos)
+                positions.reverse()
+
+                if best is None or (positions[-1] - positions[0] <
+                                    best[-1] - best[0]):
+                    best = positions
+
+                # earliest end of a match after this window's start
+                end = positions[0] + 1
+                for c in query:
+                    end = text.find(c, end, eol)
+                    if end < 0:
+                        break
+                    end += 1
+                else:
+                    continue
+                break
+
+            self._positions = tuple(best)
+
+        return self._positions
+
+
+class CompiledQuery(object):
+    """A query prepared for :meth:`Workflow.filter`.
+
+    Create one with :meth:`Workflow.compile_query`. Instances can be
+    pickled, so they can be cached, e.g. with :meth:`Workflow.cache_data`.
+
+    """
+
+    def __init__(self, query, words):
+        """Create new :class:`CompiledQuery`.
+
+        :param query: the query as entered
+        :type query: ``unicode``
+        :param words: ``(word, fold, chars, atom, search)`` tuples
+        :type words: ``tuple``
+
+        """
+        #: The query as entered.
+        self.query = query
+        #: A ``(word, fold, chars, atom, search)`` tuple for each word
+        #: of the query. ``word`` is lowercase, ``fold`` is whether to
+        #: compare it to ASCII-folded search keys, ``chars`` are its
+        #: unique characters, ``atom`` is ``word`` as it appears in
+        #: :meth:`Workflow._search_keys` atoms, and ``search`` is its
+        #: :const:`MATCH_ALLCHARS` matcher (see :func:`search_allchars`).
+        self.words = words
+
+    def __repr__(self):
+        """Format query as string."""
+        return 'CompiledQuery({0!r})'.format(self.query)
+
+
 class Settings(dict):
     """A dictionary that saves itself when changed.
 
@@ -955,6 +1909,7 @@ class Workflow(object):
         self._name = None
         self._cache_serializer = 'cpickle'
         self._data_serializer = 'cpickle'
+        self._cache_manifest = UNSET
         self._info = None
         self._info_loaded = False
         self._logger = None
@@ -966,6 +1921,13 @@ class Workflow(object):
         self._last_version_run = UNSET
         # Cache for regex patterns created for filter keys
         self._search_pattern_cache = {}
+        #: Minimum number of items for :meth:`filter` to score indexed
+        #: items with the batch scorer. Set to ``0`` to disable it.
+        self.filter_batch_size = 10000
+        #: Minimum number of items for :meth:`filter` to score them in
+        #: parallel, in one forked process per CPU. Set to ``0`` to
+        #: disable it.
+        self.filter_pool_size = 50000
         #: Prefix for all magic arguments.
         #: The default value is ``workflow:`` so keyword
         #: ``config`` would match user query ``workflow:config``.
@@ -1668,7 +2630,8 @@ class Workflow(object):
 
         self.logger.debug('saved data: %s', data_path)
 
-    def cached_data(self, name, data_func=None, max_age=60):
+    def cached_data(self, name, data_func=None, max_age=60,
+                    serializer=None):
         """Return cached data if younger than ``max_age`` seconds.
 
         Retrieve data from cache or re-generate and re-cache data if
@@ -1680,30 +2643,41 @@ class Workflow(object):
         :type data_func: ``callable``
         :param max_age: maximum age of cached data in seconds
         :type max_age: ``int``
+        :param serializer: name of serializer the data was cached with.
+            Defaults to :attr:`cache_serializer`.
+
         :returns: cached data, return value of ``data_func`` or ``None``
             if ``data_func`` is not set
 
         """
-        serializer = manager.serializer(self.cache_serializer)
-
-        cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
-        age = self.cached_data_age(name)
-
-        if (age < max_age or max_age == 0) and os.path.exists(cache_path):
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
 
-            with open(cache_path, 'rb') as file_obj:
-                self.logger.debug('loading cached data: %s', cache_path)
-                return serializer.load(file_obj)
+        cache_path = self.cachefile('%s.%s' % (name, serializer_name))
+        age = self.cached_data_age(name, serializer_name)
+
+        if age and (age < max_age or max_age == 0):
+            try:
+                with open(cache_path, 'rb') as file_obj:
+                    self.logger.debug('loading cached data: %s', cache_path)
+                    # Stop :meth:`evict_cached_data` deleting the file.
+                    # Memory-mapped files stay locked while mapped.
+                    fcntl.flock(file_obj, fcntl.LOCK_SH)
+                    return serializer.load(file_obj)
+            except IOError as err:
+                # deleted since the manifest was read
+                if err.errno != errno.ENOENT:
+                    raise
 
         if not data_func:
             return None
 
         data = data_func()
-        self.cache_data(name, data)
+        self.cache_data(name, data, serializer_name)
 
         return data
 
-    def cache_data(self, name, data):
+    def cache_data(self, name, data, serializer=None):
         """Save ``data`` to cache under ``name``.
 
         If ``data`` is ``None``, the corresponding cache file will be
@@ -1712,59 +2686,225 @@ class Workflow(object):
         :param name: name of datastore
         :param data: data to store. This may be any object supported by
                 the cache serializer
+        :param serializer: name of serializer to use. Defaults to
+            :attr:`cache_serializer`. Pass the same name to
+            :meth:`cached_data` to load the data.
 
         """
-        serializer = manager.serializer(self.cache_serializer)
+        serializer_name = serializer or self.cache_serializer
+        serializer = manager.serializer(serializer_name)
 
-        cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
+        cache_path = self.cachefile('%s.%s' % (name, serializer_name))
+
+        filename = os.path.basename(cache_path)
 
         if data is None:
             if os.path.exists(cache_path):
                 os.unlink(cache_path)
                 self.logger.debug('deleted cache file: %s', cache_path)
+            self._update_cache_manifest(
+                lambda manifest: manifest.pop(filename, None))
             return
 
         with atomic_writer(cache_path, 'wb') as file_obj:
             serializer.dump(data, file_obj)
 
+        st = os.stat(cache_path)
+
+        def update(manifest):
+            old = manifest.get(filename)
+            manifest[filename] = {
+                'name': name,
+                'serializer': serializer_name,
+                'mtime': st.st_mtime,
+                'size': st.st_size,
+                'version': old['version'] + 1 if old else 1,
+            }
+
+        self._update_cache_manifest(update)
         self.logger.debug('cached data: %s', cache_path)
 
-    def cached_data_fresh(self, name, max_age):
+    def evict_cached_data(self, name, serializer=None):
+        """Delete cache ``name`` unless another process is reading it.
+
+        Unlike ``cache_data(name, None)``, leaves the cache alone if
+        :meth:`cached_data` is loading it or has memory-mapped it.
+
+        :param name: name of datastore
+        :type name: ``unicode``
+        :param serializer: name of serializer the data was cached with.
+            Defaults to :attr:`cache_serializer`.
+        :returns: ``True`` if cache was deleted or didn't exist, ``False``
+            if it's in use
+        :rtype: ``bool``
+
+        """
+        serializer = serializer or self.cache_serializer
+        cache_path = self.cachefile('%s.%s' % (name, serializer))
+        filename = os.path.basename(cache_path)
+
+        try:
+            file_obj = open(cache_path, 'rb')
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        else:
+            with file_obj:
+                try:
+                    fcntl.flock(file_obj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as err:
+                    if err.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    self.logger.debug('cache file in use: %s', cache_path)
+                    return False
+
+                os.unlink(cache_path)
+                self.logger.debug('evicted cache file: %s', cache_path)
+
+        self._update_cache_manifest(
+            lambda manifest: manifest.pop(filename, None))
+        return True
+
+    def cached_data_fresh(self, name, max_age, serializer=None):
         """Whether cache `name` is less than `max_age` seconds old.
 
         :param name: name of datastore
         :param max_age: maximum age of data in seconds
         :type max_age: ``int``
+        :param serializer: name of serializer the data was cached with.
+            Defaults to :attr:`cache_serializer`.
+
         :returns: ``True`` if data is less than ``max_age`` old, else
             ``False``
 
         """
-        age = self.cached_data_age(name)
+        age = self.cached_data_age(name, serializer)
 
         if not age:
             return False
 
         return age < max_age
 
-    def cached_data_age(self, name):
+    def cached_data_age(self, name, serializer=None):
         """Return age in seconds of cache `name` or 0 if cache doesn't exist.
 
         :param name: name of datastore
         :type name: ``unicode``
+        :param serializer: name of serializer the data was cached with.
+            Defaults to :attr:`cache_serializer`.
+
         :returns: age of datastore in seconds
         :rtype: ``int``
 
         """
-        cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
-
-        if not os.path.exists(cache_path):
+        info = self.cached_data_info(name, serializer)
+        if info is None:
             return 0
 
-        return time.time() - os.stat(cache_path).st_mtime
+        return time.time() - info['mtime']
+
+    def cached_data_info(self, name, serializer=None):
+        """Return manifest entry of cache `name` or ``None``.
+
+        :meth:`cache_data` records each cache it saves in a manifest,
+        which is read only once per process. The entries are
+        ``dict`` objects with the keys ``name``, ``serializer``,
+        ``mtime`` and ``size`` (of the cache file) and ``version``,
+        which is incremented every time the data are saved.
+
+        :param name: name of datastore
+        :type name: ``unicode``
+        :param serializer: name of serializer the data was cached with.
+            Defaults to :attr:`cache_serializer`.
+        :returns: manifest entry or ``None`` if cache doesn't exist
+        :rtype: ``dict``
+
+        """
+        serializer = serializer or self.cache_serializer
+        filename = '%s.%s' % (name, serializer)
+
+        if self._cache_manifest is UNSET:
+            self._cache_manifest = self._read_cache_manifest()
+
+        if self._cache_manifest is not None:
+            info = self._cache_manifest.get(filename)
+            return dict(info) if info else None
+
+        # No manifest yet, so check the file itself
+        return self._cache_file_info(filename)
+
+    def cached_data_entries(self):
+        """Return manifest entries of all cached data.
+
+        See :meth:`cached_data_info` for the format of the entries.
+
+        :returns: manifest entries
+        :rtype: ``list`` of ``dict`` objects
+
+        """
+        if self._cache_manifest is UNSET:
+            self._cache_manifest = self._read_cache_manifest()
+
+        manifest = self._cache_manifest
+        if manifest is None:
+            manifest = self._scan_cache()
+
+        return [dict(info) for info in manifest.values()]
+
+    def _read_cache_manifest(self):
+        """Return contents of cache manifest or ``None``."""
+        try:
+            with open(self.cachefile(CACHE_MANIFEST), 'rb') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def _update_cache_manifest(self, func):
+        """Call ``func`` with contents of cache manifest and save them.
+
+        The manifest is locked and re-read first, so updates by other
+        processes aren't lost.
+
+        """
+        path = self.cachefile(CACHE_MANIFEST)
+        with LockFile(path):
+            manifest = self._read_cache_manifest()
+            if manifest is None:
+                manifest = self._scan_cache()
+            func(manifest)
+            with atomic_writer(path, 'wb') as fp:
+                json.dump(manifest, fp)
+
+        self._cache_manifest = manifest
+
+    def _scan_cache(self):
+        """Return manifest entries for files in cache directory."""
+        manifest = {}
+        for filename in os.listdir(self.cachedir):
+            info = self._cache_file_info(filename)
+            if info:
+                manifest[filename] = info
+
+        return manifest
+
+    def _cache_file_info(self, filename):
+        """Return manifest entry for cache file or ``None``."""
+        name, ext = os.path.splitext(filename)
+        if filename == CACHE_MANIFEST or not manager.serializer(ext[1:]):
+            return None
+
+        try:
+            st = os.stat(self.cachefile(filename))
+        except OSError:
+            return None
+
+        return {'name': name, 'serializer': ext[1:], 'mtime': st.st_mtime,
+                'size': st.st_size, 'version': 0}
 
     def filter(self, query, items, key=lambda x: x, ascending=False,
                include_score=False, min_score=0, max_results=0,
-               match_on=MATCH_ALL, fold_diacritics=True):
+               match_on=MATCH_ALL, fold_diacritics=True, index=None,
+               grams=None):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
         ``query`` is case-insensitive. Any item that does not contain the
@@ -1773,8 +2913,10 @@ class Workflow(object):
         If ``query`` is an empty string or contains only whitespace,
         all items will match.
 
-        :param query: query to test items against
-        :type query: ``unicode``
+        :param query: query to test items against, or a query compiled
+            with :meth:`compile_query`, in which case ``fold_diacritics``
+            is ignored
+        :type query: ``unicode`` or :class:`CompiledQuery`
         :param items: iterable of items to test
         :type items: ``list`` or ``tuple``
         :param key: function to get comparison key from ``items``.
@@ -1791,6 +2933,8 @@ class Workflow(object):
             than this.
         :type min_score: ``int``
         :param max_results: If non-zero, prune results list to this length.
+            Only the best ``max_results`` matches are selected instead of
+            sorting all of them, so set this if you only need the top few.
         :type max_results: ``int``
         :param match_on: Filter option flags. Bitwise-combined list of
             ``MATCH_*`` constants (see below).
@@ -1798,6 +2942,14 @@ class Workflow(object):
         :param fold_diacritics: Convert search keys to ASCII-only
             characters if ``query`` only contains ASCII characters.
         :type fold_diacritics: ``Boolean``
+        :param index: Search keys precomputed by :meth:`search_index`
+            for ``items`` (with the same ``key``). If set, ``key`` is not
+            called.
+        :type index: ``dict``
+        :param grams: Posting lists generated by :meth:`gram_index` from
+            ``index``. If set, only items that can possibly match ``query``
+            are tested.
+        :type grams: ``dict``
         :returns: list of ``items`` matching ``query`` or list of
             ``(item, score, rule)`` `tuples` if ``include_score`` is ``True``.
             ``rule`` is the ``MATCH_*`` rule that matched the item.
@@ -1834,8 +2986,9 @@ class Workflow(object):
             Combination of all the above.
 
 
-        :const:`MATCH_ALLCHARS` is considerably slower than the other
-        tests and provides much less accurate results.
+        :const:`MATCH_ALLCHARS` is slower than the other tests (though
+        it takes linear time, see :func:`search_allchars`) and provides
+        much less accurate results.
 
         **Examples:**
 
@@ -1862,58 +3015,507 @@ class Workflow(object):
         If ``query`` contains non-ASCII characters, search keys will not be
         altered.
 
+        **Search index**
+
+        Most of the work done by :meth:`filter` is deriving comparison
+        keys (lowercase, capitals, atoms, initials, ASCII-folded variants)
+        from each item. If you filter the same large list repeatedly,
+        generate the keys once with :meth:`search_index`, cache them
+        alongside ``items`` and pass them as ``index``.
+
+        For very large lists, also generate posting lists with
+        :meth:`gram_index` and pass them as ``grams``. :meth:`filter` then
+        only looks at items that contain the query's characters (or,
+        if ``match_on`` only contains substring-type rules, trigrams).
+
+        If there are at least :attr:`filter_pool_size` items to score,
+        :meth:`filter` splits them between one process per CPU. The
+        results are the same.
+
         """
-        if not query:
+        if not isinstance(query, CompiledQuery):
+            query = self.compile_query(query, fold_diacritics)
+
+        words = query.words
+        if not words:
             return items
 
-        # Remove preceding/trailing spaces
-        query = query.strip()
+        results, _ = self._filter_matches(words, items, key, index, match_on,
+                                          grams=grams, min_score=min_score,
+                                          max_results=max_results,
+                                          ascending=ascending)
 
-        if not query:
-            return items
+        return self._rank_results(results, ascending, include_score,
+                                  min_score, max_results)
+
+    def compile_query(self, query, fold_diacritics=True):
+        """Prepare ``query`` for :meth:`filter`.
+
+        Splits ``query`` into words and works out everything about them
+        that :meth:`filter` needs to compare them to items. Pass the
+        result to :meth:`filter` instead of ``query`` to avoid doing
+        this again, e.g. when filtering several lists or when caching
+        the query for the session.
+
+        :param query: query to prepare
+        :type query: ``unicode``
+        :param fold_diacritics: as for :meth:`filter`. The user's
+            diacritic-folding setting is also applied now.
+        :type fold_diacritics: ``Boolean``
+        :returns: compiled query
+        :rtype: :class:`CompiledQuery`
 
+        """
+        words = []
         # Use user override if there is one
         fold_diacritics = self.settings.get('__workflow_diacritic_folding',
                                             fold_diacritics)
 
+        for word in (query or '').strip().split(' '):
+            word = word.strip().lower()
+            if not word:
+                continue
+
+            chars = []
+            for c in word:
+                if c not in chars:
+                    chars.append(c)
+
+            words.append((word, fold_diacritics and isascii(word),
+                          ''.join(chars), '\x01{0}\x01'.format(word),
+                          self._search_for_query(word)))
+
+        return CompiledQuery(query, tuple(words))
+
+    def _filter_matches(self, words, items, key, index, match_on,
+                        candidates=None, grams=None, min_score=0,
+                        max_results=0, ascending=False):
+        """Score ``items`` against ``words``.
+
+        Returns ``(results, survivors)``. ``results`` are the unsorted
+        matches as ``(sort_key, (item, score, rule))`` tuples. They
+        may already be pruned per ``min_score`` and ``max_results``
+        (see :meth:`_pool_matches`), but must still be passed through
+        :meth:`_rank_results` with the same arguments.
+        ``survivors`` are the indices of the items that contain all the
+        characters of every word, which all ``MATCH_*`` rules require
+        (or a superset of them, or ``None`` if they aren't known).
+
+        Extending a query can only shrink the set of survivors, so they
+        may be passed back as ``candidates`` to only test those items
+        when filtering the same ``items`` with a longer query.
+
+        If ``grams`` is set, ``candidates`` is narrowed further to the
+        items whose posting lists contain the query.
+
+        """
+        if grams is not None:
+            candidates = self._narrow_candidates(words, grams, match_on,
+                                                 candidates)
+
+        columns = None
+        if index is not None:
+            columns = [index[k].split('\x00') for k in SEARCH_KEYS]
+
+        count = len(items if candidates is None else candidates)
+        if (self.filter_pool_size and count >= self.filter_pool_size and
+                multiprocessing.cpu_count() > 1):
+            return self._pool_matches(words, items, key, index, columns,
+                                      match_on, candidates, min_score,
+                                      max_results, ascending)
+
+        if (index is not None and self.filter_batch_size and
+                count >= self.filter_batch_size):
+            return self._batch_matches(words, items, index, columns,
+                                       match_on, candidates)
+
+        return self._score_matches(words, items, key, index, columns,
+                                   match_on, candidates)
+
+    def _score_matches(self, words, items, key, index, columns, match_on,
+                       candidates, labels=None, offset=0):
+        """Score ``items`` against ``words`` one by one.
+
+        ``columns`` are the split search keys of ``index``, starting at
+        item ``offset`` (see :func:`_index_block`). Returns ``(results,
+        survivors)`` like :meth:`_filter_matches`, but with the
+        corresponding element of ``labels`` (default: ``items``) in
+        place of each item.
+
+        """
+        if labels is None:
+            labels = items
+
         results = []
+        survivors = []
+        folding = [word[1] for word in words]
 
-        for item in items:
-            skip = False
-            score = 0
-            words = [s.strip() for s in query.split(' ')]
+        if index is not None:
+            folded = index['folded']
+            if candidates is None:
+                rows = enumerate(izip(*columns), offset)
+            else:
+                rows = ((i, tuple([c[i - offset] for c in columns]))
+                        for i in candidates)
+
+            for i, keys in rows:
+                if keys[0] == '':
+                    continue
+                fkeys = folded.get(i, keys)
+                if not self._has_chars(words, keys[1], fkeys[1]):
+                    continue
+                survivors.append(i)
+
+                score, rule = self._score_words(words, keys, fkeys, match_on)
+                if score:
+                    # use "reversed" `score` (i.e. highest becomes lowest)
+                    # and `value` as sort key. This means items with the
+                    # same score will be sorted in alphabetical not reverse
+                    # alphabetical order
+                    results.append(((100.0 / score, keys[1], score),
+                                    (labels[i], score, rule)))
+
+            return results, survivors
+
+        if candidates is None:
+            rows = enumerate(items)
+        else:
+            rows = ((i, items[i]) for i in candidates)
+
+        for i, item in rows:
             value = key(item).strip()
             if value == '':
                 continue
-            for word in words:
-                if word == '':
+            fvalue = value
+            if any(folding):
+                fvalue = self.fold_to_ascii(value)
+            if not self._has_chars(words, value.lower(), fvalue.lower()):
+                continue
+            survivors.append(i)
+
+            keys = fkeys = self._search_keys(value)
+            if fvalue != value:
+                fkeys = self._search_keys(fvalue)
+
+            score, rule = self._score_words(words, keys, fkeys, match_on)
+            if score:
+                results.append(((100.0 / score, keys[1], score),
+                                (labels[i], score, rule)))
+
+        return results, survivors
+
+    def _pool_matches(self, words, items, key, index, columns, match_on,
+                      candidates, min_score, max_results, ascending):
+        """Parallel version of :meth:`_score_matches`.
+
+        The items are split into one chunk per CPU, which are scored by
+        :meth:`_score_chunk` in forked processes (see :func:`_fork_map`).
+
+        Each process only returns its best ``max_results`` results with
+        a score above ``min_score``, so the union of them contains the
+        best results overall.
+
+        """
+        if candidates is None:
+            candidates = xrange(len(items))
+
+        count = len(candidates)
+        processes = multiprocessing.cpu_count()
+        size = -(-count // processes)  # round up
+        chunks = [(n, min(n + size, count)) for n in range(0, count, size)]
+        self.logger.debug('[filter] scoring %d item(s) in %d processes',
+                          count, len(chunks))
+
+        def score_chunk(bounds):
+            return self._score_chunk(words, items, key, index, columns,
+                                     match_on, candidates, bounds,
+                                     min_score, max_results, ascending)
+
+        results = []
+        survivors = array(b'I')
+        for matches, found in _fork_map(score_chunk, chunks):
+            results.extend([(sort_key, (items[i], score, rule))
+                            for sort_key, (i, score, rule) in matches])
+            survivors.fromstring(found)
+
+        return results, survivors.tolist()
+
+    def _score_chunk(self, words, items, key, index, columns, match_on,
+                     candidates, bounds, min_score, max_results, ascending,
+                     offset=0):
+        """Score a chunk of ``candidates`` for :meth:`_pool_matches`.
+
+        ``bounds`` are the start and end of the chunk in ``candidates``.
+        ``columns`` and ``offset`` are as for :meth:`_score_matches`.
+
+        Returns the chunk's best ``(sort_key, (index, score, rule))``
+        results and its survivors as a packed :class:`array.array`.
+
+        """
+        start, end = bounds
+        if isinstance(candidates, xrange):
+            chunk = xrange(start, end)
+        else:
+            chunk = candidates[start:end]
+
+        results, survivors = self._score_matches(words, items, key, index,
+                                                 columns, match_on, chunk,
+                                                 xrange(len(items)), offset)
+
+        # return indices, as items may not be picklable
+        return (_best_indices(results, items, ascending, min_score,
+                              max_results),
+                array(b'I', survivors).tostring())
+
+    def _batch_chunk(self, words, items, index, columns, match_on,
+                     candidates, bounds, min_score, max_results, ascending,
+                     offset=0):
+        """Like :meth:`_score_chunk`, but with :meth:`_batch_matches`.
+
+        ``index`` and ``columns`` are those of the block of items
+        starting at item ``offset`` (see :func:`_block_index`), which
+        must contain the whole chunk. All the items in the block are
+        searched, but only ``candidates`` can match.
+
+        """
+        start, end = bounds
+        results, survivors = self._batch_matches(words, items, index,
+                                                 columns, match_on, None,
+                                                 xrange(len(items)), offset)
+        if survivors is None:  # not known, so all of them
+            if isinstance(candidates, xrange):
+                survivors = xrange(start, end)
+            else:
+                survivors = candidates[start:end]
+
+        return (_best_indices(results, items, ascending, min_score,
+                              max_results),
+                array(b'I', survivors).tostring())
+
+    def _batch_matches(self, words, items, index, columns, match_on,
+                       candidates, labels=None, offset=0):
+        """Batch version of :meth:`_filter_matches` for indexed items.
+
+        Instead of testing each item against each rule in turn, each rule
+        is tested against all items at once by searching the NUL-joined
+        search keys in ``index`` (see :meth:`_batch_score`). This is only
+        done for the first word of the query: the others are tested
+        individually against the items that match it. The results are
+        the same.
+
+        ``index`` may also be the index of one block of items starting at
+        item ``offset`` (see :func:`_block_index`). ``labels`` are as for
+        :meth:`_score_matches`.
+
+        """
+        if labels is None:
+            labels = items
+
+        folded = index['folded']
+        lowers = columns[1]
+        matched = self._batch_score(words[0], index, columns, match_on)
+        words = words[1:]
+
+        results = []
+        fired = []
+        for i, (score, rule) in matched.iteritems():
+            ok = bool(score)
+            if words:
+                keys = tuple([c[i] for c in columns])
+                fkeys = folded.get(i, keys)
+                if not self._has_chars(words, keys[1], fkeys[1]):
                     continue
-                s, rule = self._filter_item(value, word, match_on,
-                                            fold_diacritics)
 
-                if not s:  # Skip items that don't match part of the query
-                    skip = True
-                score += s
+                for word in words:
+                    s, rule = self._filter_keys(fkeys if word[1] else keys,
+                                                word, match_on)
+                    if rule is None:  # no match
+                        break
+                    if not s:  # match, but item is skipped
+                        ok = False
+                    score += s
+
+                else:
+                    fired.append(i + offset)
+                    if ok and score:
+                        results.append(((100.0 / score, lowers[i], score),
+                                        (labels[i + offset], score, rule)))
 
-            if skip:
                 continue
 
-            if score:
-                # use "reversed" `score` (i.e. highest becomes lowest) and
-                # `value` as sort key. This means items with the same score
-                # will be sorted in alphabetical not reverse alphabetical order
-                results.append(((100.0 / score, value.lower(), score),
-                                (item, score, rule)))
-
-        # sort on keys, then discard the keys
-        results.sort(reverse=ascending)
-        results = [t[1] for t in results]
+            fired.append(i + offset)
+            if ok:
+                results.append(((100.0 / score, lowers[i], score),
+                                (labels[i + offset], score, rule)))
+
+        # If all characters in order is enough for a match, every match
+        # of an extended query matches (though possibly with a zero
+        # score) this one, too
+        if match_on & MATCH_ALLCHARS:
+            return results, sorted(fired)
+
+        return results, candidates
+
+    def _batch_score(self, word, index, columns, match_on):
+        """Match all items against ``word``.
+
+        ``word`` is one of the :attr:`CompiledQuery.words`. If it should
+        be folded, the ASCII-folded keys of non-ASCII items are used.
 
-        if min_score:
-            results = [r for r in results if r[1] > min_score]
+        The rules in :const:`BATCH_RULES` are substring searches of the
+        NUL-joined keys. :const:`MATCH_ALLCHARS` is a single pass over
+        the joined lowercase keys with :func:`_find_allchars`.
 
-        if max_results and len(results) > max_results:
-            results = results[:max_results]
+        :returns: :class:`dict` mapping the indices of matching items to
+            ``(score, rule)``, as returned by :meth:`_filter_keys`.
+
+        """
+        word, fold, _, atom, search = word
+        folded = index['folded'] if fold else {}
+        prefix = 'folded_' if folded else ''
+        matched = {}
+        for rule, k, base, scored, start in BATCH_RULES:
+            if not match_on & rule:
+                continue
+
+            sub = word
+            if rule == MATCH_ATOM:
+                sub = atom
+
+            blob = index[prefix + SEARCH_KEYS[k]]
+            lengths = columns[scored]
+            for i in _find_items(blob, sub, start):
+                if i in matched:
+                    continue
+                if i in folded:
+                    n = len(folded[i][scored])
+                else:
+                    n = len(lengths[i])
+                matched[i] = (base - (n / len(word)), rule)
+
+        if not match_on & MATCH_ALLCHARS:
+            return matched
+
+        # The lowercase keys match a superset of what
+        # :func:`search_allchars` does, which only ignores the case of
+        # ASCII letters, so check non-ASCII items again
+        recheck = {} if fold else index['folded']
+        values = columns[0]
+        for i, start, end in _find_allchars(index[prefix + 'lower'], word):
+            if i in matched:
+                continue
+            if i in recheck:
+                match = search(values[i])
+                if not match:
+                    continue
+                start, end = match.start(), match.end()
+
+            score = 100.0 / ((1 + start) * (end - start + 1))
+            matched[i] = (score, MATCH_ALLCHARS)
+
+        return matched
+
+    def _narrow_candidates(self, words, grams, match_on, candidates):
+        """Narrow ``candidates`` to items that may match per ``grams``.
+
+        ``candidates`` may be ``None`` (all items), and so is the result
+        if ``grams`` doesn't narrow them down (see
+        :meth:`_gram_candidates`).
+
+        """
+        found = self._gram_candidates(words, grams, match_on)
+        if found is None:
+            return candidates
+        if candidates is not None:
+            return sorted(set(candidates).intersection(found))
+        return found
+
+    def _gram_candidates(self, words, grams, match_on):
+        """Return indices of items that may match ``words`` per ``grams``.
+
+        Returns ``None`` if the posting lists don't narrow down the items
+        enough to be worth using.
+
+        """
+        # Only these rules require ``query`` to be a substring of the
+        # item. All the rules require it to contain the characters.
+        substrings = not match_on & ~(MATCH_STARTSWITH | MATCH_ATOM |
+                                      MATCH_SUBSTRING)
+        wanted = set()
+        for word in [w[0] for w in words]:
+            if substrings and len(word) >= 3:
+                wanted.update([word[i:i + 3] for i in xrange(len(word) - 2)])
+            else:
+                wanted.update(word)
+
+        postings = []
+        for gram in wanted:
+            data = grams['grams'].get(gram)
+            if data is None:  # no item contains ``gram``
+                return []
+            postings.append(data)
+
+        # Start with the shortest list. If even that contains most items,
+        # a full scan is quicker.
+        postings.sort(key=len)
+        posting = array(b'I')
+        if len(postings[0]) / posting.itemsize > grams['count'] / 2:
+            return None
+
+        candidates = None
+        for data in postings:
+            posting = array(b'I')
+            posting.fromstring(data)
+            if candidates is None:
+                candidates = set(posting)
+            else:
+                candidates.intersection_update(posting)
+            if not candidates:
+                break
+
+        return sorted(candidates)
+
+    def _has_chars(self, words, lower, flower):
+        """Whether ``lower`` or ``flower`` contain all characters of words.
+
+        ``lower`` and ``flower`` are the lowercase plain and ASCII-folded
+        search keys respectively.
+
+        """
+        for _, fold, chars, _, _ in words:
+            text = flower if fold else lower
+            for c in chars:
+                if c not in text:
+                    return False
+
+        return True
+
+    def _score_words(self, words, keys, fkeys, match_on):
+        """Score plain ``keys`` and ASCII-folded ``fkeys`` against words.
+
+        :returns: ``(score, rule)``. ``score`` is ``0`` if any word
+            doesn't match and ``rule`` is the rule the last word matched.
+
+        """
+        score = 0
+        rule = None
+        for word in words:
+            s, rule = self._filter_keys(fkeys if word[1] else keys, word,
+                                        match_on)
+
+            if not s:  # Skip items that don't match part of the query
+                return (0, None)
+            score += s
+
+        return (score, rule)
+
+    def _rank_results(self, results, ascending, include_score, min_score,
+                      max_results):
+        """Sort and prune :meth:`filter` results."""
+        results = _best_results(results, ascending, min_score, max_results)
+
+        # discard the sort keys
+        results = [t[1] for t in results]
 
         # return list of ``(item, score, rule)``
         if include_score:
@@ -1921,56 +3523,160 @@ class Workflow(object):
         # just return list of items
         return [t[0] for t in results]
 
-    def _filter_item(self, value, query, match_on, fold_diacritics):
-        """Filter ``value`` against ``query`` using rules ``match_on``.
+    def search_index(self, items, key=lambda x: x):
+        """Precompute :meth:`filter` search keys for ``items``.
 
-        :returns: ``(score, rule)``
+        Derives everything :meth:`filter` compares a query to from the
+        search key of each item (lowercase key, capitals, atoms, initials
+        and the same for the ASCII-folded key), so it only has to be done
+        once, not on every call to :meth:`filter`.
+
+        The index consists only of strings, so it is compact and quick
+        to (un)serialize, and can be cached with :meth:`cache_data`.
+        Pass it to :meth:`filter` via the ``index`` argument along with
+        the same ``items``.
+
+        :param items: iterable of items to index
+        :type items: ``list`` or ``tuple``
+        :param key: function to get comparison key from ``items``. Must
+            be the same function you would pass to :meth:`filter`.
+        :type key: ``callable``
+        :returns: search keys for ``items``
+        :rtype: ``dict``
+
+        """
+        columns = [[] for _ in SEARCH_KEYS]
+        folded = {}
+        for i, item in enumerate(items):
+            value = key(item).strip()
+            if value == '':
+                keys = ('',) * len(SEARCH_KEYS)
+            else:
+                keys = self._search_keys(value)
+                if not isascii(value):
+                    folded[i] = self._search_keys(self.fold_to_ascii(value))
+
+            for column, k in zip(columns, keys):
+                column.append(k)
+
+        index = {'count': len(columns[0]), 'folded': folded, 'blocks': {}}
+        for k, column in zip(SEARCH_KEYS, columns):
+            index[k] = '\x00'.join(column)
+
+            # Offset of each block of keys
+            offsets = []
+            offset = 0
+            for i in xrange(0, len(column), INDEX_BLOCK_SIZE):
+                offsets.append(offset)
+                block = column[i:i + INDEX_BLOCK_SIZE]
+                offset += len('\x00'.join(block)) + 1
+
+            index['blocks'][k] = offsets
+
+        # Keys with the ASCII-folded versions of non-ASCII items for
+        # the batch scorer
+        if folded:
+            for i, keys in folded.iteritems():
+                for column, k in zip(columns, keys):
+                    column[i] = k
+
+            for k, column in zip(SEARCH_KEYS, columns):
+                index['folded_' + k] = '\x00'.join(column)
+
+        return index
+
+    def gram_index(self, index):
+        """Generate posting lists of the characters and trigrams in ``index``.
+
+        Maps each character and trigram of the lowercase (and
+        ASCII-folded) search keys in a search index generated by
+        :meth:`search_index` to the indices of the items that contain
+        it. Pass the result to :meth:`filter` via the ``grams`` argument
+        along with ``index`` to only test the items that can possibly
+        match the query.
+
+        The posting lists are stored as strings of packed integers, so
+        the index can be cached with :meth:`cache_data` and loads quickly.
+
+        :param index: search keys as returned by :meth:`search_index`
+        :type index: ``dict``
+        :returns: posting lists
+        :rtype: ``dict``
+
+        """
+        folded = index['folded']
+        postings = {}
+        for i, lower in enumerate(index['lower'].split('\x00')):
+            if lower == '':
+                continue
+            texts = [lower]
+            if i in folded:
+                texts.append(folded[i][1])
+
+            found = set()
+            for text in texts:
+                found.update(text)
+                found.update([text[j:j + 3] for j in xrange(len(text) - 2)])
+
+            for gram in found:
+                if gram not in postings:
+                    postings[gram] = array(b'I')
+                postings[gram].append(i)
+
+        grams = {}
+        for gram, posting in postings.items():
+            grams[gram] = posting.tostring()
+
+        return {'count': index['count'], 'grams': grams}
+
+    def _search_keys(self, value):
+        """Return search keys for ``value`` in :const:`SEARCH_KEYS` order.
+
+        Atoms are joined with (and wrapped in) ``\\x01``.
 
         """
-        query = query.lower()
+        # capital letters, for matching e.g. of = OmniFocus
+        capitals = ''.join([c for c in value if c in INITIALS]).lower()
+        # split the item into "atoms", i.e. words separated by
+        # spaces or other non-word characters
+        atoms = [s.lower() for s in split_on_delimiters(value)]
+        # initials of the atoms
+        initials = ''.join([s[0] for s in atoms if s])
+        atoms = '\x01{0}\x01'.format('\x01'.join(atoms))
+
+        return (value, value.lower(), capitals, atoms, initials)
 
-        if not isascii(query):
-            fold_diacritics = False
+    def _filter_keys(self, keys, word, match_on):
+        """Filter search ``keys`` against ``word`` using rules ``match_on``.
 
-        if fold_diacritics:
-            value = self.fold_to_ascii(value)
+        ``keys`` are as returned by :meth:`_search_keys` and ``word``
+        is one of the :attr:`CompiledQuery.words`. ``keys`` must contain
+        all its characters (see :meth:`_has_chars`).
 
-        # pre-filter any items that do not contain all characters
-        # of ``query`` to save on running several more expensive tests
-        if not set(query) <= set(value.lower()):
+        :returns: ``(score, rule)``
 
-            return (0, None)
+        """
+        value, lower, capitals, atoms, initials = keys
+        query, _, _, atom, search = word
 
         # item starts with query
-        if match_on & MATCH_STARTSWITH and value.lower().startswith(query):
+        if match_on & MATCH_STARTSWITH and lower.startswith(query):
             score = 100.0 - (len(value) / len(query))
 
             return (score, MATCH_STARTSWITH)
 
         # query matches capitalised letters in item,
         # e.g. of = OmniFocus
-        if match_on & MATCH_CAPITALS:
-            initials = ''.join([c for c in value if c in INITIALS])
-            if initials.lower().startswith(query):
-                score = 100.0 - (len(initials) / len(query))
+        if match_on & MATCH_CAPITALS and capitals.startswith(query):
+            score = 100.0 - (len(capitals) / len(query))
 
-                return (score, MATCH_CAPITALS)
-
-        # split the item into "atoms", i.e. words separated by
-        # spaces or other non-word characters
-        if (match_on & MATCH_ATOM or
-                match_on & MATCH_INITIALS_CONTAIN or
-                match_on & MATCH_INITIALS_STARTSWITH):
-            atoms = [s.lower() for s in split_on_delimiters(value)]
-            # print('atoms : %s  -->  %s' % (value, atoms))
-            # initials of the atoms
-            initials = ''.join([s[0] for s in atoms if s])
+            return (score, MATCH_CAPITALS)
 
         if match_on & MATCH_ATOM:
             # is `query` one of the atoms in item?
             # similar to substring, but scores more highly, as it's
             # a word within the item
-            if query in atoms:
+            if atom in atoms:
                 score = 100.0 - (len(value) / len(query))
 
                 return (score, MATCH_ATOM)
@@ -1994,7 +3700,7 @@ class Workflow(object):
             return (score, MATCH_INITIALS_CONTAIN)
 
         # `query` is a substring of item
-        if match_on & MATCH_SUBSTRING and query in value.lower():
+        if match_on & MATCH_SUBSTRING and query in lower:
             score = 90.0 - (len(value) / len(query))
 
             return (score, MATCH_SUBSTRING)
@@ -2002,7 +3708,6 @@ class Workflow(object):
         # finally, assign a score based on how close together the
         # characters in `query` are in item.
         if match_on & MATCH_ALLCHARS:
-            search = self._search_for_query(query)
             match = search(value)
             if match:
                 score = 100.0 / ((1 + match.start()) *
@@ -2014,16 +3719,15 @@ class Workflow(object):
         return (0, None)
 
     def _search_for_query(self, query):
+        """Return function to find all characters of ``query`` in text.
+
+        See :func:`search_allchars`.
+
+        """
         if query in self._search_pattern_cache:
             return self._search_pattern_cache[query]
 
-        # Build pattern: include all characters
-        pattern = []
-        for c in query:
-            # pattern.append('[^{0}]*{0}'.format(re.escape(c)))
-            pattern.append('.*?{0}'.format(re.escape(c)))
-        pattern = ''.join(pattern)
-        search = re.compile(pattern, re.IGNORECASE).search
+        search = functools.partial(_search_allchars, _ascii_lower(query))
 
         self._search_pattern_cache[query] = search
         return search
@@ -2608,6 +4312,17 @@ class Workflow(object):
         """
         self._delete_directory_contents(self.cachedir, filter_func)
 
+        # forget deleted data
+        if os.path.exists(self.cachefile(CACHE_MANIFEST)):
+            def update(manifest):
+                for filename in manifest.keys():
+                    if filter_func(filename):
+                        del manifest[filename]
+
+            self._update_cache_manifest(update)
+        else:
+            self._cache_manifest = UNSET
+
     def clear_data(self, filter_func=lambda f: True):
         """Delete all files in workflow's :attr:`datadir`.
 
@@ -25,11 +25,33 @@ of them, and they won't be sent to Alfred when you call
 
 from __future__ import print_function, unicode_literals, absolute_import
 
+from array import array
+import bisect
 import json
+import multiprocessing
 import os
 import sys
+import time
 
-from .workflow import ICON_WARNING, Workflow
+from .workflow import (
+    ICON_WARNING,
+    INDEX_BLOCK_SIZE,
+    MATCH_ALL,
+    SEARCH_KEYS,
+    CompiledQuery,
+    Workflow,
+    _best_indices,
+    _block_index,
+    _fork_map,
+    _index_block,
+)
+
+
+def _indices(data):
+    """Unpack item indices packed with :meth:`array.array.tostring`."""
+    indices = array(b'I')
+    indices.fromstring(data)
+    return indices
 
 
 class Variables(dict):
@@ -455,6 +477,8 @@ class Workflow3(Workflow):
     Attributes:
         item_class (class): Class used to generate feedback items.
         variables (dict): Top level workflow variables.
+        filter_pending (bool): Whether the last call to :meth:`filter`
+            ran out of time before it scored all items.
 
     """
 
@@ -469,6 +493,7 @@ class Workflow3(Workflow):
         Workflow.__init__(self, **kwargs)
         self.variables = {}
         self._rerun = 0
+        self.filter_pending = False
         # Get session ID from environment if present
         self._session_id = os.getenv('_WF_SESSION_ID') or None
         if self._session_id:
@@ -598,7 +623,7 @@ class Workflow3(Workflow):
         """New cache name/key based on session ID."""
         return self._session_prefix + name
 
-    def cache_data(self, name, data, session=False):
+    def cache_data(self, name, data, session=False, serializer=None):
         """Cache API with session-scoped expiry.
 
         .. versionadded:: 1.25
@@ -608,8 +633,9 @@ class Workflow3(Workflow):
             data (object): Data to cache
             session (bool, optional): Whether to scope the cache
                 to the current session.
+            serializer (str, optional): Name of serializer to use.
 
-        ``name`` and ``data`` are the same as for the
+        ``name``, ``data`` and ``serializer`` are the same as for the
         :meth:`~workflow.Workflow.cache_data` method on
         :class:`~workflow.Workflow`.
 
@@ -620,9 +646,10 @@ class Workflow3(Workflow):
         if session:
             name = self._mk_session_name(name)
 
-        return super(Workflow3, self).cache_data(name, data)
+        return super(Workflow3, self).cache_data(name, data, serializer)
 
-    def cached_data(self, name, data_func=None, max_age=60, session=False):
+    def cached_data(self, name, data_func=None, max_age=60, session=False,
+                    serializer=None):
         """Cache API with session-scoped expiry.
 
         .. versionadded:: 1.25
@@ -634,9 +661,11 @@ class Workflow3(Workflow):
             max_age (int): Maximum allowable age of cache in seconds.
             session (bool, optional): Whether to scope the cache
                 to the current session.
+            serializer (str, optional): Name of serializer the data
+                was cached with.
 
-        ``name``, ``data_func`` and ``max_age`` are the same as for the
-        :meth:`~workflow.Workflow.cached_data` method on
+        ``name``, ``data_func``, ``max_age`` and ``serializer`` are the
+        same as for the :meth:`~workflow.Workflow.cached_data` method on
         :class:`~workflow.Workflow`.
 
         If ``session`` is ``True``, then ``name`` is prefixed
@@ -646,7 +675,419 @@ class Workflow3(Workflow):
         if session:
             name = self._mk_session_name(name)
 
-        return super(Workflow3, self).cached_data(name, data_func, max_age)
+        return super(Workflow3, self).cached_data(name, data_func, max_age,
+                                                  serializer)
+
+    def cached_data_swr(self, name, cmd, max_age=60, job_name=None,
+                        serializer=None, rerun=0.5, timeout=None):
+        """Return cached data now and update them in the background if stale.
+
+        "Stale while revalidate": returns the data cached under ``name``
+        however old they are, and if they are older than ``max_age``
+        (or don't exist), runs ``cmd`` in the background via
+        :meth:`refresh_in_background`. ``cmd`` should save the new data
+        with :meth:`cache_data`.
+
+        Args:
+            name (str): Cache key
+            cmd (list): Command (and arguments) that updates the cache.
+            max_age (int, optional): Age in seconds after which the
+                cached data should be updated.
+            job_name (str, optional): Name of the background job.
+                Defaults to ``name``.
+            serializer (str, optional): Name of serializer the data
+                were cached with.
+            rerun (float, optional): Rerun interval while the cache
+                is being updated.
+            timeout (float, optional): Restart update jobs that have
+                been running longer than this. See
+                :meth:`refresh_in_background`.
+
+        Returns:
+            tuple: ``(data, stale, loading)``. ``data`` are the cached
+            data (``None`` if there aren't any), ``stale`` whether they
+            are older than ``max_age`` and ``loading`` whether they are
+            being updated.
+
+        """
+        data = self.cached_data(name, max_age=0, serializer=serializer)
+        stale = not self.cached_data_fresh(name, max_age, serializer)
+        loading = self.refresh_in_background(job_name or name, cmd, stale,
+                                             rerun, timeout)
+        return data, stale, loading
+
+    def refresh_in_background(self, name, cmd, stale=True, rerun=0.5,
+                              timeout=None):
+        """Run ``cmd`` as background job ``name`` if data are ``stale``.
+
+        The job isn't started if it's already running. While it runs,
+        :attr:`rerun` is set to (at most) ``rerun``, so Alfred runs the
+        Script Filter again and it can show the updated data.
+
+        If ``timeout`` is given and the data are stale, a job that has
+        been running longer than ``timeout`` seconds is assumed to be
+        stuck. It is killed along with the processes it started
+        (see :func:`~workflow.background.kill`), and a new one is
+        started in its place.
+
+        Args:
+            name (str): Name of the background job.
+            cmd (list): Command (and arguments) to run.
+            stale (bool, optional): Whether the data need updating.
+            rerun (float, optional): Rerun interval while job runs.
+            timeout (float, optional): Seconds after which the job is
+                superseded by a new one.
+
+        Returns:
+            bool: ``True`` if the job is running.
+
+        """
+        from .background import is_running, job_age, kill, run_in_background
+
+        running = is_running(name)
+        if stale and running and timeout:
+            age = job_age(name)
+            if age is not None and age > timeout:
+                self.logger.warning('[swr] %r has been running for %0.1fs, '
+                                    'restarting ...', name, age)
+                kill(name, group=True)
+                running = False
+
+        if stale and not running:
+            self.logger.debug('[swr] updating %r in background ...', name)
+            run_in_background(name, cmd)
+            running = True
+
+        if running:
+            if not self.rerun or self.rerun > rerun:
+                self.rerun = rerun
+            self.logger.debug('[swr] %r is being updated', name)
+
+        return running
+
+    def filter(self, query, items, key=lambda x: x, ascending=False,
+               include_score=False, min_score=0, max_results=0,
+               match_on=MATCH_ALL, fold_diacritics=True, index=None,
+               grams=None, session_key=None, version=None, budget=None):
+        """Fuzzy search filter that narrows results as the query grows.
+
+        Args:
+            session_key (str, optional): Session cache key to save the
+                state of the search under. Use a different key for each
+                list of ``items`` you filter.
+            version (object, optional): Identifies the current contents
+                of ``items``, e.g. the modification time of the cache
+                they were loaded from.
+            budget (float, optional): Maximum time in seconds to spend
+                scoring items. Requires ``session_key`` and ``version``.
+
+        See :meth:`Workflow.filter() <workflow.Workflow.filter>` for
+        the main documentation and other parameters.
+
+        If ``session_key`` and ``version`` are set, the indices of the
+        items that might match ``query`` are saved to the session cache.
+        When the script is re-run with a query that extends the previous
+        one (e.g. "inv" becomes "invo") and ``version`` is unchanged, only
+        those items are tested, so filtering gets faster as the user types
+        instead of rescanning all ``items`` on every keystroke. The
+        :class:`~workflow.workflow.CompiledQuery` is saved, too, and
+        reused if the script is re-run with the same query.
+
+        If not all items can be scored within ``budget``, the best
+        results so far are returned, :attr:`filter_pending` is set and
+        so is :attr:`rerun` (if it isn't already shorter). When the
+        script is re-run with the same query, scoring continues where
+        it stopped, so the final results are the same as without a
+        ``budget``. Items are scored one block of ``index``
+        (:const:`~workflow.workflow.INDEX_BLOCK_SIZE` items) at a time,
+        either with the batch scorer or one by one, whichever has been
+        quicker for the previous blocks.
+
+        If there is more than one CPU and at least
+        :attr:`~workflow.Workflow.filter_pool_size` items are left to
+        score after the first block, the rest are split between one
+        forked process per CPU. Each scores as many blocks as the
+        first one took to score in the time left of ``budget``.
+
+        Returns:
+            list: Items matching ``query``.
+
+        """
+        started = time.time()
+        self.filter_pending = False
+        if not session_key or version is None:
+            return super(Workflow3, self).filter(
+                query, items, key, ascending, include_score, min_score,
+                max_results, match_on, fold_diacritics, index, grams)
+
+        compiled = None
+        if isinstance(query, CompiledQuery):
+            compiled, query = query, query.query
+
+        query = (query or '').strip()
+        state = self.cached_data(session_key, max_age=0, session=True)
+        if state and state['version'] != version:
+            state = None
+
+        if compiled is None and state and state['query'] == query:
+            compiled = state.get('compiled')
+        if compiled is None:
+            compiled = self.compile_query(query, fold_diacritics)
+
+        words = compiled.words
+        if not words:
+            return items
+
+        if state and state['query'] == query and 'cursor' in state:
+            # Continue unfinished search
+            cursor = state['cursor']
+            candidates = state['candidates']
+            if candidates is not None:
+                candidates = _indices(candidates)
+            found = state['results']
+            survivors = _indices(state['survivors'])
+            self.logger.debug('[filter] resuming search for %r at %d',
+                              query, cursor)
+
+        else:
+            candidates = None
+            if state and query.startswith(state['query']):
+                candidates = self._search_candidates(state, len(items))
+                self.logger.debug('[filter] %d/%d candidate(s) from query %r',
+                                  len(candidates), len(items),
+                                  state['query'])
+
+            if budget is None:
+                results, survivors = self._filter_matches(
+                    words, items, key, index, match_on, candidates, grams,
+                    min_score, max_results, ascending)
+
+                if survivors is not None:
+                    self.cache_data(session_key, {
+                        'version': version,
+                        'query': query,
+                        'compiled': compiled,
+                        'survivors': array(b'I', survivors).tostring(),
+                    }, session=True)
+
+                return self._rank_results(results, ascending, include_score,
+                                          min_score, max_results)
+
+            if grams is not None:
+                candidates = self._narrow_candidates(words, grams, match_on,
+                                                     candidates)
+            cursor = 0
+            found = []
+            survivors = array(b'I')
+
+        # Seconds per block with the batch scorer and per candidate
+        # without it. Which is quicker depends on the query, so both are
+        # timed and the quicker one is used.
+        timings = {}
+        todo = xrange(len(items)) if candidates is None else candidates
+        deadline = None if budget is None else started + budget
+        processes = multiprocessing.cpu_count()
+        scored = 0  # candidates scored by this process
+        spent = 0.0  # time it took
+        while cursor < len(todo):
+            scoring = time.time()
+            pool = (processes > 1 and self.filter_pool_size and
+                    len(todo) - cursor >= self.filter_pool_size)
+            if pool and scored:
+                size = None  # all of them
+                if deadline is not None:
+                    size = (deadline - scoring) * scored / max(spent, 1e-6)
+                results, chunk, end = self._pool_blocks(
+                    words, items, key, index, match_on, todo, cursor,
+                    min_score, max_results, ascending, timings, processes,
+                    size)
+            else:
+                # Only one block if the rest can go to the pool: it shows
+                # how many each process can score in time
+                results, chunk, end = self._scan_blocks(
+                    words, items, key, index, match_on, todo,
+                    (cursor, len(todo)), min_score, max_results, ascending,
+                    timings, scoring if pool else deadline)
+                scored += end - cursor
+                spent += time.time() - scoring
+            found = _best_indices(found + results, items, ascending,
+                                  min_score, max_results)
+            survivors.fromstring(chunk)
+            cursor = end
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        state = {
+            'version': version,
+            'query': query,
+            'compiled': compiled,
+            'survivors': survivors.tostring(),
+        }
+        if cursor < len(todo):
+            if candidates is not None:
+                candidates = array(b'I', candidates).tostring()
+            state.update(cursor=cursor, candidates=candidates, results=found)
+            self.filter_pending = True
+            if not self.rerun or self.rerun > 0.1:
+                self.rerun = 0.1
+            self.logger.debug('[filter] scored %d/%d item(s) for %r',
+                              cursor, len(todo), query)
+
+        self.cache_data(session_key, state, session=True)
+
+        results = [(sort_key, (items[i], score, rule))
+                   for sort_key, (i, score, rule) in found]
+        return self._rank_results(results, ascending, include_score,
+                                  min_score, max_results)
+
+    def _scan_blocks(self, words, items, key, index, match_on, todo,
+                     bounds, min_score, max_results, ascending, timings,
+                     deadline=None):
+        """Score candidates ``todo`` one block of ``index`` at a time.
+
+        Args:
+            todo (list): Indices of the items to score (sorted).
+            bounds (tuple): Start and end of the candidates to score
+                in ``todo``. The end must be at the end of a block.
+            timings (dict): Seconds per block with the batch scorer
+                (``'batch'``) and per candidate without it (``'item'``).
+                Updated as blocks are scored.
+            deadline (float, optional): Stop after the block during
+                which this time passes.
+
+        See :meth:`filter` for the other arguments.
+
+        Returns:
+            tuple: ``(found, survivors, cursor)``. ``found`` are the best
+            ``(sort_key, (index, score, rule))`` results, ``survivors``
+            the items that contain the query's characters as a packed
+            :class:`array.array` and ``cursor`` the position in ``todo``
+            after the last block scored.
+
+        """
+        cursor, stop = bounds
+        columns = None
+        offset = 0
+        found = []
+        survivors = array(b'I')
+        while cursor < stop:
+            # Score the candidates in the next block of the index
+            block = todo[cursor] // INDEX_BLOCK_SIZE
+            end = bisect.bisect_left(todo, (block + 1) * INDEX_BLOCK_SIZE,
+                                     cursor, stop)
+            batch = None  # scored one by one without timing
+            if index is not None:
+                if 'blocks' in index:
+                    columns = _index_block(index, block)
+                    offset = block * INDEX_BLOCK_SIZE
+                    if self.filter_batch_size:
+                        batch = 'batch' not in timings
+                        if not batch and 'item' in timings:
+                            batch = (timings['batch'] <
+                                     timings['item'] * (end - cursor))
+                elif columns is None:  # index without blocks
+                    columns = [index[k].split('\x00') for k in SEARCH_KEYS]
+
+            scoring = time.time()
+            if batch:
+                results, chunk = self._batch_chunk(
+                    words, items, _block_index(index, block, columns),
+                    columns, match_on, todo, (cursor, end), min_score,
+                    max_results, ascending, offset)
+                timings['batch'] = time.time() - scoring
+            else:
+                results, chunk = self._score_chunk(
+                    words, items, key, index, columns, match_on, todo,
+                    (cursor, end), min_score, max_results, ascending,
+                    offset)
+                if batch is not None:
+                    timings['item'] = (time.time() - scoring) / (end - cursor)
+            found = _best_indices(found + results, items, ascending,
+                                  min_score, max_results)
+            survivors.fromstring(chunk)
+            cursor = end
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        return found, survivors.tostring(), cursor
+
+    def _pool_blocks(self, words, items, key, index, match_on, todo, cursor,
+                     min_score, max_results, ascending, timings, processes,
+                     size=None):
+        """Score blocks of candidates in parallel with :meth:`_scan_blocks`.
+
+        The candidates from ``cursor`` on are split into whole blocks
+        between ``processes`` forked processes (see
+        :func:`~workflow.workflow._fork_map`).
+
+        Args:
+            processes (int): Number of processes.
+            size (float, optional): Number of candidates each process
+                should score. At least one block each is scored. All
+                remaining candidates are scored if ``None``.
+
+        See :meth:`_scan_blocks` for the other arguments.
+
+        Returns:
+            tuple: ``(found, survivors, cursor)`` as for
+            :meth:`_scan_blocks`.
+
+        """
+        count = len(todo) - cursor
+        if size is None or size * processes > count:
+            size = -(-count // processes)  # round up
+        size = max(int(size), 1)
+
+        # end each process's share at the end of a block
+        bounds = []
+        start = cursor
+        while start < len(todo) and len(bounds) < processes:
+            end = min(start + size, len(todo))
+            last = todo[end - 1] // INDEX_BLOCK_SIZE
+            end = bisect.bisect_left(todo, (last + 1) * INDEX_BLOCK_SIZE,
+                                     end)
+            bounds.append((start, end))
+            start = end
+
+        self.logger.debug('[filter] scoring %d item(s) in %d processes',
+                          start - cursor, len(bounds))
+
+        def scan(bounds):
+            return self._scan_blocks(words, items, key, index, match_on,
+                                     todo, bounds, min_score, max_results,
+                                     ascending, dict(timings))[:2]
+
+        found = []
+        survivors = []
+        for results, chunk in _fork_map(scan, bounds):
+            found.extend(results)
+            survivors.append(chunk)
+
+        found = _best_indices(found, items, ascending, min_score,
+                              max_results)
+        return found, b''.join(survivors), start
+
+    def _search_candidates(self, state, count):
+        """Return indices of items that may match extensions of a query.
+
+        Args:
+            state (dict): Search state saved by :meth:`filter`.
+            count (int): Number of items.
+
+        Returns:
+            array.array: The items that survived the saved query and,
+                if the search is unfinished, those not yet scored.
+
+        """
+        candidates = _indices(state['survivors'])
+        if 'cursor' in state:
+            if state['candidates'] is None:
+                candidates.extend(xrange(state['cursor'], count))
+            else:
+                todo = _indices(state['candidates'])
+                candidates.extend(todo[state['cursor']:])
+
+        return candidates
 
     def clear_session_cache(self, current=False):
         """Remove session data from the cache.
@@ -0,0 +1,670 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""Tests for cache.py and the workflow cache it's built on.
+
+mdfind is replaced by the fake in `tests/bin`, which prints its results
+slowly, like a query of a big Smart Folder.
+
+"""
+
+from __future__ import print_function
+
+import fcntl
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+
+from workflow import Workflow3, background  # noqa: E402
+from workflow.workflow import CACHE_MANIFEST  # noqa: E402
+
+import cache  # noqa: E402
+
+FOLDER = u'/Users/me/Library/Saved Searches/Invoices.savedSearch'
+
+
+def fake_paths(count):
+    """Return sorted paths the fake mdfind prints if told to print `count`."""
+    return sorted(u'/Users/me/Documents/{0}/Caf\xe9 {1}.pdf'.format(i % 10, i)
+                  for i in range(count))
+
+
+class RecordingCache(cache.Cache):
+    """`Cache` that records the snapshots it publishes."""
+
+    def __init__(self, wf):
+        """Create new `RecordingCache`."""
+        super(RecordingCache, self).__init__()
+        self.wf = wf
+        # (time, files, partial flag exists, cached contents)
+        self.snapshots = []
+
+    def search_command(self, path):
+        """Return fake mdfind command."""
+        return ['mdfind', 'kMDItemContentType == com.adobe.pdf']
+
+    def _publisher(self, path, save):
+        """Record what `publish` leaves in the cache."""
+        publish = super(RecordingCache, self)._publisher(path, save)
+        flag = cache.partial_flag(self.wf, path)
+
+        def record(files):
+            publish(files)
+            cached = self.wf.cached_data(cache.cache_key(path), max_age=0,
+                                         serializer=cache.CONTENTS_SERIALIZER)
+            self.snapshots.append((time.time(), files, os.path.exists(flag),
+                                   list(cached)))
+
+        return record
+
+
+class CacheTestCase(unittest.TestCase):
+    """Workflow with an empty cache that runs the fake mdfind."""
+
+    def setUp(self):
+        """Point workflow at empty cache and fake mdfind."""
+        self.tempdir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        os.environ.update({
+            'alfred_version': '4.0',
+            'alfred_workflow_bundleid': 'net.deanishe.test',
+            'alfred_workflow_cache': os.path.join(self.tempdir, 'cache'),
+            'alfred_workflow_data': os.path.join(self.tempdir, 'data'),
+            'PATH': os.path.join(HERE, 'bin') + os.pathsep + os.getenv('PATH'),
+            'FAKE_MDFIND_COUNT': '1000',
+            'FAKE_MDFIND_BATCH': '100',
+            'FAKE_MDFIND_DELAY': '0.05',
+        })
+        self.wf = Workflow3()
+        cache.log = self.wf.logger
+
+    def tearDown(self):
+        """Restore environment."""
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tempdir)
+
+
+class ManifestTests(CacheTestCase):
+    """Cache entries are looked up in the cache manifest."""
+
+    def test_entries(self):
+        """Manifest records every cache saved and deleted."""
+        self.wf.cache_data('a', [1, 2, 3])
+        self.wf.cache_data('a', [1, 2])
+        self.wf.cache_data('b', u'text', serializer='json')
+
+        path = self.wf.cachefile('a.cpickle')
+        info = self.wf.cached_data_info('a')
+        self.assertEqual(info, {'name': 'a', 'serializer': 'cpickle',
+                                'mtime': os.path.getmtime(path),
+                                'size': os.path.getsize(path),
+                                'version': 2})
+        self.assertEqual(self.wf.cached_data_info('b', 'json')['version'], 1)
+        self.assertIsNone(self.wf.cached_data_info('b'))
+
+        # another process
+        wf = Workflow3()
+        self.assertEqual(wf.cached_data_info('a'), info)
+        self.assertEqual(sorted(i['name'] for i in wf.cached_data_entries()),
+                         ['a', 'b'])
+
+        wf.cache_data('a', None)
+        self.assertIsNone(wf.cached_data_info('a'))
+        self.assertIsNone(Workflow3().cached_data_info('a'))
+
+    def test_read_once(self):
+        """Manifest is read once, not the cache files each time."""
+        self.wf.cache_data('a', [1, 2, 3])
+        wf = Workflow3()
+        self.assertTrue(wf.cached_data_fresh('a', 60))
+        os.unlink(self.wf.cachefile('a.cpickle'))
+        os.unlink(self.wf.cachefile(CACHE_MANIFEST))
+
+        self.assertIsNotNone(wf.cached_data_info('a'))
+        # file deleted since manifest was read
+        self.assertIsNone(wf.cached_data('a', max_age=0))
+        self.assertIsNone(Workflow3().cached_data_info('a'))
+
+    def test_no_manifest(self):
+        """Caches saved without manifest are found in cache directory."""
+        self.wf.cache_data('a', [1, 2, 3])
+        self.wf.cache_data('b', u'text', serializer='json')
+        os.unlink(self.wf.cachefile(CACHE_MANIFEST))
+
+        wf = Workflow3()
+        info = wf.cached_data_info('a')
+        self.assertEqual(info['version'], 0)
+        self.assertEqual(info['size'],
+                         os.path.getsize(self.wf.cachefile('a.cpickle')))
+        self.assertEqual(sorted(i['name'] for i in wf.cached_data_entries()),
+                         ['a', 'b'])
+        self.assertEqual(wf.cached_data('a', max_age=0), [1, 2, 3])
+
+        # versions carry on from the manifest written now
+        wf.cache_data('a', [1])
+        self.assertEqual(Workflow3().cached_data_info('a')['version'], 1)
+        self.assertEqual(Workflow3().cached_data_info('b', 'json')['version'],
+                         0)
+
+
+class RefreshTests(CacheTestCase):
+    """Cached data updated in the background when stale."""
+
+    def setUp(self):
+        """Replace background jobs with fakes."""
+        super(RefreshTests, self).setUp()
+        self.jobs = {}  # name -> (cmd, age)
+        self.killed = []
+        self.defaults = (background.is_running, background.job_age,
+                         background.kill, background.run_in_background)
+        background.is_running = lambda name: name in self.jobs
+        background.job_age = lambda name: self.jobs[name][1]
+        background.kill = lambda name, group: self.killed.append(
+            (name, group))
+        background.run_in_background = lambda name, cmd: self.jobs.update(
+            {name: (cmd, 0)})
+
+    def tearDown(self):
+        """Restore background jobs."""
+        (background.is_running, background.job_age, background.kill,
+         background.run_in_background) = self.defaults
+        super(RefreshTests, self).tearDown()
+
+    def test_missing(self):
+        """Data loaded in background if not cached."""
+        self.assertEqual(self.wf.cached_data_swr('a', ['update'], 60),
+                         (None, True, True))
+        self.assertEqual(self.jobs, {'a': (['update'], 0)})
+        self.assertEqual(self.wf.rerun, 0.5)
+
+    def test_fresh(self):
+        """Fresh data returned without updating them."""
+        self.wf.cache_data('a', [1, 2])
+        self.assertEqual(self.wf.cached_data_swr('a', ['update'], 60),
+                         ([1, 2], False, False))
+        self.assertEqual(self.jobs, {})
+        self.assertEqual(self.wf.rerun, 0)
+
+    def test_stale(self):
+        """Stale data returned and updated in background."""
+        self.wf.cache_data('a', [1, 2])
+        time.sleep(0.02)
+        self.assertEqual(self.wf.cached_data_swr('a', ['update'], 0.01,
+                                                 job_name='job', rerun=1),
+                         ([1, 2], True, True))
+        self.assertEqual(self.jobs, {'job': (['update'], 0)})
+        self.assertEqual(self.wf.rerun, 1)
+
+    def test_running(self):
+        """Job isn't started twice, and rerun set while it runs."""
+        self.jobs['a'] = (['other'], 5)
+        self.wf.cache_data('a', [1, 2])
+        self.assertEqual(self.wf.cached_data_swr('a', ['update'], 60),
+                         ([1, 2], False, True))
+        self.assertTrue(self.wf.refresh_in_background('a', ['update']))
+        self.assertEqual(self.jobs, {'a': (['other'], 5)})
+        self.assertEqual(self.wf.rerun, 0.5)
+
+    def test_timeout(self):
+        """Job running longer than timeout is replaced if data are stale."""
+        self.jobs['a'] = (['other'], 5)
+        self.assertTrue(self.wf.refresh_in_background('a', ['update'], False,
+                                                      timeout=1))
+        self.assertEqual(self.killed, [])
+        self.assertTrue(self.wf.refresh_in_background('a', ['update'],
+                                                      timeout=10))
+        self.assertEqual(self.killed, [])
+        self.assertTrue(self.wf.refresh_in_background('a', ['update'],
+                                                      timeout=1))
+        self.assertEqual(self.killed, [('a', True)])
+        self.assertEqual(self.jobs, {'a': (['update'], 0)})
+
+
+class PrefetchTests(CacheTestCase):
+    """Contents of most used folders updated in advance."""
+
+    def setUp(self):
+        """Record background jobs instead of running them."""
+        super(PrefetchTests, self).setUp()
+        self.cache = cache.Cache()
+        self.cache.wf = self.wf
+        self.jobs = []
+        self.defaults = (cache.run_in_background, cache.PREFETCH_FOLDERS,
+                         cache.PREFETCH_AGE)
+        cache.run_in_background = lambda name, cmd: self.jobs.append(
+            (name, cmd))
+        self.paths = dict((name, u'/Users/me/Library/Saved Searches/'
+                                 u'{0}.savedSearch'.format(name))
+                          for name in 'ABCDE')
+
+    def tearDown(self):
+        """Restore settings."""
+        (cache.run_in_background, cache.PREFETCH_FOLDERS,
+         cache.PREFETCH_AGE) = self.defaults
+        super(PrefetchTests, self).tearDown()
+
+    def set_usage(self, usage):
+        """Save usage log of folders `{name: (count, days ago)}`."""
+        now = time.time()
+        self.wf.store_data(cache.USAGE_LOG, dict(
+            (self.paths[name], (n, now - days * 24 * 3600))
+            for name, (n, days) in usage.items()))
+
+    def test_record_usage(self):
+        """Usage log counts openings and records the last one."""
+        cache.record_usage(self.wf, self.paths['A'])
+        cache.record_usage(self.wf, self.paths['A'])
+        cache.record_usage(self.wf, self.paths['B'])
+
+        usage = self.wf.stored_data(cache.USAGE_LOG)
+        self.assertEqual(sorted(usage), [self.paths['A'], self.paths['B']])
+        count, last = usage[self.paths['A']]
+        self.assertEqual(count, 2)
+        self.assertLess(time.time() - last, 5)
+
+    def test_frequent_folders(self):
+        """Old openings count for less than recent ones."""
+        self.set_usage({'A': (20, 28), 'B': (3, 0.1), 'C': (1, 0)})
+        self.assertEqual(cache.frequent_folders(self.wf, 2),
+                         [self.paths['B'], self.paths['A']])
+        self.assertEqual(cache.frequent_folders(self.wf, 5),
+                         [self.paths[name] for name in 'BAC'])
+
+    def test_prefetch(self):
+        """Old or uncached contents of most used folders updated."""
+        cache.PREFETCH_FOLDERS = 4
+        cache.PREFETCH_AGE = 0.05
+        self.set_usage({'E': (10, 0), 'A': (9, 0), 'B': (8, 0),
+                        'C': (7, 0), 'D': (1, 0)})
+        self.cache.update_folder(self.paths['A'], fake_paths(10))
+        time.sleep(0.1)
+        self.cache.update_folder(self.paths['B'], fake_paths(10))
+
+        # E has been deleted
+        self.cache.prefetch([(name, self.paths[name]) for name in 'ABCD'])
+        self.assertEqual(self.jobs, [
+            (cache.cache_key(self.paths[name]),
+             cache.folder_command(self.wf, self.paths[name]))
+            for name in 'AC'])
+
+
+class SearchesTests(CacheTestCase):
+    """Parsed Smart Folders cached till they change."""
+
+    def setUp(self):
+        """Count parses of Smart Folders."""
+        super(SearchesTests, self).setUp()
+        self.parsed = []
+        self.parse_search = cache.parse_search
+
+        def parse(path):
+            self.parsed.append(path)
+            return self.parse_search(path)
+
+        cache.parse_search = parse
+        self.paths = dict((name, os.path.join(self.tempdir,
+                                              name + '.savedSearch'))
+                          for name in 'AB')
+        self.scope = os.path.join(self.tempdir, 'Invoices')
+        self.save('A', 'kind:pdf')
+        self.save('B', 'kind:txt')
+
+    def tearDown(self):
+        """Restore parser."""
+        cache.parse_search = self.parse_search
+        super(SearchesTests, self).tearDown()
+
+    def save(self, name, query, scopes=('kMDQueryScopeComputer',)):
+        """Save Smart Folder `name`."""
+        plistlib.writePlist({'RawQueryDict': {
+            'RawQuery': query,
+            'SearchScopes': list(scopes),
+        }}, self.paths[name])
+
+    def command(self, name):
+        """Return mdfind command of Smart Folder `name` (in new process)."""
+        searches = cache.Cache()
+        searches.wf = Workflow3()
+        return searches.search_command(self.paths[name])
+
+    def test_cached(self):
+        """Smart Folder parsed once."""
+        self.assertEqual(self.command('A'), ['mdfind', 'kind:pdf'])
+        self.assertEqual(self.command('A'), ['mdfind', 'kind:pdf'])
+        self.assertEqual(self.parsed, [self.paths['A']])
+
+    def test_changed(self):
+        """Smart Folder parsed again when it changes."""
+        self.command('A')
+        self.save('A', 'kind:image')
+        os.utime(self.paths['A'], (1, 1))
+        self.assertEqual(self.command('A'), ['mdfind', 'kind:image'])
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_missing_scope(self):
+        """Smart Folder parsed again when missing scope appears."""
+        self.save('A', 'kind:pdf', [self.scope])
+        self.assertEqual(self.command('A'), ['mdfind', 'kind:pdf'])
+        self.assertEqual(self.command('A'), ['mdfind', 'kind:pdf'])
+        os.mkdir(self.scope)
+        self.assertEqual(self.command('A'), ['mdfind', '-onlyin', self.scope,
+                                             'kind:pdf'])
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_invalid(self):
+        """Error parsing Smart Folder is cached, too."""
+        with open(self.paths['A'], 'wb') as fp:
+            fp.write(b'not a plist')
+        self.assertRaises(ValueError, self.command, 'A')
+        self.assertRaises(ValueError, self.command, 'A')
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_parse_searches(self):
+        """Changed Smart Folders parsed, deleted ones forgotten."""
+        searches = cache.Cache()
+        searches.wf = self.wf
+        searches.parse_searches([('A', self.paths['A']),
+                                 ('B', self.paths['B'])])
+        self.assertEqual(sorted(self.parsed), [self.paths['A'],
+                                               self.paths['B']])
+
+        self.save('A', 'kind:image')
+        os.utime(self.paths['A'], (1, 1))
+        searches = cache.Cache()
+        searches.wf = Workflow3()
+        searches.parse_searches([('A', self.paths['A'])])
+        self.assertEqual(len(self.parsed), 3)
+        self.assertEqual(sorted(self.wf.cached_data(cache.SEARCHES_CACHE,
+                                                    max_age=0)),
+                         [self.paths['A']])
+        self.assertEqual(self.command('A'), ['mdfind', 'kind:image'])
+        self.assertEqual(len(self.parsed), 3)
+
+
+class EvictTests(CacheTestCase):
+    """Least recently updated folder caches are evicted over budget."""
+
+    def setUp(self):
+        """Cache contents of folders A, B and C (updated in that order)."""
+        super(EvictTests, self).setUp()
+        self.cache = cache.Cache()
+        self.cache.wf = self.wf
+        self.paths = dict((name, u'/Users/me/Library/Saved Searches/'
+                                 u'{0}.savedSearch'.format(name))
+                          for name in 'ABCD')
+        self.wf.cache_data('folders', [(name, self.paths[name])
+                                       for name in 'ABC'])
+        for name in 'ABC':
+            self.update(name)
+            time.sleep(0.01)
+
+        # A's contents have been updated since
+        self.update('A', 1)
+        key = cache.cache_key(self.paths['A'])
+        size = sum(info['size'] for info in self.wf.cached_data_entries()
+                   if info['name'].startswith(key))
+        self.budget = size * 1.5 / 1024 / 1024
+
+    def update(self, name, extra=0):
+        """Cache contents of folder `name`."""
+        files = fake_paths(2000 + extra)
+        self.cache.update_folder(self.paths[name], files)
+
+    def cached(self):
+        """Return names of folders whose contents are cached."""
+        return [name for name in 'ABCD'
+                if self.wf.cached_data_info(cache.cache_key(self.paths[name]),
+                                            cache.CONTENTS_SERIALIZER)]
+
+    def deltas(self):
+        """Return names of folders with a log of changes."""
+        return [name for name in 'ABCD'
+                if os.path.exists(cache.delta_log(self.wf, self.paths[name]))]
+
+    def test_under_budget(self):
+        """Nothing evicted under budget."""
+        self.cache.evict()
+        self.assertEqual(self.cached(), ['A', 'B', 'C'])
+
+    def test_lru(self):
+        """Least recently updated folders evicted with their indices."""
+        os.environ['cache_budget'] = str(self.budget)
+        self.cache.evict()
+        self.assertEqual(self.cached(), ['A'])
+        self.assertEqual(self.deltas(), ['A'])
+        names = set(info['name'] for info in self.wf.cached_data_entries())
+        for name in 'BC':
+            key = cache.cache_key(self.paths[name])
+            self.assertFalse(set([key, key + '-index', key + '-grams']) &
+                             names)
+
+    def test_deleted_folder_first(self):
+        """Caches of deleted folders go first, however recent."""
+        os.environ['cache_budget'] = str(self.budget * 2.5)
+        self.update('D')
+        self.cache.evict()
+        self.assertEqual(self.cached(), ['A', 'B', 'C'])
+
+    def test_keep(self):
+        """Folder being viewed isn't evicted."""
+        os.environ['cache_budget'] = str(self.budget)
+        self.cache.evict(keep=cache.cache_key(self.paths['B']))
+        self.assertEqual(self.cached(), ['B'])
+
+    def test_in_use(self):
+        """Caches that are being read aren't evicted."""
+        os.environ['cache_budget'] = str(self.budget)
+        key = cache.cache_key(self.paths['B'])
+        with open(self.wf.cachefile(key + '.frontcoded'), 'rb') as fp:
+            fcntl.flock(fp, fcntl.LOCK_SH)
+            self.cache.evict()
+
+        self.assertIn('B', self.cached())
+        self.assertIn('B', self.deltas())
+        self.assertNotIn('C', self.cached())
+        self.assertEqual(list(self.wf.cached_data(key, max_age=0,
+                                                  serializer='frontcoded')),
+                         fake_paths(2000))
+
+
+class ConcurrentCache(cache.Cache):
+    """`Cache` that records how many folders it queries at once."""
+
+    def __init__(self, wf, files):
+        """Create new `ConcurrentCache` that finds `files` in each folder."""
+        super(ConcurrentCache, self).__init__()
+        self.wf = wf
+        self.files = files
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most = 0  # most queries running at once
+        self.queried = []
+
+    def search_command(self, path):
+        """Return fake mdfind command."""
+        return ['mdfind', 'kind:pdf']
+
+    def folder_contents(self, path, publish=None):
+        """Return `files` after a while."""
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+            self.queried.append(path)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        return self.files
+
+
+class RefreshStaleTests(CacheTestCase):
+    """`Cache.refresh_stale` updates stale folders in parallel."""
+
+    def setUp(self):
+        """Cache contents of folders A-F, F most recently."""
+        super(RefreshStaleTests, self).setUp()
+        self.defaults = cache.REFRESH_THREADS, cache.is_running
+        cache.REFRESH_THREADS = 2
+        self.paths = dict((name, u'/Users/me/Library/Saved Searches/'
+                                 u'{0}.savedSearch'.format(name))
+                          for name in 'ABCDEFG')
+        self.wf.cache_data('folders', sorted((name, path) for name, path
+                                             in self.paths.items()))
+        self.cache = ConcurrentCache(self.wf, fake_paths(20))
+        for name in 'ABCDE':
+            self.cache.update_folder(self.paths[name], fake_paths(10))
+        time.sleep(0.2)
+        self.cache.update_folder(self.paths['F'], fake_paths(10))
+
+    def tearDown(self):
+        """Restore settings."""
+        cache.REFRESH_THREADS, cache.is_running = self.defaults
+        super(RefreshStaleTests, self).tearDown()
+
+    def test_refresh_stale(self):
+        """Only stale folders refreshed, REFRESH_THREADS at a time."""
+        # B is being updated by a background job
+        key = cache.cache_key(self.paths['B'])
+        cache.is_running = lambda name: name == key
+        self.cache.refresh_stale(0.1)
+
+        stale = [self.paths[name] for name in 'ACDE']
+        self.assertEqual(sorted(self.cache.queried), stale)
+        self.assertEqual(self.cache.most, 2)
+        for name in 'ABCDEFG':
+            _, changes, _ = cache.contents_state(self.wf, self.paths[name])
+            self.assertEqual(len(changes.added),
+                             10 if self.paths[name] in stale else 0, name)
+
+
+class UpdateFolderTests(CacheTestCase):
+    """`Cache.update_folder` with slow mdfind output."""
+
+    def setUp(self):
+        """Snapshot more often."""
+        super(UpdateFolderTests, self).setUp()
+        self.defaults = cache.FIRST_SNAPSHOT, cache.SNAPSHOT_INTERVAL
+        cache.SNAPSHOT_INTERVAL = 0.2
+        self.cache = RecordingCache(self.wf)
+
+    def tearDown(self):
+        """Restore settings."""
+        cache.FIRST_SNAPSHOT, cache.SNAPSHOT_INTERVAL = self.defaults
+        super(UpdateFolderTests, self).tearDown()
+
+    def cached(self):
+        """Return cached contents of `FOLDER`."""
+        return list(self.wf.cached_data(cache.cache_key(FOLDER), max_age=0,
+                                        serializer=cache.CONTENTS_SERIALIZER))
+
+    def partial(self):
+        """Return `True` if contents of `FOLDER` are marked partial."""
+        return os.path.exists(cache.partial_flag(self.wf, FOLDER))
+
+    def test_first_snapshot(self):
+        """First snapshot after FIRST_SNAPSHOT paths."""
+        cache.FIRST_SNAPSHOT = 250
+        self.cache.update_folder(FOLDER)
+
+        _, files, flagged, cached = self.cache.snapshots[0]
+        self.assertGreaterEqual(len(files), cache.FIRST_SNAPSHOT)
+        self.assertTrue(flagged)
+        self.assertEqual(cached, files)
+        self.assertEqual(files, sorted(files))
+        self.assertTrue(set(files) < set(fake_paths(1000)))
+
+    def test_snapshot_interval(self):
+        """Snapshots every SNAPSHOT_INTERVAL seconds, each a superset."""
+        # takes at least 1s
+        os.environ['FAKE_MDFIND_COUNT'] = '2000'
+        self.cache.update_folder(FOLDER)
+
+        snapshots = self.cache.snapshots
+        self.assertGreater(len(snapshots), 2)
+        for prev, snap in zip(snapshots, snapshots[1:]):
+            self.assertGreaterEqual(snap[0] - prev[0],
+                                    cache.SNAPSHOT_INTERVAL)
+            self.assertTrue(set(prev[1]) < set(snap[1]))
+            self.assertTrue(snap[2])
+            self.assertEqual(snap[3], snap[1])
+
+    def test_complete(self):
+        """Complete contents cached and partial flag removed at the end."""
+        self.cache.update_folder(FOLDER)
+
+        self.assertTrue(self.cache.snapshots)
+        self.assertFalse(self.partial())
+        self.assertEqual(self.cached(), fake_paths(1000))
+        self.assertIsNotNone(self.wf.cached_data(cache.index_key(FOLDER),
+                                                 max_age=0))
+
+    def test_no_snapshots_when_cached(self):
+        """Complete cached contents aren't replaced by snapshots."""
+        self.cache.update_folder(FOLDER)
+        del self.cache.snapshots[:]
+        os.environ['FAKE_MDFIND_COUNT'] = '1100'
+
+        self.cache.update_folder(FOLDER)
+
+        self.assertEqual(self.cache.snapshots, [])
+        self.assertEqual(self.cached(), fake_paths(1000))
+        _, changes, _ = cache.contents_state(self.wf, FOLDER)
+        self.assertEqual(len(changes.added), 100)
+        self.assertFalse(self.partial())
+
+    def test_partial_contents_reloaded(self):
+        """Contents marked partial are loaded again from scratch."""
+        self.cache.update_folder(FOLDER)
+        open(cache.partial_flag(self.wf, FOLDER), 'wb').close()
+        del self.cache.snapshots[:]
+        os.environ['FAKE_MDFIND_COUNT'] = '900'
+
+        self.cache.update_folder(FOLDER)
+
+        self.assertTrue(self.cache.snapshots)
+        self.assertFalse(self.partial())
+        self.assertEqual(self.cached(), fake_paths(900))
+        _, changes, _ = cache.contents_state(self.wf, FOLDER)
+        self.assertEqual(len(changes), 0)
+
+    def test_timeout_after_snapshot(self):
+        """Partial contents aren't postponed when the query times out."""
+        os.environ['FAKE_MDFIND_HANG'] = '30'
+        os.environ['query_timeout'] = '1'
+
+        self.assertRaises(cache.QueryTimeout, self.cache.update_folder, FOLDER)
+
+        self.assertTrue(self.cache.snapshots)
+        self.assertTrue(self.partial())
+        self.assertEqual(self.cached(), self.cache.snapshots[-1][1])
+        self.assertFalse(self.cache.postpone(FOLDER))
+
+    def test_timeout_postponed(self):
+        """Complete contents are postponed when the query times out."""
+        self.cache.update_folder(FOLDER)
+        os.environ['FAKE_MDFIND_HANG'] = '30'
+        os.environ['query_timeout'] = '1'
+
+        self.assertRaises(cache.QueryTimeout, self.cache.update_folder, FOLDER)
+
+        self.assertFalse(self.partial())
+        self.assertTrue(self.cache.postpone(FOLDER))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""Tests that the fast paths of `Workflow.filter()` find the same results."""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+
+from workflow import Workflow3, workflow3  # noqa: E402
+from workflow.workflow import (MATCH_ALL, MATCH_ALLCHARS,  # noqa: E402
+                               MATCH_ATOM, MATCH_CAPITALS,
+                               MATCH_INITIALS, MATCH_INITIALS_CONTAIN,
+                               MATCH_STARTSWITH, MATCH_SUBSTRING,
+                               _find_allchars, _find_items, search_allchars)
+
+WORDS = (u'invoice report final draft tax budget caf\xe9 \xc9cole readme '
+         u'notes q1 q2').split()
+
+QUERIES = (u'inv', u'e', u'r', u'rep fin', u'cafe', u'ecole', u'tx', u'q',
+           u'readme', u'zz', u'rdm', u'dr t')
+
+MATCH_ON = (MATCH_ALL, MATCH_ALLCHARS, MATCH_STARTSWITH | MATCH_SUBSTRING)
+
+LIMITS = ({}, {'max_results': 10}, {'min_score': 50, 'max_results': 5},
+          {'ascending': True, 'max_results': 7})
+
+# Items that are hard to score in bulk: repeated and overlapping
+# matches, long keys, no name and leading whitespace
+EDGE_CASES = (u'/x/' + u'a' * 150, u'/x/' + u'ab' * 120, u'/x/',
+              u'/x/A' + u'b' * 99, u'/x/  Invoice', u'/x/InvoiceReport',
+              u'/x/\xfcber-Caf\xe9.pdf')
+
+
+def make_items(count, seed=3):
+    """Return `count` random paths made of `WORDS`."""
+    rand = random.Random(seed)
+    return [u'/f{0}/{1}'.format(
+        rand.randint(0, 50),
+        u' '.join(rand.choice(WORDS) for _ in range(rand.randint(1, 3))))
+        for _ in range(count)]
+
+
+class FilterTestCase(unittest.TestCase):
+    """Workflow with items, search index and gram index."""
+
+    def setUp(self):
+        """Create workflow and items."""
+        self.tempdir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        os.environ.update({
+            'alfred_version': '4.0',
+            'alfred_workflow_bundleid': 'net.deanishe.test',
+            'alfred_workflow_cache': os.path.join(self.tempdir, 'cache'),
+            'alfred_workflow_data': os.path.join(self.tempdir, 'data'),
+            '_WF_SESSION_ID': 'test',
+        })
+        self.wf = Workflow3()
+        self.items = make_items(3000)
+        self.index = self.wf.search_index(self.items, key=os.path.basename)
+        self.grams = self.wf.gram_index(self.index)
+
+    def tearDown(self):
+        """Restore environment."""
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tempdir)
+
+    def combinations(self):
+        """Yield `(query, kwargs)` for every combination of options."""
+        indices = ({}, {'index': self.index},
+                   {'index': self.index, 'grams': self.grams})
+        for query in QUERIES:
+            for match_on in MATCH_ON:
+                for kwargs in indices:
+                    for limits in LIMITS:
+                        kwargs = dict(kwargs, key=os.path.basename,
+                                      include_score=True, match_on=match_on)
+                        kwargs.update(limits)
+                        yield query, kwargs
+
+
+class HelperTests(unittest.TestCase):
+    """Bulk searches of NUL-joined keys."""
+
+    def setUp(self):
+        """Generate random keys."""
+        rand = random.Random(5)
+        self.items = [u''.join(rand.choice(u'abc \n\xe9')
+                               for _ in range(rand.randint(0, 12)))
+                      for _ in range(500)]
+        self.blob = u'\x00'.join(self.items)
+        self.queries = set(u''.join(rand.choice(u'abc\xe9')
+                                    for _ in range(rand.randint(1, 4)))
+                           for _ in range(200))
+
+    def test_find_items(self):
+        """`_find_items` finds items containing/starting with substring."""
+        for sub in self.queries:
+            self.assertEqual(list(_find_items(self.blob, sub)),
+                             [i for i, s in enumerate(self.items)
+                              if sub in s], sub)
+            self.assertEqual(list(_find_items(self.blob, sub, True)),
+                             [i for i, s in enumerate(self.items)
+                              if s.startswith(sub)], sub)
+
+    def test_find_allchars(self):
+        """`_find_allchars` finds what `search_allchars` does."""
+        for query in self.queries:
+            expected = []
+            for i, s in enumerate(self.items):
+                match = search_allchars(query, s)
+                if match:
+                    expected.append((i, match.start(), match.end()))
+
+            self.assertEqual(list(_find_allchars(self.blob, query)),
+                             expected, query)
+
+    def test_positions(self):
+        """`AllCharsMatch.positions` are in the tightest window."""
+        self.assertEqual(search_allchars(u'ab', u'axxxxb ab').positions,
+                         (7, 8))
+        self.assertEqual(search_allchars(u'abc', u'abxc\nabc').positions,
+                         (0, 1, 3))
+        for query in self.queries:
+            for s in self.items:
+                match = search_allchars(query, s)
+                if not match:
+                    continue
+
+                # shortest match from each start on the line, first
+                # of the shortest
+                line = s[match.start():].split(u'\n')[0]
+                windows = []
+                for i, c in enumerate(line):
+                    if c != query[0]:
+                        continue
+                    end = i + 1
+                    for c in query[1:]:
+                        end = line.find(c, end) + 1
+                        if not end:
+                            break
+                    else:
+                        windows.append((end - 1 - i, i))
+
+                width, i = min(windows)
+                positions = match.positions
+                self.assertEqual((positions[0] - match.start(),
+                                  positions[-1] - positions[0]),
+                                 (i, width), (query, s))
+                self.assertEqual(u''.join(s[p] for p in positions), query)
+                self.assertEqual(list(positions), sorted(set(positions)))
+
+
+class BatchTests(FilterTestCase):
+    """Indexed items scored in bulk."""
+
+    def setUp(self):
+        """Add edge cases to items."""
+        super(BatchTests, self).setUp()
+        self.items.extend(EDGE_CASES)
+        self.index = self.wf.search_index(self.items, key=os.path.basename)
+        self.grams = self.wf.gram_index(self.index)
+
+    def test_same_results(self):
+        """Batch scorer and indices find same results as item by item."""
+        failed = []
+        for query, kwargs in self.combinations():
+            self.assertOK(query, kwargs, failed)
+
+        self.assertEqual(failed, [])
+
+    def test_match_on(self):
+        """Batch scorer finds same results for each rule."""
+        failed = []
+        queries = QUERIES + (u'a b', u'a inv', u'b a', u'voi', u'ice rep',
+                             u'Report', u'a', u'ab', u'abab', u'ubc')
+        for match_on in (MATCH_ALL, MATCH_ALL ^ MATCH_ALLCHARS,
+                         MATCH_ATOM | MATCH_SUBSTRING, MATCH_CAPITALS,
+                         MATCH_INITIALS, MATCH_INITIALS_CONTAIN,
+                         MATCH_CAPITALS | MATCH_ALLCHARS):
+            for fold in (True, False):
+                for query in queries:
+                    self.assertOK(query, {'key': os.path.basename,
+                                          'include_score': True,
+                                          'match_on': match_on,
+                                          'fold_diacritics': fold,
+                                          'index': self.index,
+                                          'grams': self.grams}, failed)
+
+        self.assertEqual(failed, [])
+
+    def assertOK(self, query, kwargs, failed):
+        """Add `(query, kwargs)` to `failed` if results differ."""
+        baseline = dict((k, v) for k, v in kwargs.items()
+                        if k not in ('index', 'grams'))
+        self.wf.filter_batch_size = 0
+        expected = self.wf.filter(query, self.items, **baseline)
+        got = self.wf.filter(query, self.items, **kwargs)
+        self.wf.filter_batch_size = 1
+        batched = self.wf.filter(query, self.items, **kwargs)
+        if got != expected or batched != expected:
+            failed.append((query, kwargs))
+
+
+class BudgetTests(FilterTestCase):
+    """Searches that run out of time and are resumed on rerun."""
+
+    def setUp(self):
+        """Use enough items for several runs."""
+        super(BudgetTests, self).setUp()
+        self.items = make_items(20000, seed=11)
+        self.index = self.wf.search_index(self.items, key=os.path.basename)
+        self.grams = self.wf.gram_index(self.index)
+
+    def expected(self, query, items, **kwargs):
+        """Return results of unbudgeted search."""
+        return self.wf.filter(query, items, key=os.path.basename,
+                              include_score=True, max_results=50, **kwargs)
+
+    def rerun(self, query, items, version, **kwargs):
+        """Run budgeted search as Alfred would rerun the Script Filter.
+
+        Returns `(results, wf)`. `wf` is the `Workflow3` the search
+        ran in.
+
+        """
+        wf = Workflow3()
+        results = wf.filter(query, items, key=os.path.basename,
+                            include_score=True, max_results=50,
+                            session_key='test', version=version,
+                            budget=0.000001, **kwargs)
+        return results, wf
+
+    def state(self):
+        """Return saved state of search."""
+        return self.wf.cached_data('test', max_age=0, session=True)
+
+    def test_resume(self):
+        """Search continues where previous run stopped."""
+        for version, kwargs in enumerate(({}, {'index': self.index},
+                                          {'index': self.index,
+                                           'grams': self.grams})):
+            cursors = []
+            while True:
+                results, wf = self.rerun(u'rep', self.items, version,
+                                         **kwargs)
+                if not wf.filter_pending:
+                    break
+                self.assertEqual(wf.rerun, 0.1)
+                cursors.append(self.state()['cursor'])
+
+            self.assertGreater(len(cursors), 1, kwargs)
+            self.assertEqual(cursors, sorted(set(cursors)), kwargs)
+            self.assertEqual(wf.rerun, 0)
+            self.assertNotIn('cursor', self.state())
+            self.assertEqual(results, self.expected(u'rep', self.items,
+                                                    **kwargs), kwargs)
+
+    def test_extended_query(self):
+        """Unfinished search narrows search for longer query."""
+        for _ in range(3):
+            _, wf = self.rerun(u'r', self.items, 1, index=self.index)
+            self.assertTrue(wf.filter_pending)
+
+        for query in (u're', u'rep'):
+            results, wf = self.rerun(query, self.items, 1, index=self.index)
+            self.assertTrue(wf.filter_pending)
+            while wf.filter_pending:
+                results, wf = self.rerun(query, self.items, 1,
+                                         index=self.index)
+
+            self.assertEqual(results, self.expected(query, self.items,
+                                                    index=self.index))
+
+    def test_version_changed(self):
+        """Search starts again when items change."""
+        _, wf = self.rerun(u'rep', self.items, 1)
+        self.assertTrue(wf.filter_pending)
+        cursor = self.state()['cursor']
+
+        # each run scores one block, so it's the first block again
+        items = make_items(20000, seed=12)
+        _, wf = self.rerun(u'rep', items, 2)
+        self.assertTrue(wf.filter_pending)
+        self.assertEqual(self.state()['cursor'], cursor)
+        while wf.filter_pending:
+            results, wf = self.rerun(u'rep', items, 2)
+
+        self.assertEqual(results, self.expected(u'rep', items))
+
+
+class PoolTests(FilterTestCase):
+    """Items scored in parallel."""
+
+    def setUp(self):
+        """Pretend there are 4 CPUs."""
+        super(PoolTests, self).setUp()
+        self.cpu_count = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 4
+
+    def tearDown(self):
+        """Restore CPU count."""
+        multiprocessing.cpu_count = self.cpu_count
+        super(PoolTests, self).tearDown()
+
+    def test_same_results(self):
+        """Pool finds same results as serial scorer."""
+        failed = []
+        count = 0
+        for query, kwargs in self.combinations():
+            self.wf.filter_pool_size = 0
+            serial = self.wf.filter(query, self.items, **kwargs)
+            self.wf.filter_pool_size = 1
+            pool = self.wf.filter(query, self.items, **kwargs)
+            count += 1
+            if pool != serial:
+                failed.append((query, kwargs))
+
+        self.assertEqual(count, 432)
+        self.assertEqual(failed, [])
+
+    def test_narrowing(self):
+        """Pool survivors narrow extended queries correctly."""
+        for query in (u'r', u're', u'rep', u'repo'):
+            self.wf.filter_pool_size = 1
+            pool = self.wf.filter(query, self.items, key=os.path.basename,
+                                  include_score=True, index=self.index,
+                                  session_key='test', version=1,
+                                  max_results=20)
+            self.wf.filter_pool_size = 0
+            serial = self.wf.filter(query, self.items, key=os.path.basename,
+                                    include_score=True, index=self.index,
+                                    max_results=20)
+            self.assertEqual(pool, serial, query)
+
+    def test_budget(self):
+        """Budgeted searches score blocks in the pool, too."""
+        items = make_items(20000, seed=7)
+        index = self.wf.search_index(items, key=os.path.basename)
+        grams = self.wf.gram_index(index)
+        calls = []
+        fork_map = workflow3._fork_map
+
+        def spy(func, args):
+            calls.append(len(args))
+            return fork_map(func, args)
+
+        workflow3._fork_map = spy
+        try:
+            version = 0
+            for query in (u'e', u'rep', u'q2'):
+                for kwargs in ({}, {'index': index},
+                               {'index': index, 'grams': grams}):
+                    kwargs = dict(kwargs, key=os.path.basename,
+                                  include_score=True, max_results=50)
+                    self.wf.filter_pool_size = 0
+                    serial = self.wf.filter(query, items, **kwargs)
+                    self.wf.filter_pool_size = 1
+                    version += 1
+                    while True:
+                        pool = self.wf.filter(query, items, session_key='test',
+                                              version=version, budget=0.005,
+                                              **kwargs)
+                        if not self.wf.filter_pending:
+                            break
+                    self.assertEqual(pool, serial, (query, kwargs))
+        finally:
+            workflow3._fork_map = fork_map
+
+        self.assertTrue(calls)
+        self.assertTrue(all(n <= 4 for n in calls))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""Tests for live.py.
+
+mdfind is replaced by the fake in `tests/bin`, which reports changes
+like `mdfind -live`.
+
+"""
+
+from __future__ import print_function
+
+import os
+import plistlib
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+from time import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+
+from workflow import Workflow3  # noqa: E402
+
+import cache  # noqa: E402
+import live  # noqa: E402
+import store  # noqa: E402
+
+
+class LiveTests(unittest.TestCase):
+    """`live.main` with a recently opened Smart Folder."""
+
+    def setUp(self):
+        """Create Smart Folder and point workflow at fake mdfind."""
+        self.tempdir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        os.environ.update({
+            'alfred_version': '4.0',
+            'alfred_workflow_bundleid': 'net.deanishe.test',
+            'alfred_workflow_cache': os.path.join(self.tempdir, 'cache'),
+            'alfred_workflow_data': os.path.join(self.tempdir, 'data'),
+            'PATH': os.path.join(HERE, 'bin') + os.pathsep + os.getenv('PATH'),
+            'FAKE_MDFIND_COUNT': '10',
+            'FAKE_MDFIND_DELAY': '0.1',
+            'FAKE_MDFIND_UPDATES': '2',
+        })
+        self.wf = Workflow3()
+        live.log = cache.log = self.wf.logger
+        self.defaults = (live.LIVE_IDLE, live.LIVE_CHECK, live.LIVE_DELAY,
+                         live.run_in_background)
+        live.LIVE_IDLE = 1.5
+        live.LIVE_CHECK = 0.1
+        live.LIVE_DELAY = 0.5
+        # background jobs started by the daemon: (name, cmd)
+        self.jobs = []
+        live.run_in_background = lambda name, cmd: self.jobs.append(
+            (name, cmd))
+        self.sigterm = signal.getsignal(signal.SIGTERM)
+
+        self.path = os.path.join(self.tempdir, 'Invoices.savedSearch')
+        plistlib.writePlist({'RawQueryDict': {
+            'RawQuery': 'kMDItemContentType == com.adobe.pdf',
+            'SearchScopes': ['kMDQueryScopeComputer'],
+        }}, self.path)
+        self.folders = [(u'Invoices', self.path)]
+
+    def tearDown(self):
+        """Restore environment and settings."""
+        (live.LIVE_IDLE, live.LIVE_CHECK, live.LIVE_DELAY,
+         live.run_in_background) = self.defaults
+        signal.signal(signal.SIGTERM, self.sigterm)
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tempdir)
+
+    def run_daemon(self):
+        """Run daemon till it exits and return how long it ran."""
+        start = time()
+        live.main(self.wf)
+        return time() - start
+
+    def assert_updated(self, duration):
+        """Check folder was watched and updated once after its changes."""
+        self.assertGreaterEqual(duration, 1.0)
+        self.assertEqual(self.jobs, [(cache.cache_key(self.path),
+                                      cache.folder_command(self.wf,
+                                                           self.path))])
+        self.assertIsNone(self.wf.cached_data(live.LIVE_JOB, max_age=0))
+
+    def test_watch(self):
+        """Folder updated when live query reports changes."""
+        self.wf.cache_data('folders', self.folders)
+        cache.record_usage(self.wf, self.path)
+
+        self.assert_updated(self.run_daemon())
+
+    def test_watch_store(self):
+        """Folders read from SQLite cache if it's used."""
+        os.environ['use_sqlite'] = '1'
+        store.Store(self.wf).set_folders(self.folders)
+        cache.record_usage(self.wf, self.path)
+
+        self.assert_updated(self.run_daemon())
+
+    def test_no_recent_folders(self):
+        """Daemon exits at once if no folder was opened recently."""
+        self.wf.cache_data('folders', self.folders)
+
+        self.assertLess(self.run_daemon(), 0.5)
+        self.assertEqual(self.jobs, [])
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""Tests for searches of folder contents cached by cache.py."""
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+
+from workflow import Workflow3  # noqa: E402
+
+import cache  # noqa: E402
+import smartfolders  # noqa: E402
+
+FOLDER = u'/Users/me/Library/Saved Searches/Documents.savedSearch'
+
+EXTENSIONS = ('pdf', 'txt', 'docx', 'png')
+
+
+def make_paths(count, start=0):
+    """Return `count` sorted paths, a quarter of them PDFs."""
+    return sorted(u'/Users/me/Documents/{0}/Report {1}.{2}'.format(
+        i % 10, i, EXTENSIONS[i % len(EXTENSIONS)])
+        for i in range(start, start + count))
+
+
+class SearchFolderTestCase(unittest.TestCase):
+    """`SmartFolders` controller with an empty cache."""
+
+    def setUp(self):
+        """Create workflow and controller."""
+        self.tempdir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        os.environ.update({
+            'alfred_version': '4.0',
+            'alfred_workflow_bundleid': 'net.deanishe.test',
+            'alfred_workflow_cache': os.path.join(self.tempdir, 'cache'),
+            'alfred_workflow_data': os.path.join(self.tempdir, 'data'),
+            '_WF_SESSION_ID': 'test',
+        })
+        self.wf = Workflow3()
+        smartfolders.log = cache.log = self.wf.logger
+        self.budget = smartfolders.SEARCH_BUDGET
+        self.cache = cache.Cache()
+        self.cache.wf = self.wf
+        self.sf = smartfolders.SmartFolders()
+        self.sf.wf = self.wf
+
+    def tearDown(self):
+        """Restore environment and settings."""
+        smartfolders.SEARCH_BUDGET = self.budget
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tempdir)
+
+    def search(self, query):
+        """Run `_search_folder` for `query` once and return its results."""
+        self.sf.query = query
+        mtime, changes, _ = cache.contents_state(self.wf, FOLDER)
+        return self.sf._search_folder(FOLDER, cache.cache_key(FOLDER),
+                                      mtime, changes)
+
+    def expected(self, query, files):
+        """Return what an unbudgeted `Workflow.filter` finds in `files`."""
+        return self.wf.filter(query, files, key=os.path.basename,
+                              min_score=10,
+                              max_results=smartfolders.MAX_RESULTS)
+
+
+class SearchFolderTests(SearchFolderTestCase):
+    """`SmartFolders._search_folder` with a log of changes."""
+
+    def test_pending_with_changes(self):
+        """Unfinished search stays pending when changes are searched too."""
+        files = make_paths(20000)
+        added = make_paths(10, start=20000)
+        self.cache.update_folder(FOLDER, files)
+        self.cache.update_folder(FOLDER, files[5:] + added)
+        changes = cache.contents_state(self.wf, FOLDER)[1]
+        self.assertEqual(len(changes), 15)
+
+        smartfolders.SEARCH_BUDGET = 0.001
+        runs = 1
+        results = self.search('pdf')
+        self.assertTrue(self.wf.filter_pending)
+        while self.wf.filter_pending:
+            self.assertLess(runs, 20000)
+            results = self.search('pdf')
+            runs += 1
+
+        self.assertGreater(runs, 1)
+        self.assertEqual(results, self.expected('pdf', files[5:] + added))
+
+
+class MemoTests(SearchFolderTestCase):
+    """Reruns with the same query get memoised results."""
+
+    def setUp(self):
+        """Cache contents of `FOLDER`."""
+        super(MemoTests, self).setUp()
+        self.files = make_paths(2000)
+        self.cache.update_folder(FOLDER, self.files)
+        self.searches = 0
+
+    def run_search(self, query):
+        """Show results for `query` like a new run of the Script Filter.
+
+        Returns paths of the results and whether the search is pending.
+
+        """
+        wf = Workflow3()
+        sf = smartfolders.SmartFolders()
+        sf.wf = wf
+        sf.query = query
+        sf.folders = [smartfolders.Folder(u'Documents', FOLDER)]
+        search = sf._search_folder
+
+        def counted(*args):
+            self.searches += 1
+            return search(*args)
+
+        sf._search_folder = counted
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            sf.do_search_in_folder(FOLDER)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        paths = [it['arg'] for it in json.loads(output)['items']
+                 if 'arg' in it]
+        return paths, wf.filter_pending
+
+    def test_memo(self):
+        """Results are memoised till query or contents change."""
+        results, _ = self.run_search('pdf')
+        self.assertEqual(results, self.expected('pdf', self.files))
+        self.assertEqual(self.run_search('pdf'), (results, False))
+        self.assertEqual(self.searches, 1)
+
+        self.run_search('txt')
+        self.assertEqual(self.searches, 2)
+
+        added = make_paths(10, start=2000)
+        self.cache.update_folder(FOLDER, self.files + added)
+        results, _ = self.run_search('pdf')
+        self.assertEqual(self.searches, 3)
+        self.assertEqual(results, self.expected('pdf', self.files + added))
+
+    def test_pending_not_memoised(self):
+        """Results of unfinished searches aren't memoised."""
+        self.files = make_paths(20000)
+        self.cache.update_folder(FOLDER, self.files)
+        smartfolders.SEARCH_BUDGET = 0.000001
+        results, pending = self.run_search('pdf')
+        self.assertTrue(pending)
+        while pending:
+            results, pending = self.run_search('pdf')
+
+        self.assertGreater(self.searches, 2)
+        self.assertEqual(results, self.expected('pdf', self.files))
+        searches = self.searches
+        self.assertEqual(self.run_search('pdf'), (results, False))
+        self.assertEqual(self.searches, searches)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
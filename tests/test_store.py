@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-17
+#
+
+"""Tests for searches of the SQLite cache."""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+
+from workflow import Workflow3  # noqa: E402
+
+import cache  # noqa: E402
+import smartfolders  # noqa: E402
+import store  # noqa: E402
+
+FOLDER = u'/Users/me/Library/Saved Searches/Documents.savedSearch'
+
+FILES = sorted([
+    u'/Users/me/Documents/Invoice 2026-01.pdf',
+    u'/Users/me/Documents/invoices/Report Final.docx',
+    u'/Users/me/Documents/Caf\xe9 Menu.pdf',
+    u'/Users/me/Documents/\xc9cole/notes.txt',
+    u'/Users/me/Documents/100%_done.txt',
+    u'/Users/me/Documents/back\\slash',
+    u'/Users/me/Documents/ExpenseReport.xlsx',
+] + [u'/Users/me/Documents/misc/file {0}.txt'.format(i) for i in range(50)])
+
+
+class SearchStoreTests(unittest.TestCase):
+    """`SmartFolders._search_store` finds what `Workflow.filter` does."""
+
+    def setUp(self):
+        """Create SQLite cache with contents of `FOLDER`."""
+        self.tempdir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        os.environ.update({
+            'alfred_version': '4.0',
+            'alfred_workflow_bundleid': 'net.deanishe.test',
+            'alfred_workflow_cache': os.path.join(self.tempdir, 'cache'),
+            'alfred_workflow_data': os.path.join(self.tempdir, 'data'),
+            '_WF_SESSION_ID': 'test',
+        })
+        self.wf = Workflow3()
+        smartfolders.log = cache.log = self.wf.logger
+        self.store = store.Store(self.wf)
+        self.cache = cache.Cache()
+        self.cache.wf = self.wf
+        self.key = cache.cache_key(FOLDER)
+        self.sf = smartfolders.SmartFolders()
+        self.sf.wf = self.wf
+        self.sf.store = self.store
+
+    def tearDown(self):
+        """Restore environment."""
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tempdir)
+
+    def search(self, query):
+        """Return all results for `query` from the SQLite cache."""
+        self.sf.query = query
+        while True:
+            results = self.sf._search_store(FOLDER, self.key)
+            if not self.wf.filter_pending:
+                return results
+
+    def expected(self, query):
+        """Return what `Workflow.filter` finds for `query`."""
+        return self.wf.filter(query, FILES, key=os.path.basename,
+                              min_score=10,
+                              max_results=smartfolders.MAX_RESULTS)
+
+    def test_search(self):
+        """Short queries via index, long ones via SQLite."""
+        self.cache.store_contents(self.store, FOLDER, FILES)
+        self.assertIsNotNone(self.sf._stored_index(FOLDER, self.key))
+        for query in ('e', 'in', 'f 1', u'\xe9', 'caf', 'inv rep', '100%',
+                      'back\\', '_', 'er', 'zq'):
+            self.assertEqual(self.search(query), self.expected(query),
+                             query)
+
+    def test_search_extended(self):
+        """Short queries narrowed down as they're extended."""
+        self.cache.store_contents(self.store, FOLDER, FILES)
+        for query in ('f', 'fi', 'fil', 'file'):
+            self.assertEqual(self.search(query), self.expected(query),
+                             query)
+
+    def test_search_pending(self):
+        """Short queries searched in several runs if they take too long."""
+        files = sorted(u'/Users/me/Documents/{0}/Report {1}.pdf'.format(
+            i % 10, i) for i in range(20000))
+        self.cache.store_contents(self.store, FOLDER, files)
+        budget = smartfolders.SEARCH_BUDGET
+        smartfolders.SEARCH_BUDGET = 0.000001
+        try:
+            self.sf.query = 'r'
+            self.sf._search_store(FOLDER, self.key)
+            self.assertTrue(self.wf.filter_pending)
+            self.assertEqual(self.search('r'), self.wf.filter(
+                'r', files, key=os.path.basename, min_score=10,
+                max_results=smartfolders.MAX_RESULTS))
+        finally:
+            smartfolders.SEARCH_BUDGET = budget
+
+    def test_not_indexed(self):
+        """Contents without index searched via SQLite."""
+        self.store.set_contents(FOLDER, FILES)
+        self.assertIsNone(self.sf._stored_index(FOLDER, self.key))
+        for query in ('e', 'in', u'\xe9'):
+            self.assertEqual(self.search(query), self.expected(query),
+                             query)
+
+    def test_other_version(self):
+        """Cached contents of a different update aren't searched."""
+        self.cache.store_contents(self.store, FOLDER, FILES)
+        self.wf.cache_data(self.key, FILES[:10],
+                           serializer=cache.CONTENTS_SERIALIZER)
+        self.assertIsNone(self.sf._stored_index(FOLDER, self.key))
+        for query in ('e', 'in', u'\xe9'):
+            self.assertEqual(self.search(query), self.expected(query),
+                             query)
+
+    def test_unchanged(self):
+        """Unchanged contents aren't cached and indexed again."""
+        self.cache.store_contents(self.store, FOLDER, FILES)
+        version = self.store.indexed(FOLDER)
+        updated = self.store.updated(FOLDER)
+        self.cache.store_contents(self.store, FOLDER, list(FILES))
+        self.assertEqual(self.store.indexed(FOLDER), version)
+        self.assertGreater(self.store.updated(FOLDER), updated)
+
+        self.cache.store_contents(self.store, FOLDER, FILES[1:])
+        self.assertEqual(self.store.indexed(FOLDER), version + 1)
+        self.assertEqual(self.store.contents(FOLDER), FILES[1:])
+        files, _, _, v = self.sf._stored_index(FOLDER, self.key)
+        self.assertEqual((list(files), v), (FILES[1:], version + 1))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()